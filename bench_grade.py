@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Grading throughput benchmark built on Example/Q1..Q4.
+
+Synthesizes N submission ZIPs from the example exam (correct copies and mutated ones),
+grades them through grade_batch like the batch views do, and writes a JSON report that
+can be compared between versions:
+
+    python bench_grade.py -n 40 --workers 4 -o bench.json
+"""
+import argparse, json, math, os, random, re, shutil, struct, subprocess, sys, tempfile, time, zipfile
+from collections import Counter
+from pathlib import Path
+
+from grade_core import grade_batch, find_java_tools, looks_like_question_root, PHASE_KEYS, DEFAULT_MAX_OUTPUT_BYTES
+
+HERE = Path(__file__).resolve().parent
+
+DEFAULT_MIX = "correct=50,wrong_output=20,infinite_loop=10,compile_error=10,huge_output=10,corrupt_zip=2"
+
+MAIN_RE = re.compile(r"public\s+static\s+void\s+main\s*\([^)]*\)\s*(?:throws\s+[\w.,\s]+)?\{")
+
+# Statements inserted at the top of main(); the guards keep the code after them reachable for javac
+MUTATIONS = {
+    "correct": None,
+    "wrong_output": 'System.out.println("WRONG ANSWER");',
+    "infinite_loop": "if (System.nanoTime() > 0) { while (true) { } }",
+    "compile_error": "this is not java;",
+    "huge_output": 'if (System.nanoTime() > 0) { while (true) { System.out.println("spam spam spam spam spam spam spam"); } }',
+    # Not a source change: the archive is written with a broken deflate stream (see corrupt_deflate)
+    "corrupt_zip": None,
+}
+
+# Test statuses the mutated question must show at least one of; compile_error is checked on the summary instead
+EXPECTED_STATUSES = {
+    "wrong_output": {"OK", "RuntimeError", "EarlyMismatch"},
+    "infinite_loop": {"Timeout"},
+    "huge_output": {"OutputLimitExceeded", "EarlyMismatch", "Timeout"},
+}
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in MUTATIONS:
+            raise argparse.ArgumentTypeError(f"unknown mutation {name!r} (choose from {', '.join(MUTATIONS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def _gradable_files(example: Path):
+    """(relative path, bytes) of what a submission ZIP needs: sources, reference jars and test cases."""
+    files = []
+    for q in sorted(p for p in example.iterdir() if p.is_dir() and p.name.upper().startswith("Q")):
+        for pattern in ("Given/src/**/*.java", "Given/run/*.jar", "TestCases/*.txt"):
+            for p in sorted(q.glob(pattern)):
+                files.append((p.relative_to(example).as_posix(), p.read_bytes()))
+    return files
+
+
+def mutate_source(text: str, mutation: str) -> str:
+    stmt = MUTATIONS[mutation]
+    if stmt is None:
+        return text
+    m = MAIN_RE.search(text)
+    if not m:
+        return text
+    return text[:m.end()] + "\n        " + stmt + text[m.end():]
+
+
+def corrupt_deflate(zip_path: Path):
+    """Break the deflate stream of every member; the ZIP still opens but its members do not read."""
+    data = bytearray(zip_path.read_bytes())
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            if info.compress_size:
+                name_len, extra_len = struct.unpack("<HH", data[info.header_offset + 26:info.header_offset + 30])
+                # 0xFF starts a block of the reserved type 3
+                data[info.header_offset + 30 + name_len + extra_len] = 0xFF
+    zip_path.write_bytes(data)
+
+
+def synthesize(example: Path, out_dir: Path, count: int, mix: dict, seed: int):
+    """Write count ZIPs to out_dir; returns [(zip path, mutation, question)].
+
+    A compile_error submission leaves out the mutated question's run/*.jar, otherwise the
+    grader would fall back to the jar and give the broken question full marks.
+    """
+    rng = random.Random(seed)
+    files = _gradable_files(example)
+    questions = sorted({rel.split("/", 1)[0] for rel, _ in files})
+    names, weights = zip(*mix.items())
+    out_dir.mkdir(parents=True, exist_ok=True)
+    made = []
+    for i in range(count):
+        mutation = rng.choices(names, weights)[0]
+        target_q = rng.choice(questions) if MUTATIONS[mutation] else ""
+        student = f"SE{i + 1:04d}_Bench"
+        zip_path = out_dir/f"{student}.zip"
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            for rel, data in files:
+                if mutation == "compile_error" and rel.startswith(f"{target_q}/Given/run/"):
+                    continue
+                if rel.endswith("/Main.java"):
+                    text = data.decode("utf-8", errors="ignore")
+                    if rel.startswith(f"{target_q}/"):
+                        text = mutate_source(text, mutation)
+                    # A per-student comment keeps the result store from deduplicating identical copies
+                    data = (text + f"\n// {student}\n").encode("utf-8")
+                zf.writestr(f"{student}/{rel}", data)
+        if mutation == "corrupt_zip":
+            corrupt_deflate(zip_path)
+        made.append((zip_path, mutation, target_q))
+    return made
+
+
+def check_outcome(row, mutation: str, question: str) -> str:
+    """Why a graded submission does not look like its mutation; empty when it does."""
+    if mutation == "corrupt_zip":
+        # Reported on its own row, without failing the rest of the batch
+        return "" if row["Error"] else "graded despite the corrupt archive"
+    if row["Error"]:
+        return row["Error"]
+    if mutation == "correct":
+        return "" if row["Max"] and row["Score"] >= row["Max"] else f"scored {row['Score']}/{row['Max']}"
+    summary = next((s for s in row["Summaries"] if s["Question"] == question), None)
+    if summary is None:
+        return f"{question} was not graded"
+    if mutation == "compile_error":
+        return "" if not summary["Compiled"] and not summary["Score"] else f"{question} compiled or scored {summary['Score']}"
+    if summary["Passed"] >= summary["Total"]:
+        return f"{question} passed {summary['Passed']}/{summary['Total']}"
+    statuses = set()
+    for meta_path in Path(row["OutDir"]).glob(f"{question}-*-meta.json") if row["OutDir"] else ():
+        try:
+            statuses.add(json.loads(meta_path.read_text(encoding="utf-8")).get("Status", ""))
+        except (OSError, ValueError):
+            pass
+    if not statuses & EXPECTED_STATUSES[mutation]:
+        return f"{question} statuses {sorted(statuses)}, expected one of {sorted(EXPECTED_STATUSES[mutation])}"
+    return ""
+
+
+def percentile(values, pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _collect_tests(rows):
+    tests = []
+    for row in rows:
+        out_dir = Path(row["OutDir"]) if row["OutDir"] else None
+        if not out_dir or not out_dir.exists():
+            continue
+        for meta_path in out_dir.glob("*-meta.json"):
+            try:
+                tests.append(json.loads(meta_path.read_text(encoding="utf-8")))
+            except (OSError, ValueError):
+                pass
+    return tests
+
+
+def _peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    scale = 1024 if sys.platform == "darwin" else 1
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def build_parser():
+    ap = argparse.ArgumentParser(description="Benchmark grading throughput on synthesized submissions")
+    ap.add_argument("-n", "--submissions", type=int, default=20, help="Number of submission ZIPs to synthesize")
+    ap.add_argument("--example", default=str(HERE/"Example"), help="Exam folder with Q1..Qn (default: Example/)")
+    ap.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                    help=f"Mutation weights (default: {DEFAULT_MIX})")
+    ap.add_argument("--seed", type=int, default=1, help="Seed for the mutation mix")
+    ap.add_argument("--java-home", default=os.environ.get("JAVA_HOME", ""), help="JDK folder (default: $JAVA_HOME, then PATH)")
+    ap.add_argument("--workers", type=int, default=None, help="Parallel grading processes (default: CPU count)")
+    ap.add_argument("--test-workers", type=int, default=None, help="Concurrent test cases per question")
+    ap.add_argument("--timeout-ms", type=int, default=2000, help="Default TIMEOUT_MS; bounds the infinite-loop mutation")
+    ap.add_argument("--max-output-kb", type=int, default=DEFAULT_MAX_OUTPUT_BYTES // 1024, help="Per-stream output cap in KB")
+    ap.add_argument("--warm-jvm", action="store_true", help="Run tests in a reused JVM when possible")
+    ap.add_argument("--compile-daemon", action="store_true", help="Compile with a warm in-process javac")
+    ap.add_argument("--early-fail", action="store_true", help="Stop a student program once its output can no longer match")
+    ap.add_argument("--work-dir", default=None, help="Where ZIPs and results go (default: a temporary folder)")
+    ap.add_argument("--keep", action="store_true", help="Keep the work folder afterwards")
+    ap.add_argument("-o", "--output", default="bench.json", help="JSON report (default: bench.json)")
+    return ap
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    example = Path(args.example)
+    if not looks_like_question_root(example):
+        print(f"error: no Q* folders in {example}", file=sys.stderr)
+        return 2
+    javac, java = find_java_tools(args.java_home or None)
+
+    work = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix="autograde_bench_"))
+    try:
+        made = synthesize(example, work/"submissions", args.submissions, args.mix, args.seed)
+        defaults = {
+            "Strict": False,
+            "IgnoreTrailingPerLine": False,
+            "RemoveSpaces": None,
+            "CaseSensitive": None,
+            "TimeoutMs": args.timeout_ms,
+            "MaxOutputBytes": args.max_output_kb * 1024 if args.max_output_kb else None,
+            "WarmJvm": args.warm_jvm,
+            "CompileDaemon": args.compile_daemon,
+            "EarlyFail": args.early_fail,
+            "TestWorkers": args.test_workers,
+        }
+        cache_dir = work/"_autograde_cache"
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        started = time.perf_counter()
+        rows = grade_batch([p for p, _, _ in made], args.java_home, defaults, cache_dir=cache_dir, workers=args.workers)
+        wall_s = time.perf_counter() - started
+
+        mismatches = []
+        for row, (zip_path, mutation, question) in zip(rows, made):
+            problem = check_outcome(row, mutation, question)
+            if problem:
+                mismatches.append({"submission": zip_path.name, "mutation": mutation, "question": question, "problem": problem})
+        tests = _collect_tests(rows)
+        latencies = [t["ElapsedMs"] for t in tests if t.get("ElapsedMs") is not None]
+        student_rss = [t["Usage"]["PeakRssKb"] for t in tests if t.get("Usage", {}).get("PeakRssKb") is not None]
+        self_rss, children_rss = _peak_rss_kb()
+        report = {
+            "revision": _git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "java": java,
+            "config": {
+                "submissions": args.submissions,
+                "mix": args.mix,
+                "seed": args.seed,
+                "workers": args.workers,
+                "cpu_count": os.cpu_count(),
+                "defaults": defaults,
+            },
+            "wall_s": round(wall_s, 3),
+            "submissions_per_minute": round(len(rows) * 60.0 / wall_s, 2) if wall_s else None,
+            "errors": sum(1 for r in rows if r["Error"]),
+            "mutations": dict(Counter(m for _, m, _ in made)),
+            "tests": len(tests),
+            "statuses": dict(Counter(t.get("Status", "") for t in tests)),
+            "mismatches": mismatches,
+            "test_latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "max": max(latencies) if latencies else None,
+            },
+            "phase_ms": {k: round(sum(r["Timing"].get(k, 0.0) for r in rows), 1) for k in ("ExtractMs",) + PHASE_KEYS},
+            "peak_rss_kb": {
+                "grader": self_rss,
+                "largest_child": children_rss,
+                "student_max": max(student_rss) if student_rss else None,
+            },
+        }
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"{report['submissions_per_minute']} submissions/min, p50 {report['test_latency_ms']['p50']} ms, "
+          f"p95 {report['test_latency_ms']['p95']} ms -> {args.output}", file=sys.stderr)
+    for m in report["mismatches"]:
+        print(f"mismatch: {m['submission']} ({m['mutation']} {m['question']}): {m['problem']}", file=sys.stderr)
+    return 1 if report["mismatches"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
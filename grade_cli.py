@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Headless entry point: python grade_cli.py ... or python -m grade_core ...
+
+Exit codes: 0 all submissions graded, 1 at least one submission could not be graded,
+2 bad arguments, 3 java/javac not found.
+"""
+import argparse, csv, json, os, shutil, sys
+from pathlib import Path
+
+from grade_core import (grade_batch, default_cache_dir, default_workers, find_java_tools,
+                        looks_like_question_root, DEFAULT_MAX_OUTPUT_BYTES, DEFAULT_LIMITS)
+from grade_store import BatchJournal
+
+EXIT_OK, EXIT_SUBMISSION_ERROR, EXIT_USAGE, EXIT_NO_JAVA = 0, 1, 2, 3
+
+
+def _tri_state(value: str):
+    return {"yes": True, "no": False}.get(value)
+
+
+def add_grading_options(ap):
+    """The options that make up the grading defaults; grade_cluster shares them."""
+    ap.add_argument("--strict", action="store_true", help="Strict compare (no normalization)")
+    ap.add_argument("--ignore-trailing", action="store_true", help="Ignore trailing spaces per line")
+    ap.add_argument("--remove-spaces", choices=["default", "yes", "no"], default="default", help="Default REMOVE_SPACES")
+    ap.add_argument("--case-sensitive", choices=["default", "yes", "no"], default="default", help="Default CASE_SENSITIVE")
+    ap.add_argument("--timeout-ms", type=int, default=None, help="Default TIMEOUT_MS")
+    ap.add_argument("--max-output-kb", type=int, default=DEFAULT_MAX_OUTPUT_BYTES // 1024, help="Per-stream output cap in KB")
+    ap.add_argument("--memory-mb", type=int, default=None,
+                    help=f"Heap of each student run, as -Xmx (default: {DEFAULT_LIMITS['MemoryMb']}; 0 = no limit)")
+    ap.add_argument("--stack-kb", type=int, default=None, help="Thread stack of each student run, as -Xss (default: JVM default)")
+    ap.add_argument("--cpu-seconds", type=int, default=None, help="CPU time of each student run, Linux only (default: no limit)")
+    ap.add_argument("--max-processes", type=int, default=None,
+                    help="RLIMIT_NPROC of each student run; counts all processes and threads of the grading user (default: no limit)")
+    ap.add_argument("--file-size-mb", type=int, default=None,
+                    help=f"Largest file a student run may write, Linux only (default: {DEFAULT_LIMITS['FileSizeMb']}; 0 = no limit)")
+    ap.add_argument("--warm-jvm", action="store_true", help="Run tests in a reused JVM when possible")
+    ap.add_argument("--compile-daemon", action="store_true", help="Compile with a warm in-process javac")
+    ap.add_argument("--early-fail", action="store_true", help="Stop a student program once its output can no longer match")
+    ap.add_argument("--single-file", action="store_true",
+                    help="Keep per-test outputs in one _grading_out/grading.sqlite instead of three files per test")
+
+
+def defaults_from_args(args) -> dict:
+    """Grading defaults from the options of add_grading_options."""
+    return {
+        "Strict": args.strict,
+        "IgnoreTrailingPerLine": args.ignore_trailing,
+        "RemoveSpaces": _tri_state(args.remove_spaces),
+        "CaseSensitive": _tri_state(args.case_sensitive),
+        "TimeoutMs": args.timeout_ms,
+        "MaxOutputBytes": args.max_output_kb * 1024 if args.max_output_kb else None,
+        "WarmJvm": args.warm_jvm,
+        "CompileDaemon": args.compile_daemon,
+        "EarlyFail": args.early_fail,
+        "OutputFormat": "sqlite" if args.single_file else "files",
+        "MemoryMb": args.memory_mb,
+        "StackKb": args.stack_kb,
+        "CpuSeconds": args.cpu_seconds,
+        "MaxProcesses": args.max_processes,
+        "FileSizeMb": args.file_size_mb,
+    }
+
+
+def build_parser():
+    ap = argparse.ArgumentParser(prog="python -m grade_core", description="PE Java autograder (headless)")
+    ap.add_argument("sources", nargs="+",
+                    help="Question roots (folders with Q1..Qn) or submission ZIPs; a folder without Q* "
+                         "subfolders is treated as a batch of submissions (its subfolders and *.zip)")
+    ap.add_argument("--java-home", default=os.environ.get("JAVA_HOME", ""), help="JDK folder (default: $JAVA_HOME, then PATH)")
+    add_grading_options(ap)
+    ap.add_argument("--workers", type=int, default=default_workers(), help="Parallel grading processes (default: CPU count)")
+    ap.add_argument("--test-workers", type=int, default=None,
+                    help="Test cases of one question run concurrently (default: up to 4, 1 when several submissions run in parallel)")
+    ap.add_argument("--journal", default=None,
+                    help="Append finished submissions to this file and skip the ones it already has (same content and settings)")
+    ap.add_argument("--cache-dir", default=None, help="Shared cache folder (default: _autograde_cache next to the sources)")
+    ap.add_argument("--format", choices=["jsonl", "csv"], default="jsonl", help="Result format")
+    ap.add_argument("-o", "--output", default="-", help="Result file (default: stdout)")
+    ap.add_argument("-q", "--quiet", action="store_true", help="No progress lines on stderr")
+    return ap
+
+
+def expand_sources(values):
+    sources = []
+    for value in values:
+        path = Path(value)
+        if path.is_dir() and not looks_like_question_root(path):
+            # Skip the cache and the <zip>_grading_out folders earlier runs left next to the ZIPs
+            children = sorted(p for p in path.iterdir()
+                              if not p.name.startswith("_") and not p.name.endswith("_grading_out")
+                              and (p.is_dir() or p.suffix.lower() == ".zip"))
+            sources.extend(children)
+        else:
+            sources.append(path)
+    return sources
+
+
+def _java_available(tool: str) -> bool:
+    return Path(tool).exists() or shutil.which(tool) is not None
+
+
+def check_java(java_home: str) -> bool:
+    """Whether java and javac of java_home (or PATH) exist; prints the error when they do not."""
+    javac, java = find_java_tools(java_home or None)
+    if _java_available(javac) and _java_available(java):
+        return True
+    print(f"error: java/javac not found (java={java}, javac={javac}); set --java-home or JAVA_HOME", file=sys.stderr)
+    return False
+
+
+def result_record(row: dict) -> dict:
+    max_score = row["Max"]
+    rec = {
+        "Source": row["Source"],
+        "Score": row["Score"],
+        "Max": max_score,
+        "Percent": round(100.0 * row["Score"] / max_score, 2) if max_score else 0.0,
+        "OutDir": row["OutDir"],
+        "Error": row["Error"],
+        "Resumed": row.get("Resumed", False),
+        "DedupHits": row.get("DedupHits", 0),
+        "TestsReused": row.get("TestsReused", 0),
+        "TestsExecuted": row.get("TestsExecuted", 0),
+    }
+    rec.update(row.get("Timing", {}))
+    for s in row.get("Summaries", []):
+        rec[f"{s['Question']}.Score"] = s["Score"]
+        rec[f"{s['Question']}.Max"] = s["MaxScore"]
+    return rec
+
+
+def write_results(records, fmt: str, stream):
+    if fmt == "jsonl":
+        for rec in records:
+            stream.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        return
+    fields = []
+    for rec in records:
+        for key in rec:
+            if key not in fields:
+                fields.append(key)
+    w = csv.DictWriter(stream, fieldnames=fields)
+    w.writeheader()
+    for rec in records:
+        w.writerow(rec)
+
+
+def main(argv=None) -> int:
+    ap = build_parser()
+    args = ap.parse_args(argv)
+
+    sources = expand_sources(args.sources)
+    missing = [str(s) for s in sources if not s.exists()]
+    if missing or not sources:
+        ap.print_usage(sys.stderr)
+        print(f"error: not found: {', '.join(missing) or 'no submissions'}", file=sys.stderr)
+        return EXIT_USAGE
+
+    if not check_java(args.java_home):
+        return EXIT_NO_JAVA
+
+    defaults = defaults_from_args(args)
+    defaults["TestWorkers"] = args.test_workers
+    first = Path(args.sources[0])
+    cache_dir = Path(args.cache_dir) if args.cache_dir else default_cache_dir(first if first.is_dir() else first.parent)
+
+    def on_result(src, row):
+        if not args.quiet:
+            status = f"ERROR {row['Error']}" if row["Error"] else f"{row['Score']} / {row['Max']}"
+            tag = "resumed" if row.get("Resumed") else "done"
+            print(f"[{tag}] {src}: {status}", file=sys.stderr, flush=True)
+
+    journal = BatchJournal(args.journal) if args.journal else None
+    try:
+        rows = grade_batch(sources, args.java_home, defaults, cache_dir=cache_dir, workers=args.workers, on_result=on_result,
+                           journal=journal)
+    finally:
+        if journal is not None:
+            journal.close()
+    records = [result_record(r) for r in rows]
+    if args.output == "-":
+        write_results(records, args.format, sys.stdout)
+    else:
+        with open(args.output, "w", newline="", encoding="utf-8") as f:
+            write_results(records, args.format, f)
+
+    return EXIT_SUBMISSION_ERROR if any(r["Error"] for r in rows) else EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
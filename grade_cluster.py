@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+"""
+Grading on several machines: a coordinator hands out the submission ZIPs of a batch over HTTP
+and any number of workers grade them with grade_submission, then send back the result row and
+the output folder.
+
+    python grade_cluster.py serve subs/*.zip --host 0.0.0.0 --port 8765 -o results.jsonl
+    python grade_cluster.py work http://coordinator:8765 --java-home /opt/jdk17
+    python grade_cluster.py local subs/*.zip --workers 3        # coordinator and workers on this machine
+
+The shared secret comes from --token or $AUTOGRADE_TOKEN and travels in the X-Autograde-Token header.
+
+Protocol (JSON bodies unless noted):
+    POST /lease                         {"worker"} -> {"job": {"id", "name", "defaults", "lease_s"} | null, "done"}
+    GET  /jobs/<id>/zip                 -> the submission ZIP
+    POST /jobs/<id>/heartbeat           {"worker"} -> {"ok", "cancel"}
+    POST /jobs/<id>/result?worker=<w>   ZIP with row.json and out/... -> {"accepted"}
+A lease without a heartbeat for lease_s seconds goes back to the queue, so the jobs of a
+crashed worker are graded again by another one.
+"""
+import argparse, hmac, io, json, os, secrets, shutil, socket, subprocess, sys, tempfile, threading, time, uuid, zipfile
+import urllib.error, urllib.parse, urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from grade_core import (grade_submission, schedule_submissions, schedule_store_dir, record_question_timings, submission_row,
+                        CancelToken, CANCELLED_ERROR)
+from grade_cli import result_record, write_results, add_grading_options, defaults_from_args, check_java, EXIT_NO_JAVA
+from grade_store import ResultStore
+
+TOKEN_HEADER = "X-Autograde-Token"
+TOKEN_ENV = "AUTOGRADE_TOKEN"
+DEFAULT_PORT = 8765
+LEASE_S = 60.0
+POLL_S = 2.0
+# A job whose worker disappeared this many times is reported as an error instead of re-queued
+MAX_ATTEMPTS = 3
+# Consecutive failed requests after which a worker assumes the coordinator is gone
+CONNECT_RETRIES = 5
+LOST_ERROR = "Không chấm được: worker bị mất kết nối {attempts} lần."
+
+EXIT_OK, EXIT_SUBMISSION_ERROR, EXIT_USAGE = 0, 1, 2
+
+
+class Coordinator:
+    """
+    Queue of the ZIPs of one batch, handed out longest first (schedule_submissions).
+    Output folders come back to <zip>_grading_out next to each ZIP, as with local grading, and the
+    question timings measured by the workers go into the store the next batch is scheduled from;
+    record_timings=False when the workers already write to that store themselves.
+    on_result(source, row) is called from the HTTP threads as results arrive.
+    """
+
+    def __init__(self, sources, defaults: dict | None = None, host: str = "127.0.0.1", port: int = DEFAULT_PORT,
+                 token: str = "", lease_s: float = LEASE_S, on_result=None, job=None, cache_dir: Path | None = None,
+                 record_timings: bool = True):
+        self.defaults = dict(defaults or {})
+        self.cache_dir = cache_dir
+        self.record_timings = record_timings
+        self.stores = {}
+        self.token = token
+        self.lease_s = lease_s
+        self.on_result = on_result
+        self.job = job
+        self.order = [str(s) for s in sources]
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.queue = deque()
+        for i, est in enumerate(schedule_submissions(self.order, self.defaults, cache_dir)):
+            job_id = str(i + 1)
+            self.jobs[job_id] = {"Source": est.source, "Cost": est.cost_ms, "Attempts": 0}
+            self.queue.append(job_id)
+        self.leases = {}
+        self.receiving = set()
+        self.rows = {}
+        self.cancelled = False
+        if job is not None:
+            job.expect(len(self.jobs), "submission", cost=sum(j["Cost"] for j in self.jobs.values()))
+        self.server = ThreadingHTTPServer((host, port), _handler_for(self))
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def finished(self) -> bool:
+        return len(self.rows) == len(self.jobs)
+
+    def _finish(self, job_id, row):
+        src = self.jobs[job_id]["Source"]
+        self.rows[src] = row
+        self.cond.notify_all()
+        if self.job is not None:
+            self.job.advance(cost=self.jobs[job_id]["Cost"])
+        if self.on_result:
+            self.on_result(src, row)
+
+    def _finish_cancelled(self, job_id):
+        row = submission_row(self.jobs[job_id]["Source"], error=CANCELLED_ERROR)
+        row["Cancelled"] = True
+        self._finish(job_id, row)
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id, (_, deadline) in list(self.leases.items()):
+            if deadline >= now or job_id in self.receiving:
+                continue
+            del self.leases[job_id]
+            attempts = self.jobs[job_id]["Attempts"]
+            if self.cancelled:
+                self._finish_cancelled(job_id)
+            elif attempts >= MAX_ATTEMPTS:
+                self._finish(job_id, submission_row(self.jobs[job_id]["Source"], error=LOST_ERROR.format(attempts=attempts)))
+            else:
+                self.queue.appendleft(job_id)
+
+    def lease(self, worker: str) -> dict:
+        with self.cond:
+            self._expire()
+            if self.cancelled or not self.queue:
+                return {"job": None, "done": self.finished()}
+            job_id = self.queue.popleft()
+            self.jobs[job_id]["Attempts"] += 1
+            self.leases[job_id] = (worker, time.monotonic() + self.lease_s)
+            return {"job": {"id": job_id, "name": Path(self.jobs[job_id]["Source"]).name, "defaults": self.defaults,
+                            "lease_s": self.lease_s}, "done": False}
+
+    def heartbeat(self, job_id: str, worker: str) -> dict:
+        with self.cond:
+            lease = self.leases.get(job_id)
+            ok = lease is not None and lease[0] == worker
+            if ok:
+                self.leases[job_id] = (worker, time.monotonic() + self.lease_s)
+            return {"ok": ok, "cancel": self.cancelled}
+
+    def job_zip(self, job_id: str):
+        found = self.jobs.get(job_id)
+        return Path(found["Source"]) if found else None
+
+    def accept(self, job_id: str, body: bytes) -> bool:
+        """Store a worker's result; False when the job already has one (a re-queued copy finished first)."""
+        with self.cond:
+            if job_id not in self.jobs or self.jobs[job_id]["Source"] in self.rows or job_id in self.receiving:
+                return False
+            self.receiving.add(job_id)
+        try:
+            row = _unpack_result(Path(self.jobs[job_id]["Source"]), body)
+            if self.record_timings:
+                self._record_timings(row)
+        except BaseException:
+            with self.cond:
+                self.receiving.discard(job_id)
+            raise
+        with self.cond:
+            self.receiving.discard(job_id)
+            self.leases.pop(job_id, None)
+            if job_id in self.queue:
+                self.queue.remove(job_id)
+            self._finish(job_id, row)
+        return True
+
+    def _record_timings(self, row: dict):
+        store_dir = schedule_store_dir(row["Source"], self.cache_dir)
+        with self.cond:
+            store = self.stores.get(store_dir)
+            if store is None:
+                store = self.stores[store_dir] = ResultStore.for_cache_dir(store_dir)
+        record_question_timings(store, row.get("Summaries", []))
+
+    def cancel(self):
+        """Queued jobs come back cancelled at once; workers stop theirs at the next heartbeat."""
+        with self.cond:
+            self.cancelled = True
+            while self.queue:
+                self._finish_cancelled(self.queue.popleft())
+
+    def _wait_round(self) -> bool:
+        with self.cond:
+            self._expire()
+            if not self.finished():
+                self.cond.wait(1.0)
+            return self.finished()
+
+    def run(self):
+        """Serve until every job has a row; returns the rows in source order."""
+        thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.2}, daemon=True)
+        thread.start()
+        try:
+            try:
+                while not self._wait_round():
+                    pass
+            except KeyboardInterrupt:
+                # First Ctrl+C: stop handing out jobs and collect what the workers have
+                self.cancel()
+                while not self._wait_round():
+                    pass
+            # Let polling workers hear that the batch is done before the port closes
+            time.sleep(POLL_S * 1.5)
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            for store in self.stores.values():
+                store.close()
+        return [self.rows[src] for src in self.order]
+
+
+def _handler_for(coord: Coordinator):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _authorized(self) -> bool:
+            if coord.token and not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ""), coord.token):
+                self._send(403, {"error": "bad token"})
+                return False
+            return True
+
+        def _send(self, code: int, payload=None, body: bytes | None = None, ctype: str = "application/json"):
+            data = body if body is not None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        def _route(self):
+            url = urllib.parse.urlsplit(self.path)
+            return url.path.strip("/").split("/"), urllib.parse.parse_qs(url.query)
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            parts, _ = self._route()
+            path = coord.job_zip(parts[1]) if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "zip" else None
+            if path is None:
+                self._send(404, {"error": "not found"})
+                return
+            self._send(200, body=path.read_bytes(), ctype="application/zip")
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            parts, query = self._route()
+            body = self._body()
+            try:
+                if parts == ["lease"]:
+                    self._send(200, coord.lease(json.loads(body)["worker"]))
+                elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "heartbeat":
+                    self._send(200, coord.heartbeat(parts[1], json.loads(body)["worker"]))
+                elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "result":
+                    self._send(200, {"accepted": coord.accept(parts[1], body)})
+                else:
+                    self._send(404, {"error": "not found"})
+            except (ValueError, KeyError, zipfile.BadZipFile) as exc:
+                self._send(400, {"error": str(exc)})
+
+    return Handler
+
+
+def _pack_result(row: dict) -> bytes:
+    """row.json plus the output folder under out/; compiled classes stay on the worker."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("row.json", json.dumps(row, ensure_ascii=False))
+        out_dir = Path(row["OutDir"]) if row.get("OutDir") else None
+        if out_dir is not None and out_dir.is_dir():
+            for p in sorted(out_dir.rglob("*")):
+                rel = p.relative_to(out_dir)
+                if p.is_file() and not any(part.endswith("-classes") for part in rel.parts):
+                    zf.write(p, "out/" + rel.as_posix())
+    return buf.getvalue()
+
+
+def _unpack_result(zip_source: Path, body: bytes) -> dict:
+    dest = zip_source.with_name(f"{zip_source.stem}_grading_out")
+    partial = dest.with_name(dest.name + ".partial")
+    shutil.rmtree(partial, ignore_errors=True)
+    root = partial.resolve()
+    with zipfile.ZipFile(io.BytesIO(body)) as zf:
+        row = json.loads(zf.read("row.json"))
+        for info in zf.infolist():
+            parts = info.filename.split("/")
+            if info.is_dir() or parts[0] != "out" or len(parts) < 2:
+                continue
+            # Resolved, so backslashes, drive letters and absolute parts cannot leave the folder either
+            target = root.joinpath(*parts[1:]).resolve()
+            if target == root or not target.is_relative_to(root):
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(zf.read(info))
+    if partial.exists():
+        shutil.rmtree(dest, ignore_errors=True)
+        partial.rename(dest)
+        row["OutDir"] = str(dest)
+    else:
+        row["OutDir"] = ""
+    row["Source"] = str(zip_source)
+    return row
+
+
+class Worker:
+    """Leases jobs from a coordinator until it reports the batch done or stops answering."""
+
+    def __init__(self, url: str, java_home: str = "", token: str = "", cache_dir: Path | None = None,
+                 test_workers: int | None = None, worker_id: str | None = None, poll_s: float = POLL_S):
+        self.url = url.rstrip("/")
+        self.java_home = java_home
+        self.token = token
+        # Kept between jobs, so resubmitted ZIPs and shared reference outputs hit the caches
+        self.cache_dir = Path(cache_dir) if cache_dir else Path(tempfile.gettempdir())/"autograde_worker_cache"
+        self.test_workers = test_workers
+        self.id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.poll_s = poll_s
+
+    def _request(self, method: str, path: str, payload=None, body: bytes | None = None, ctype: str = "application/json"):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else body
+        req = urllib.request.Request(self.url + path, data=data, method=method)
+        req.add_header(TOKEN_HEADER, self.token)
+        if data is not None:
+            req.add_header("Content-Type", ctype)
+        with urllib.request.urlopen(req, timeout=120) as resp:
+            raw = resp.read()
+        return json.loads(raw) if resp.headers.get_content_type() == "application/json" else raw
+
+    def run(self) -> int:
+        """Returns how many jobs this worker graded."""
+        graded = failures = 0
+        while True:
+            try:
+                resp = self._request("POST", "/lease", {"worker": self.id})
+                failures = 0
+            except urllib.error.HTTPError:
+                raise
+            except (urllib.error.URLError, OSError):
+                failures += 1
+                if failures > CONNECT_RETRIES:
+                    return graded
+                time.sleep(self.poll_s)
+                continue
+            job = resp["job"]
+            if job is None:
+                if resp["done"]:
+                    return graded
+                time.sleep(self.poll_s)
+                continue
+            self._grade(job)
+            graded += 1
+
+    def _grade(self, job: dict):
+        work = Path(tempfile.mkdtemp(prefix="autograde_worker_"))
+        try:
+            zip_path = work/Path(job["name"]).name
+            zip_path.write_bytes(self._request("GET", f"/jobs/{job['id']}/zip"))
+            defaults = dict(job["defaults"])
+            if self.test_workers:
+                defaults["TestWorkers"] = self.test_workers
+            cancel = CancelToken()
+            stop = threading.Event()
+            beat = threading.Thread(target=self._heartbeat, args=(job, cancel, stop), daemon=True)
+            beat.start()
+            try:
+                row = grade_submission(zip_path, self.java_home, defaults, self.cache_dir, cancel_token=cancel)
+            finally:
+                stop.set()
+                beat.join()
+            body = _pack_result(row)
+            for attempt in range(CONNECT_RETRIES):
+                try:
+                    self._request("POST", f"/jobs/{job['id']}/result?worker={urllib.parse.quote(self.id)}",
+                                  body=body, ctype="application/zip")
+                    break
+                except urllib.error.HTTPError:
+                    raise
+                except (urllib.error.URLError, OSError):
+                    time.sleep(self.poll_s)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+    def _heartbeat(self, job: dict, cancel: CancelToken, stop: threading.Event):
+        while not stop.wait(job["lease_s"] / 4.0):
+            try:
+                if self._request("POST", f"/jobs/{job['id']}/heartbeat", {"worker": self.id}).get("cancel"):
+                    cancel.cancel()
+            except (urllib.error.URLError, OSError):
+                pass
+
+
+def run_local(sources, defaults: dict | None, workers: int, java_home: str = "", lease_s: float = LEASE_S,
+              on_result=None, cache_dir: Path | None = None):
+    """Coordinator on a loopback port plus `workers` worker processes; the end-to-end test setup."""
+    token = secrets.token_hex(16)
+    # Workers given cache_dir record their timings in it already
+    coord = Coordinator(sources, defaults, host="127.0.0.1", port=0, token=token, lease_s=lease_s, on_result=on_result,
+                        cache_dir=cache_dir, record_timings=not cache_dir)
+    cmd = [sys.executable, str(Path(__file__).resolve()), "work", coord.url, "--poll-s", "0.5"]
+    if java_home:
+        cmd += ["--java-home", java_home]
+    if cache_dir:
+        cmd += ["--cache-dir", str(cache_dir)]
+    env = dict(os.environ, **{TOKEN_ENV: token})
+    procs = [subprocess.Popen(cmd, env=env) for _ in range(max(1, workers))]
+    try:
+        return coord.run()
+    finally:
+        for proc in procs:
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def build_parser():
+    ap = argparse.ArgumentParser(description="Grade a batch of submission ZIPs on several machines")
+    sub = ap.add_subparsers(dest="mode", required=True)
+
+    def batch_options(p):
+        p.add_argument("zips", nargs="+", help="Submission ZIPs")
+        add_grading_options(p)
+        p.add_argument("--lease-s", type=float, default=LEASE_S, help="Re-queue a job after this long without a heartbeat")
+        p.add_argument("--format", choices=["jsonl", "csv"], default="jsonl", help="Result format")
+        p.add_argument("-o", "--output", default="-", help="Result file (default: stdout)")
+        p.add_argument("-q", "--quiet", action="store_true", help="No progress lines on stderr")
+
+    serve = sub.add_parser("serve", help="Run the coordinator")
+    batch_options(serve)
+    serve.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: loopback only)")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port (default: {DEFAULT_PORT})")
+    serve.add_argument("--token", default=os.environ.get(TOKEN_ENV, ""), help=f"Shared secret (default: ${TOKEN_ENV})")
+
+    local = sub.add_parser("local", help="Coordinator and worker processes on this machine")
+    batch_options(local)
+    local.add_argument("--workers", type=int, default=2, help="Worker processes (default: 2)")
+    local.add_argument("--java-home", default=os.environ.get("JAVA_HOME", ""), help="JDK folder for the workers")
+    local.add_argument("--cache-dir", default=None, help="Cache folder shared by the workers")
+
+    work = sub.add_parser("work", help="Run a worker")
+    work.add_argument("url", help="Coordinator URL, e.g. http://host:8765")
+    work.add_argument("--token", default=os.environ.get(TOKEN_ENV, ""), help=f"Shared secret (default: ${TOKEN_ENV})")
+    work.add_argument("--java-home", default=os.environ.get("JAVA_HOME", ""), help="JDK folder (default: $JAVA_HOME, then PATH)")
+    work.add_argument("--cache-dir", default=None, help="Cache folder kept between jobs (default: autograde_worker_cache in the temp folder)")
+    work.add_argument("--test-workers", type=int, default=None, help="Test cases of one question run concurrently")
+    work.add_argument("--poll-s", type=float, default=POLL_S, help="Wait between lease attempts when the queue is empty")
+    return ap
+
+
+def main(argv=None) -> int:
+    ap = build_parser()
+    args = ap.parse_args(argv)
+
+    if args.mode in ("work", "local") and not check_java(args.java_home):
+        # A worker without a JDK would report every reference run as failed
+        return EXIT_NO_JAVA
+    if args.mode == "work":
+        graded = Worker(args.url, args.java_home, args.token, args.cache_dir, args.test_workers, poll_s=args.poll_s).run()
+        print(f"[worker] graded {graded} submission(s)", file=sys.stderr)
+        return EXIT_OK
+
+    missing = [z for z in args.zips if not Path(z).is_file()]
+    if missing:
+        ap.print_usage(sys.stderr)
+        print(f"error: not found: {', '.join(missing)}", file=sys.stderr)
+        return EXIT_USAGE
+
+    def on_result(src, row):
+        if not args.quiet:
+            status = f"ERROR {row['Error']}" if row["Error"] else f"{row['Score']} / {row['Max']}"
+            print(f"[done] {src}: {status}", file=sys.stderr, flush=True)
+
+    defaults = defaults_from_args(args)
+    if args.mode == "serve":
+        if args.host not in ("127.0.0.1", "localhost", "::1") and not args.token:
+            print(f"error: set --token or ${TOKEN_ENV} when listening on {args.host}", file=sys.stderr)
+            return EXIT_USAGE
+        coord = Coordinator(args.zips, defaults, args.host, args.port, args.token, args.lease_s, on_result=on_result)
+        if not args.quiet:
+            print(f"[coordinator] {len(coord.jobs)} job(s) at {coord.url}", file=sys.stderr, flush=True)
+        rows = coord.run()
+    else:
+        rows = run_local(args.zips, defaults, args.workers, args.java_home, args.lease_s, on_result=on_result,
+                         cache_dir=args.cache_dir)
+
+    records = [result_record(r) for r in rows]
+    if args.output == "-":
+        write_results(records, args.format, sys.stdout)
+    else:
+        with open(args.output, "w", newline="", encoding="utf-8") as f:
+            write_results(records, args.format, f)
+    return EXIT_SUBMISSION_ERROR if any(r["Error"] for r in rows) else EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,28 @@
 #!/usr/bin/env python3
-import os, subprocess, shutil, csv, re, sys
-from pathlib import Path
+import os, subprocess, shutil, csv, re, sys, hashlib, tempfile, zipfile, json, threading, codecs, locale, functools, time, signal
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from grade_jvm import (get_warm_jvm, get_compile_service, decode_output, encode_input, stop_warm_jvms, release_warm_jvms,
+                       COMPILE_TIMEOUT_S)
+from grade_store import (ResultStore, ResultBundle, BatchJournal, test_result_key, question_timing_keys, BUNDLE_FILE_NAME,
+                         RESULT_TEXT_FIELDS)
+
+CACHE_DIR_NAME = "_autograde_cache"
+
+# Guards for untrusted submission ZIPs
+ZIP_MAX_MEMBERS = 5000
+ZIP_MAX_MEMBER_BYTES = 16 * 1024 * 1024
+ZIP_MAX_TOTAL_BYTES = 64 * 1024 * 1024
+
+# Per-stream cap on captured program output unless defaults["MaxOutputBytes"] says otherwise
+DEFAULT_MAX_OUTPUT_BYTES = 8 * 1024 * 1024
 
 def parse_testcase_text(text: str):
     """
@@ -50,31 +72,170 @@ def to_int(val, default=None):
     except Exception:
         return default
 
+def testcase_problems(tdata: dict):
+    """Header values that parse_testcase_text accepted but to_bool/to_float/to_int would silently replace."""
+    problems = []
+    for key in ("REMOVE_SPACES", "CASE_SENSITIVE"):
+        val = tdata.get(key)
+        if val and to_bool(val) is None:
+            problems.append(f"{key}: expected YES/NO, got {val!r}")
+    mark = tdata.get("MARK")
+    if mark:
+        value = to_float(mark, default=None)
+        if value is None:
+            problems.append(f"MARK: not a number: {mark!r}")
+        elif value < 0:
+            problems.append(f"MARK: must not be negative: {mark!r}")
+    timeout = tdata.get("TIMEOUT_MS")
+    if timeout:
+        value = to_int(timeout)
+        if value is None:
+            problems.append(f"TIMEOUT_MS: not an integer: {timeout!r}")
+        elif value <= 0:
+            problems.append(f"TIMEOUT_MS: must be positive: {timeout!r}")
+    return problems
+
+_WHITESPACE_RUN = re.compile(r"\s+")
+
+def _strip_trailing_per_line(t: str) -> str:
+    return "\n".join([ln.rstrip() for ln in t.splitlines()])
+
+class OutputNormalizer:
+    """
+    Comparison rules compiled into a fixed list of string passes.
+    Normalized expected outputs are cached, since every student is compared against the same ones.
+    """
+    EXPECTED_CACHE_LIMIT = 256
+
+    def __init__(self, remove_spaces=None, case_sensitive=None, whitespace_norm=False, strict=False, ignore_trailing_per_line=False):
+        steps = []
+        if not strict:
+            if whitespace_norm:
+                steps.append(lambda t: _WHITESPACE_RUN.sub(" ", t).strip())
+            if remove_spaces is True:
+                steps.append(lambda t: _WHITESPACE_RUN.sub("", t))
+            if ignore_trailing_per_line:
+                steps.append(_strip_trailing_per_line)
+            if case_sensitive is False:  # NOT case sensitive
+                steps.append(str.casefold)
+        self.steps = tuple(steps)
+        self._expected = {}
+        self._lock = threading.Lock()
+
+    def normalize(self, text: str) -> str:
+        t = text or ""
+        for step in self.steps:
+            t = step(t)
+        return t
+
+    def normalize_expected(self, expected: str) -> str:
+        expected = expected or ""
+        found = self._expected.get(expected)
+        if found is None:
+            found = self.normalize(expected)
+            with self._lock:
+                if len(self._expected) >= self.EXPECTED_CACHE_LIMIT:
+                    self._expected.pop(next(iter(self._expected)))
+                self._expected[expected] = found
+        return found
+
+    def matches(self, expected: str, got: str) -> bool:
+        expected, got = expected or "", got or ""
+        # Identical raw text normalizes identically
+        if expected == got:
+            return True
+        return self.normalize_expected(expected) == self.normalize(got)
+
+@functools.lru_cache(maxsize=64)
+def get_normalizer(remove_spaces=None, case_sensitive=None, whitespace_norm=False, strict=False, ignore_trailing_per_line=False) -> OutputNormalizer:
+    return OutputNormalizer(remove_spaces, case_sensitive, whitespace_norm, strict, ignore_trailing_per_line)
+
+def normalize_output(text: str, remove_spaces=None, case_sensitive=None, whitespace_norm=False, strict=False, ignore_trailing_per_line=False):
+    return get_normalizer(remove_spaces, case_sensitive, whitespace_norm, strict, ignore_trailing_per_line).normalize(text)
+
 def apply_compare_rules(expected: str, got: str, remove_spaces=None, case_sensitive=None, whitespace_norm=False, strict=False, ignore_trailing_per_line=False):
-    e = expected or ""
-    g = got or ""
+    return get_normalizer(remove_spaces, case_sensitive, whitespace_norm, strict, ignore_trailing_per_line).matches(expected, got)
 
-    if strict:
-        # No normalization at all
-        pass
-    else:
-        if whitespace_norm:
-            e = re.sub(r"\s+", " ", e).strip()
-            g = re.sub(r"\s+", " ", g).strip()
+# Line boundaries recognised by str.splitlines()
+_LINE_BREAKS = frozenset("\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029")
 
-        if remove_spaces is True:
-            e = re.sub(r"\s+", "", e)
-            g = re.sub(r"\s+", "", g)
+class StreamingComparator:
+    """
+    Incremental form of apply_compare_rules for early-fail grading.
+    feed() takes student output as it arrives and returns True once the normalized output
+    can no longer equal the normalized expected output (a mismatch or more text than expected).
+    Characters whose fate depends on what follows (trailing spaces, a final newline) are held
+    back, so a divergence reported here always means apply_compare_rules returns False.
+    """
 
-        if ignore_trailing_per_line:
-            e = "\n".join([ln.rstrip() for ln in e.splitlines()])
-            g = "\n".join([ln.rstrip() for ln in g.splitlines()])
+    def __init__(self, expected: str, remove_spaces=None, case_sensitive=None, whitespace_norm=False, strict=False, ignore_trailing_per_line=False):
+        self.target = get_normalizer(remove_spaces, case_sensitive, whitespace_norm, strict, ignore_trailing_per_line).normalize_expected(expected)
+        if strict:
+            self.mode = "raw"
+        elif remove_spaces is True:
+            self.mode = "nospace"
+        elif whitespace_norm:
+            self.mode = "collapse"
+        elif ignore_trailing_per_line:
+            self.mode = "trail"
+        else:
+            self.mode = "raw"
+        self.fold = (not strict) and case_sensitive is False
+        self.pos = 0
+        self.diverged = False
+        self.pending_space = ""
+        self.pending_breaks = 0
+        self.last_cr = False
 
-        if case_sensitive is False:  # NOT case sensitive
-            e = e.casefold()
-            g = g.casefold()
+    def _commit(self, text: str):
+        end = self.pos + len(text)
+        if end > len(self.target) or self.target[self.pos:end] != text:
+            self.diverged = True
+        self.pos = end
 
-    return e == g
+    def feed(self, chunk: str) -> bool:
+        if self.diverged or not chunk:
+            return self.diverged
+        if self.mode == "raw":
+            self._commit(chunk.casefold() if self.fold else chunk)
+            return self.diverged
+        out = []
+        for ch in chunk:
+            if self.mode == "nospace":
+                if not ch.isspace():
+                    out.append(ch)
+            elif self.mode == "collapse":
+                if ch.isspace():
+                    self.pending_space = " " if (self.pos or out) else ""
+                else:
+                    out.append(self.pending_space + ch)
+                    self.pending_space = ""
+            else:
+                if ch in _LINE_BREAKS:
+                    if not (ch == "\n" and self.last_cr):
+                        self.pending_breaks += 1
+                    self.pending_space = ""
+                elif ch.isspace():
+                    self.pending_space += ch
+                else:
+                    out.append("\n" * self.pending_breaks + self.pending_space + ch)
+                    self.pending_breaks = 0
+                    self.pending_space = ""
+                self.last_cr = (ch == "\r")
+        if out:
+            text = "".join(out)
+            self._commit(text.casefold() if self.fold else text)
+        return self.diverged
+
+    def finish(self) -> bool:
+        """True when everything fed so far equals the expected output under the rules."""
+        if self.diverged:
+            return False
+        tail = ""
+        if self.mode == "trail" and self.pending_breaks:
+            # splitlines() drops one final line break unless blank-looking text follows it
+            tail = "\n" * (self.pending_breaks - (0 if self.pending_space else 1))
+        return self.target[self.pos:] == tail
 
 def find_java_tools(java_home=None):
     javac = "javac"
@@ -85,31 +246,675 @@ def find_java_tools(java_home=None):
         java  = str(bin_dir / ("java.exe"  if os.name=="nt" else "java"))
     return javac, java
 
+@functools.lru_cache(maxsize=None)
+def java_identity(java: str) -> str:
+    """Resolved path and version of a java binary, "" when there is none; cached outputs are keyed by it."""
+    found = shutil.which(java)
+    if found is None:
+        return ""
+    real = os.path.realpath(found)
+    version = ""
+    try:
+        for line in (Path(real).parent.parent/"release").read_text(encoding="utf-8", errors="ignore").splitlines():
+            if line.startswith("JAVA_VERSION="):
+                version = line.split("=", 1)[1].strip().strip('"')
+    except OSError:
+        pass
+    if not version:
+        try:
+            out = subprocess.run([real, "-version"], capture_output=True, text=True, errors="replace", timeout=30)
+            version = (out.stderr or out.stdout).strip().splitlines()[0] if (out.stderr or out.stdout).strip() else ""
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+    return f"{real}|{version}"
+
 def detect_main_class(src_dir: Path):
-    main_candidate = src_dir/"Main.java"
-    if main_candidate.exists():
-        return "Main"
-    for p in src_dir.rglob("*.java"):
+    return scan_sources(src_dir).main_class
+
+class _StdoutWatcher:
+    """Decodes stdout chunks the same way decode_output does and hands the text to a callback."""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors="replace")
+        self.held_cr = False
+
+    def feed(self, chunk: bytes) -> bool:
+        text = self.decoder.decode(chunk)
+        if self.held_cr:
+            text = "\r" + text
+        # A trailing CR may be the first half of CRLF
+        self.held_cr = text.endswith("\r")
+        if self.held_cr:
+            text = text[:-1]
+        return bool(self.callback(text.replace("\r\n", "\n").replace("\r", "\n")))
+
+# Per-test limits of student programs; None in defaults means the value here, 0 turns a limit off.
+# Memory and stack go to the JVM as -Xmx/-Xss (a JVM reserves far more address space than it uses,
+# so RLIMIT_AS would break it); the others are Linux rlimits. MaxProcesses is RLIMIT_NPROC, which
+# counts every process and thread of the user running the grader, not only this test's.
+DEFAULT_LIMITS = {"MemoryMb": 512, "StackKb": 0, "CpuSeconds": 0, "MaxProcesses": 0, "FileSizeMb": 64}
+LIMIT_KEYS = tuple(DEFAULT_LIMITS)
+
+def resource_limits(defaults: dict) -> dict:
+    limits = {}
+    for key in LIMIT_KEYS:
+        value = defaults.get(key)
+        limits[key] = int(DEFAULT_LIMITS[key] if value is None else value) or None
+    return limits
+
+def jvm_limit_flags(limits: dict) -> list:
+    flags = []
+    if limits.get("MemoryMb"):
+        flags.append(f"-Xmx{limits['MemoryMb']}m")
+    if limits.get("StackKb"):
+        flags.append(f"-Xss{limits['StackKb']}k")
+    return flags
+
+def _apply_rlimits(pid: int, limits: dict):
+    """
+    Set the rlimits of a started child with prlimit (Linux); unlike preexec_fn this is safe while
+    other threads run tests. The child is a few instructions into the JVM launcher by then.
+    """
+    if resource is None or not hasattr(resource, "prlimit"):
+        return
+    wanted = [(resource.RLIMIT_CORE, 0, 0)]
+    if limits.get("CpuSeconds"):
+        # SIGXCPU at the soft limit; the hard limit one second later is a SIGKILL
+        wanted.append((resource.RLIMIT_CPU, limits["CpuSeconds"], limits["CpuSeconds"] + 1))
+    if limits.get("MaxProcesses"):
+        wanted.append((resource.RLIMIT_NPROC, limits["MaxProcesses"], limits["MaxProcesses"]))
+    if limits.get("FileSizeMb"):
+        wanted.append((resource.RLIMIT_FSIZE, limits["FileSizeMb"] << 20, limits["FileSizeMb"] << 20))
+    for res, soft, hard in wanted:
         try:
-            txt = p.read_text(encoding="utf-8", errors="ignore")
-            if re.search(r"public\s+static\s+void\s+main\s*\(", txt):
-                return p.stem
-        except Exception:
+            resource.prlimit(pid, res, (soft, hard))
+        except (OSError, ValueError):
             pass
-    return "Main"
 
-def run_cmd(cmd, input_text=None, cwd=None, timeout_ms=None):
+# Which limit a run hit, from how it ended; the first match wins
+_LIMIT_MARKERS = (
+    ("Threads", ("unable to create native thread", "unable to create new native thread")),
+    ("Memory", ("java.lang.OutOfMemoryError",)),
+    ("FileSize", ("File too large",)),
+)
+
+def limit_exceeded(res: dict, limits: dict) -> str:
+    """Memory, Cpu, Threads or FileSize when a finished run hit that limit, else ""."""
+    rc = res["ExitCode"]
+    if limits.get("CpuSeconds") and hasattr(signal, "SIGXCPU") and rc in (-signal.SIGXCPU, -signal.SIGKILL):
+        return "Cpu"
+    if limits.get("FileSizeMb") and hasattr(signal, "SIGXFSZ") and rc == -signal.SIGXFSZ:
+        return "FileSize"
+    stderr = res["Stderr"]
+    for name, markers in _LIMIT_MARKERS:
+        if any(m in stderr for m in markers):
+            return name
+    return ""
+
+class _ProcessGroup:
+    """A child and everything it starts: on POSIX each run gets its own session, killed as a whole."""
+
+    def __init__(self, proc):
+        self.proc = proc
+
+    def kill(self):
+        if os.name == "posix":
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+                return
+            except OSError:
+                pass
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+
+    def kill_stragglers(self):
+        """After the child exited: whatever it left running in its session."""
+        if os.name == "posix":
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+def _killed_result(rc, out, err, status):
+    marker = {"Timeout": "[TIMEOUT]", "OutputLimitExceeded": "[OUTPUT LIMIT EXCEEDED]", "EarlyMismatch": "[STOPPED: OUTPUT MISMATCH]",
+              "Cancelled": "[CANCELLED]"}[status]
+    return {"ExitCode": rc, "Stdout": out, "Stderr": err + "\n" + marker, "Timeout": status == "Timeout", "Status": status}
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000.0, 1)
+
+class _Reaper:
+    """
+    Waits for a child and keeps its resource usage. On POSIX the child is reaped with os.wait4,
+    which reports CPU time and peak RSS for that child alone even while other tests run concurrently;
+    elsewhere only wall time is known.
+    """
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.started = time.perf_counter()
+        self.ended = None
+        self.rusage = None
+        self.done = threading.Event()
+        if hasattr(os, "wait4"):
+            threading.Thread(target=self._reap, daemon=True).start()
+
+    def _reap(self):
+        try:
+            _, status, self.rusage = os.wait4(self.proc.pid, 0)
+            self.proc.returncode = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            # Popen reaped it first (kill() polls); the exit code is already set
+            self.proc.wait()
+        self.ended = time.perf_counter()
+        self.done.set()
+
+    def wait(self, timeout) -> bool:
+        if not hasattr(os, "wait4"):
+            try:
+                self.proc.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                return False
+            self.ended = time.perf_counter()
+            return True
+        return self.done.wait(timeout)
+
+    def usage(self) -> dict:
+        ru = self.rusage
+        return {
+            "WallMs": _ms((self.ended or time.perf_counter()) - self.started),
+            "CpuMs": _ms(ru.ru_utime + ru.ru_stime) if ru else None,
+            # ru_maxrss is KiB on Linux and bytes on macOS
+            "PeakRssKb": (ru.ru_maxrss // 1024 if sys.platform == "darwin" else ru.ru_maxrss) if ru else None,
+        }
+
+class CancelToken:
+    """
+    Cancellation shared by a grading job and the processes it starts. cancel() kills every
+    registered process and the warm runners of this process; later run_process calls return
+    at once. A token with a flag_path survives pickling, so batch worker processes watch the
+    same flag file and cancel themselves when it appears.
+    """
+
+    POLL_S = 0.2
+
+    def __init__(self, flag_path=None):
+        self.flag_path = str(flag_path) if flag_path else None
+        self._init_local()
+
+    def _init_local(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._procs = set()
+        self._callbacks = []
+
+    def __getstate__(self):
+        return {"flag_path": self.flag_path}
+
+    def __setstate__(self, state):
+        self.flag_path = state["flag_path"]
+        self._init_local()
+
+    @classmethod
+    def with_flag_file(cls):
+        fd, path = tempfile.mkstemp(prefix="autograde_cancel_")
+        os.close(fd)
+        os.unlink(path)
+        return cls(path)
+
+    def is_cancelled(self) -> bool:
+        if self._event.is_set():
+            return True
+        if self.flag_path and os.path.exists(self.flag_path):
+            self.cancel()
+            return True
+        return False
+
+    def cancel(self):
+        with self._lock:
+            first = not self._event.is_set()
+            self._event.set()
+            procs = list(self._procs)
+            callbacks = list(self._callbacks) if first else []
+        if first and self.flag_path:
+            try:
+                Path(self.flag_path).touch()
+            except OSError:
+                pass
+        for proc in procs:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        if first:
+            stop_warm_jvms()
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        """callback() runs once, in the thread that cancels; at once when already cancelled."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def register(self, proc):
+        with self._lock:
+            self._procs.add(proc)
+            cancelled = self._event.is_set()
+        if cancelled:
+            proc.kill()
+
+    def unregister(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def discard(self):
+        """Remove the flag file once the job is over."""
+        if self.flag_path:
+            try:
+                os.unlink(self.flag_path)
+            except OSError:
+                pass
+
+def _cancelled_result():
+    res = _killed_result(130, "", "", "Cancelled")
+    res.update(WallMs=0.0, CpuMs=None, PeakRssKb=None)
+    return res
+
+def run_process(cmd, input_text=None, cwd=None, timeout_ms=None, max_output_bytes=None, on_stdout=None, cancel=None,
+                limits=None):
+    """
+    Run cmd with both output streams read in chunks as they arrive.
+    The process is killed as soon as a stream exceeds max_output_bytes, so memory stays bounded.
+    on_stdout(text) receives decoded stdout incrementally; returning True kills the process.
+    limits (see resource_limits) become rlimits of the child. Every kill takes the child's whole
+    process group, and whatever it left running is killed once it exits.
+    Returns {"ExitCode", "Stdout", "Stderr", "Timeout", "Status", "WallMs", "CpuMs", "PeakRssKb"};
+    Status is OK, Timeout, OutputLimitExceeded, EarlyMismatch or Cancelled (cancel is a CancelToken);
+    a run that hit one of the limits is told apart afterwards by limit_exceeded.
+    CpuMs and PeakRssKb are None where the platform cannot report them.
+    """
+    if cancel is not None and cancel.is_cancelled():
+        return _cancelled_result()
     try:
-        res = subprocess.run(cmd, input=input_text, capture_output=True, text=True, cwd=cwd, timeout=None if timeout_ms is None else timeout_ms/1000.0)
-        return res.returncode, res.stdout, res.stderr, False  # not timeout
-    except subprocess.TimeoutExpired as e:
-        out = e.stdout or ""
-        err = (e.stderr or "") + "\n[TIMEOUT]"
-        return 124, out, err, True
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd,
+                                start_new_session=(os.name == "posix"))
     except FileNotFoundError as e:
-        return 127, "", str(e), False
+        return {"ExitCode": 127, "Stdout": "", "Stderr": str(e), "Timeout": False, "Status": "OK",
+                "WallMs": 0.0, "CpuMs": None, "PeakRssKb": None}
+    if limits:
+        _apply_rlimits(proc.pid, limits)
+    group = _ProcessGroup(proc)
+    if cancel is not None:
+        cancel.register(group)
+
+    over_limit = threading.Event()
+    stopped = threading.Event()
+    bufs = [bytearray(), bytearray()]
+    watcher = _StdoutWatcher(on_stdout) if on_stdout else None
+
+    def feed():
+        try:
+            if input_text:
+                proc.stdin.write(encode_input(input_text))
+        except OSError:
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    def pump(stream, buf):
+        try:
+            for chunk in iter(lambda: stream.read1(1 << 16), b""):
+                if max_output_bytes and len(buf) + len(chunk) > max_output_bytes:
+                    buf += chunk[:max(0, max_output_bytes - len(buf))]
+                    over_limit.set()
+                    group.kill()
+                    break
+                buf += chunk
+                if watcher is not None and buf is bufs[0] and watcher.feed(chunk):
+                    stopped.set()
+                    group.kill()
+                    break
+        except (OSError, ValueError):
+            pass
+
+    threads = [threading.Thread(target=feed, daemon=True),
+               threading.Thread(target=pump, args=(proc.stdout, bufs[0]), daemon=True),
+               threading.Thread(target=pump, args=(proc.stderr, bufs[1]), daemon=True)]
+    for t in threads:
+        t.start()
+    timed_out = cancelled = False
+    reaper = _Reaper(proc)
+    deadline = None if timeout_ms is None else time.perf_counter() + timeout_ms/1000.0
+    while True:
+        remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+        # With a token, wake up now and then to look at the flag file of a batch
+        step = remaining if cancel is None else CancelToken.POLL_S if remaining is None else min(remaining, CancelToken.POLL_S)
+        if reaper.wait(step):
+            break
+        cancelled = cancel is not None and cancel.is_cancelled()
+        if cancelled or step == remaining:
+            timed_out = not (over_limit.is_set() or stopped.is_set() or cancelled)
+            group.kill()
+            reaper.wait(None)
+            break
+    # Background children would also keep the pipes open
+    group.kill_stragglers()
+    if cancel is not None:
+        cancel.unregister(group)
+        # cancel() may have killed it from another thread while we waited
+        cancelled = cancelled or cancel.is_cancelled()
+    for t in threads:
+        t.join(5)
+    for stream in (proc.stdout, proc.stderr):
+        try:
+            stream.close()
+        except OSError:
+            pass
+
+    out, err = decode_output(bytes(bufs[0])), decode_output(bytes(bufs[1]))
+    if over_limit.is_set():
+        res = _killed_result(125, out, err, "OutputLimitExceeded")
+    elif stopped.is_set():
+        res = _killed_result(126, out, err, "EarlyMismatch")
+    elif cancelled:
+        res = _killed_result(130, out, err, "Cancelled")
+    elif timed_out:
+        res = _killed_result(124, out, err, "Timeout")
+    else:
+        res = {"ExitCode": proc.returncode, "Stdout": out, "Stderr": err, "Timeout": False, "Status": "OK"}
+    res.update(reaper.usage())
+    return res
+
+def run_cmd(cmd, input_text=None, cwd=None, timeout_ms=None):
+    res = run_process(cmd, input_text=input_text, cwd=cwd, timeout_ms=timeout_ms)
+    return res["ExitCode"], res["Stdout"], res["Stderr"], res["Timeout"]
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def default_cache_dir(root: Path) -> Path:
+    return Path(root)/CACHE_DIR_NAME
+
+def _expected_cache_path(cache_dir: Path, jar_hash: str, tc_hash: str, timeout_ms, java_id: str):
+    key = hashlib.sha256(f"{jar_hash}|{tc_hash}|{timeout_ms}|{java_id}".encode("utf-8")).hexdigest()
+    return Path(cache_dir)/"expected"/f"{key}.txt"
+
+def load_expected_output(cache_dir: Path, jar_hash: str, tc_hash: str, timeout_ms, java_id: str):
+    p = _expected_cache_path(cache_dir, jar_hash, tc_hash, timeout_ms, java_id)
+    try:
+        with open(p, "r", encoding="utf-8", newline="") as f:
+            return f.read()
+    except (FileNotFoundError, UnicodeDecodeError):
+        return None
+
+def store_expected_output(cache_dir: Path, jar_hash: str, tc_hash: str, timeout_ms, java_id: str, text: str):
+    p = _expected_cache_path(cache_dir, jar_hash, tc_hash, timeout_ms, java_id)
+    try:
+        p.parent.mkdir(parents=True, exist_ok=True)
+        # Write-then-rename so concurrent graders never read a half-written entry
+        tmp = p.with_name(f"{p.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "w", encoding="utf-8", errors="ignore", newline="") as f:
+            f.write(text)
+        os.replace(tmp, p)
+    except OSError:
+        pass
+
+# What the java launcher prints when it never got to run the jar
+_LAUNCHER_ERRORS = ("Error: Unable to access jarfile", "Error: Invalid or corrupt jarfile", "no main manifest attribute",
+                    "Error: Could not find or load main class", "Error occurred during initialization of VM",
+                    "Error: A JNI error has occurred", "UnsupportedClassVersionError")
+
+def reference_failure(ref: dict) -> str:
+    """Why a run of run/Q*.jar cannot be the expected output, "" when it can."""
+    if ref["Status"] != "OK":
+        reason = ref["Status"]
+    elif ref["ExitCode"] != 0:
+        reason = f"exit code {ref['ExitCode']}"
+    elif any(m in ref["Stderr"] for m in _LAUNCHER_ERRORS):
+        reason = "launcher error"
+    else:
+        return ""
+    return f"[REFERENCE FAILED: {reason}]\n{ref['Stderr']}".rstrip()
+
+# Defaults that change a verdict; execution switches such as WarmJvm do not belong here
+RESULT_DEFAULT_KEYS = ("Strict", "IgnoreTrailingPerLine", "RemoveSpaces", "CaseSensitive", "TimeoutMs", "MaxOutputBytes")
+
+def source_set_hash(src_dir: Path) -> str:
+    """Hash of Given/src that ignores line endings and BOMs, so re-saved copies still match."""
+    return scan_sources(src_dir).digest
+
+_PACKAGE_RE = re.compile(r"^\s*package\s+([\w.]+)\s*;", re.M)
+_MAIN_RE = re.compile(r"public\s+static\s+void\s+main\s*\(")
+_BLOCK_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+
+@dataclass(frozen=True)
+class SourceFile:
+    """One .java file of Given/src; sha is over the content with BOM and line endings normalized."""
+    rel: str
+    path: Path | None
+    size: int
+    sha: str
+    package: str
+    has_main: bool
+
+    @property
+    def class_name(self) -> str:
+        stem = PurePosixPath(self.rel).stem
+        return f"{self.package}.{stem}" if self.package else stem
+
+@dataclass(frozen=True)
+class SourceManifest:
+    """
+    Everything grading needs from Given/src, read in one pass: the files in path order with their
+    packages, the fully qualified classes that declare main, and the source_set_hash digest.
+    """
+    files: tuple
+    digest: str
+
+    @property
+    def java_paths(self) -> list:
+        return [str(f.path) for f in self.files if f.path is not None]
+
+    @property
+    def main_candidates(self) -> tuple:
+        return tuple(f.class_name for f in self.files if f.has_main)
+
+    @property
+    def main_class(self) -> str:
+        """src/Main.java when there is one, else the first class declaring main (Main preferred)."""
+        for f in self.files:
+            if f.rel == "Main.java":
+                return f.class_name
+        mains = [f for f in self.files if f.has_main]
+        mains.sort(key=lambda f: PurePosixPath(f.rel).stem != "Main")
+        return mains[0].class_name if mains else "Main"
+
+def _source_file(rel: str, data: bytes, path: Path | None) -> SourceFile:
+    size = len(data)
+    if data.startswith(b"\xef\xbb\xbf"):
+        data = data[3:]
+    data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    text = _BLOCK_COMMENT_RE.sub("", data.decode("utf-8", errors="ignore"))
+    package = _PACKAGE_RE.search(text)
+    return SourceFile(rel, path, size, hashlib.sha256(data).hexdigest(), package.group(1) if package else "",
+                      _MAIN_RE.search(text) is not None)
+
+def _manifest(entries) -> SourceManifest:
+    h = hashlib.sha256()
+    for f in entries:
+        h.update(f.rel.encode("utf-8") + b"\0")
+        h.update(bytes.fromhex(f.sha))
+    return SourceManifest(tuple(entries), h.hexdigest())
+
+def source_manifest(files, root: Path | None = None) -> SourceManifest:
+    """Manifest of (relative posix path, bytes) pairs given in path order; root locates them on disk."""
+    return _manifest([_source_file(rel, data, root/rel if root is not None else None) for rel, data in files])
+
+def scan_sources(src_dir: Path) -> SourceManifest:
+    """The one walk over Given/src: compile, main class detection and result caching all read its manifest."""
+    paths = sorted(p for p in src_dir.rglob("*.java") if p.is_file()) if src_dir.exists() else []
+    return source_manifest(((p.relative_to(src_dir).as_posix(), p.read_bytes()) for p in paths), src_dir)
+
+def submission_hash(src_hash: str, jar_hash: str | None) -> str:
+    return hashlib.sha256(f"{src_hash}|{jar_hash or ''}".encode("utf-8")).hexdigest()
+
+def compile_key(sub_hash: str, java_id: str) -> str:
+    """Store key of a compile: the same sources may compile differently on another JDK."""
+    return hashlib.sha256(f"{sub_hash}|{java_id}".encode("utf-8")).hexdigest()
+
+def max_output_bytes(defaults: dict) -> int:
+    """Per-stream output cap of a run: DEFAULT_MAX_OUTPUT_BYTES unless set; None or 0 means no cap (0)."""
+    return defaults.get("MaxOutputBytes", DEFAULT_MAX_OUTPUT_BYTES) or 0
+
+def result_rules(defaults: dict, java_id: str = "") -> str:
+    """Everything besides the submission and the test a stored verdict depends on; java_id is java_identity()."""
+    rules = {k: defaults.get(k) for k in RESULT_DEFAULT_KEYS}
+    # The cap a run actually gets, so a missing key and an explicit default share results
+    rules["MaxOutputBytes"] = max_output_bytes(defaults)
+    rules["Limits"] = resource_limits(defaults)
+    rules["Java"] = java_id
+    return json.dumps(rules, sort_keys=True)
+
+def _storable_result(row: dict) -> bool:
+    """
+    Whether a verdict is the same on every rerun: not timeouts, cancels or failed reference runs,
+    nor CPU and process limits, which depend on machine load and the other graders. Early-fail
+    kills are not either: EarlyFail is no result rule, and without it the run would have finished.
+    """
+    if row["Status"] == "ResourceLimitExceeded":
+        return row["LimitExceeded"] in ("Memory", "FileSize")
+    return row["Status"] in ("OK", "RuntimeError", "OutputLimitExceeded") and not row["Timeout"]
+
+@dataclass(frozen=True)
+class TestCase:
+    """One TestCases/*.txt with its headers resolved against the grading defaults. Shared, never mutated."""
+    name: str
+    sha: str
+    input_text: str
+    expected_output: str | None
+    remove_spaces: bool | None
+    case_sensitive: bool | None
+    mark: float
+    timeout_ms: int | None
+    compare_rules: dict
+    normalizer: OutputNormalizer
+    problems: tuple
+
+    @property
+    def stem(self) -> str:
+        return Path(self.name).stem
+
+@dataclass(frozen=True)
+class TestSuite:
+    key: str
+    cases: tuple
+
+    def __iter__(self):
+        return iter(self.cases)
+
+    def __len__(self):
+        return len(self.cases)
+
+# Parsed test cases are keyed on content, so the identical TestCases/ of every submission parse once per process
+TESTCASE_CACHE_LIMIT = 4096
+_testcase_stats = {}   # path -> (mtime_ns, size, sha)
+_testcase_texts = {}   # sha -> (text, tdata)
+_test_suites = {}      # (suite key, rules) -> TestSuite
+_testcase_lock = threading.Lock()
+
+def _cache_put(cache: dict, key, value):
+    with _testcase_lock:
+        if len(cache) >= TESTCASE_CACHE_LIMIT:
+            cache.pop(next(iter(cache)))
+        cache[key] = value
+
+def compile_testcase(name: str, text: str, defaults: dict | None = None, sha: str | None = None, tdata: dict | None = None) -> TestCase:
+    defaults = defaults or {}
+    if tdata is None:
+        tdata = parse_testcase_text(text)
+    remove_spaces = to_bool(tdata.get("REMOVE_SPACES"), default=defaults.get("RemoveSpaces"))
+    case_sensitive = to_bool(tdata.get("CASE_SENSITIVE"), default=defaults.get("CaseSensitive"))
+    compare_rules = dict(
+        remove_spaces=remove_spaces,
+        case_sensitive=case_sensitive,
+        whitespace_norm=(remove_spaces is None and case_sensitive is None and not defaults.get("Strict")),
+        strict=defaults.get("Strict", False),
+        ignore_trailing_per_line=defaults.get("IgnoreTrailingPerLine", False),
+    )
+    return TestCase(
+        name=name,
+        sha=sha or hashlib.sha256(text.encode("utf-8")).hexdigest(),
+        input_text=tdata.get("INPUT") if tdata.get("INPUT") is not None else text,
+        expected_output=tdata.get("OUTPUT"),
+        remove_spaces=remove_spaces,
+        case_sensitive=case_sensitive,
+        mark=to_float(tdata.get("MARK"), default=1.0),
+        timeout_ms=to_int(tdata.get("TIMEOUT_MS"), default=defaults.get("TimeoutMs")),
+        compare_rules=compare_rules,
+        normalizer=get_normalizer(**compare_rules),
+        problems=tuple(testcase_problems(tdata)),
+    )
+
+def _load_testcase_file(path: Path):
+    st = path.stat()
+    stamp = (st.st_mtime_ns, st.st_size)
+    known = _testcase_stats.get(str(path))
+    if known is not None and known[:2] == stamp:
+        parsed = _testcase_texts.get(known[2])
+        if parsed is not None:
+            return (known[2],) + parsed
+    data = path.read_bytes()
+    sha = hashlib.sha256(data).hexdigest()
+    parsed = _testcase_texts.get(sha)
+    if parsed is None:
+        text = data.decode("utf-8", errors="ignore")
+        parsed = (text, parse_testcase_text(text))
+        _cache_put(_testcase_texts, sha, parsed)
+    _cache_put(_testcase_stats, str(path), stamp + (sha,))
+    return (sha,) + parsed
+
+def suite_key(named_hashes) -> str:
+    """Identity of a TestCases/ folder from its (file name, sha256) pairs in name order."""
+    return hashlib.sha256("\n".join(f"{name}\0{sha}" for name, sha in named_hashes).encode("utf-8")).hexdigest()
+
+def load_test_suite(tcdir: Path, defaults: dict) -> TestSuite:
+    """
+    Compiled TestCases/ folder. Files are re-read only when their mtime or size changes,
+    and suites with the same file names, contents and defaults are built once.
+    """
+    files = sorted(tcdir.glob("*.txt")) if tcdir.exists() else []
+    entries = [(p.name,) + _load_testcase_file(p) for p in files]
+    key = suite_key((name, sha) for name, sha, _, _ in entries)
+    cache_key = (key, result_rules(defaults))
+    suite = _test_suites.get(cache_key)
+    if suite is None:
+        cases = []
+        for name, sha, text, tdata in entries:
+            cases.append(compile_testcase(name, text, defaults, sha=sha, tdata=tdata))
+        suite = TestSuite(key=key, cases=tuple(cases))
+        _cache_put(_test_suites, cache_key, suite)
+    return suite
 
-def grade_question(root: Path, qname: str, javac: str, java: str, out_dir: Path, defaults: dict):
+def _write_case_files(exp_path: Path, stu_path: Path, meta_path: Path, exp: str, got: str, meta: dict):
+    exp_path.write_text(exp, encoding="utf-8", errors="ignore")
+    stu_path.write_text(got, encoding="utf-8", errors="ignore")
+    meta_path.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+
+def grade_question(root: Path, qname: str, javac: str, java: str, out_dir: Path, defaults: dict, cache_dir: Path | None = None,
+                   store: ResultStore | None = None, bundle: ResultBundle | None = None, job: "GradingJob | None" = None):
     q_dir = root/qname
     given = q_dir/"Given"
     src   = given/"src"
@@ -117,140 +922,511 @@ def grade_question(root: Path, qname: str, javac: str, java: str, out_dir: Path,
     jar   = run/f"{qname}.jar"
     has_jar = jar.exists()
     tcdir = q_dir/"TestCases"
+    cache_dir = Path(cache_dir) if cache_dir else default_cache_dir(root)
 
     results = []
     summary = {"Question": qname, "Passed": 0, "Total": 0, "Percent": 0.0,
-               "Compiled": False, "MainClass": "Main", "Score": 0.0, "MaxScore": 0.0}
+               "Compiled": False, "MainClass": "Main", "Score": 0.0, "MaxScore": 0.0,
+               "Reused": False, "ReusedTests": 0, "ExecutedTests": 0,
+               "CompileMs": 0.0, "ReferenceMs": 0.0, "StudentMs": 0.0, "CompareMs": 0.0, "Cancelled": False,
+               "ReferenceErrors": 0, "SuiteKey": "", "TimingSample": None}
+    cancel = job.cancel_token if job is not None else None
 
     if not q_dir.exists():
         return results, summary, "Question folder does not exist."
 
-    classes_dir = out_dir/f"{qname}-classes"
-    if classes_dir.exists():
-        shutil.rmtree(classes_dir)
-    classes_dir.mkdir(parents=True, exist_ok=True)
-
-    java_files = [str(p) for p in src.rglob("*.java")] if src.exists() else []
-    compile_log = ""
-    compiled_ok = False
-    if java_files:
-        rc, out, err, _ = run_cmd([javac, "-d", str(classes_dir)] + java_files)
-        compiled_ok = (rc == 0)
-        compile_log = (out or "") + (("\n" + err) if err else "")
-    elif has_jar:
-        compile_log = "Skipped compilation: using existing run/*.jar"
-    else:
-        return results, summary, "No .java files in Given/src/ and no run/JAR found."
-
-    summary["Compiled"] = compiled_ok
-
-    main_class = detect_main_class(src)
-    summary["MainClass"] = main_class
-    student_from_jar = False
-    if compiled_ok:
-        student_cmd = [java, "-cp", str(classes_dir), main_class]
-    elif has_jar:
-        student_cmd = [java, "-jar", str(jar)]
-        student_from_jar = True
-    else:
-        return results, summary, "Compilation failed and no run/JAR available."
-
-    tcs = sorted(tcdir.glob("*.txt")) if tcdir.exists() else []
-    summary["Total"] = len(tcs)
-
-    for tc in tcs:
-        case_name = tc.stem
-        exp_path = out_dir/f"{qname}-{case_name}-expected.txt"
-        stu_path = out_dir/f"{qname}-{case_name}-student.txt"
-        meta_path = out_dir/f"{qname}-{case_name}-meta.json"
-
-        ttext = tc.read_text(encoding="utf-8", errors="ignore")
-        tdata = parse_testcase_text(ttext)
-        input_text = tdata.get("INPUT") if tdata.get("INPUT") is not None else ttext
-        explicit_output = tdata.get("OUTPUT")
-        remove_spaces = to_bool(tdata.get("REMOVE_SPACES"), default=defaults.get("RemoveSpaces"))
-        case_sensitive = to_bool(tdata.get("CASE_SENSITIVE"), default=defaults.get("CaseSensitive"))
-        mark = to_float(tdata.get("MARK"), default=1.0)
-        timeout_ms = to_int(tdata.get("TIMEOUT_MS"), default=defaults.get("TimeoutMs"))
-
-        # Expected: prioritize run/Q*.jar when available so prompts match exactly
-        expected_from_jar = jar.exists()
-        if expected_from_jar:
-            rc1, out1, err1, to1 = run_cmd([java, "-jar", str(jar)], input_text=input_text, timeout_ms=timeout_ms)
-            exp = out1
-        elif explicit_output is not None:
-            exp = explicit_output
+    own_store = store is None
+    if own_store:
+        store = ResultStore.for_cache_dir(cache_dir)
+    try:
+        tcs = load_test_suite(tcdir, defaults)
+        jar_hash = file_sha256(jar) if has_jar else None
+        sources = scan_sources(src)
+        sub_hash = submission_hash(sources.digest, jar_hash)
+        java_id = java_identity(java)
+        rules = result_rules(defaults, java_id)
+        tc_keys = {tc.name: test_result_key(sub_hash, tc.sha, rules) for tc in tcs}
+        stored = {name: store.get_test(key) for name, key in tc_keys.items()}
+        build_key = compile_key(sub_hash, java_id)
+        stored_compile = store.get_compile(build_key)
+
+        classes_dir = out_dir/f"{qname}-classes"
+        if classes_dir.exists():
+            shutil.rmtree(classes_dir)
+        classes_dir.mkdir(parents=True, exist_ok=True)
+
+        java_files = sources.java_paths
+        jvm_flags = jvm_limit_flags(resource_limits(defaults))
+        compiled_now = False
+        if stored_compile is not None and tcs and all(stored.values()):
+            # Every test result is already known for this exact submission: skip compile and run
+            compiled_ok = stored_compile["Compiled"]
+            main_class = stored_compile["MainClass"]
+            compile_log = stored_compile["CompileLog"]
+            student_cmd = None
+            student_from_jar = not compiled_ok
         else:
-            exp = ""
-        exp_path.write_text(exp, encoding="utf-8", errors="ignore")
-
-        # Student
-        rc2, out2, err2, to2 = run_cmd(student_cmd, input_text=input_text, timeout_ms=timeout_ms)
-        stu_path.write_text(out2, encoding="utf-8", errors="ignore")
-
-        empty_out = (out2.strip() == "")
-        runtime_error = (rc2 != 0) or (err2.strip() != "")
-
-        passed = apply_compare_rules(
-            exp, out2,
-            remove_spaces=remove_spaces,
-            case_sensitive=case_sensitive,
-            whitespace_norm=(remove_spaces is None and case_sensitive is None and not defaults.get("Strict")),
-            strict=defaults.get("Strict", False),
-            ignore_trailing_per_line=defaults.get("IgnoreTrailingPerLine", False),
-        )
-
-        summary["MaxScore"] += mark
-        if passed:
-            summary["Score"] += mark
-            summary["Passed"] += 1
-
-        meta = {
-            "ExitCode": rc2,
-            "Stderr": err2,
-            "Timeout": to2,
-            "EmptyOutput": empty_out,
-            "RuntimeError": runtime_error,
-            "AppliedRules": {
-                "RemoveSpaces": remove_spaces,
-                "CaseSensitive": case_sensitive,
-                "Strict": defaults.get("Strict", False),
-                "IgnoreTrailingPerLine": defaults.get("IgnoreTrailingPerLine", False)
-            }
-        }
-        meta_path.write_text(__import__("json").dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
-
-        results.append({
-            "Question": qname,
-            "TestCase": tc.name,
-            "Passed": passed,
-            "Mark": mark,
-            "ExpectedPath": str(exp_path),
-            "StudentPath": str(stu_path),
-            "Expected": exp,
-            "Got": out2,
-            "Compiled": compiled_ok,
-            "MainClass": main_class,
-            "CompileLog": compile_log,
-            "RemoveSpaces": remove_spaces,
-            "CaseSensitive": case_sensitive,
-            "ExitCode": rc2,
-            "Stderr": err2,
-            "Timeout": to2,
-            "EmptyOutput": empty_out,
-            "RuntimeError": runtime_error,
-            "ExpectedFromJar": expected_from_jar,
-            "StudentFromJar": student_from_jar,
-        })
+            compile_log = ""
+            compiled_ok = False
+            if java_files:
+                started = time.perf_counter()
+                compile_args = ["-d", str(classes_dir)] + java_files
+                compiled = get_compile_service(java, javac).compile(compile_args, timeout_s=COMPILE_TIMEOUT_S) \
+                    if defaults.get("CompileDaemon") else None
+                if compiled is not None:
+                    rc, out, err = compiled
+                else:
+                    rc, out, err, _ = run_cmd([javac] + compile_args)
+                compiled_ok = (rc == 0)
+                compile_log = (out or "") + (("\n" + err) if err else "")
+                summary["CompileMs"] = _ms(time.perf_counter() - started)
+                compiled_now = True
+            elif has_jar:
+                compile_log = "Skipped compilation: using existing run/*.jar"
+            else:
+                return results, summary, "No .java files in Given/src/ and no run/JAR found."
+
+            main_class = sources.main_class
+            student_from_jar = False
+            student_cmd = None
+            if compiled_ok:
+                student_cmd = [java, *jvm_flags, "-cp", str(classes_dir), main_class]
+            elif has_jar:
+                student_cmd = [java, *jvm_flags, "-jar", str(jar)]
+                student_from_jar = True
+            store.put_compile(build_key, compiled_ok, main_class, compile_log)
+            if student_cmd is None:
+                # Recorded first, so the batch scheduler can tell this known compile failure is quick
+                summary["Compiled"] = compiled_ok
+                summary["MainClass"] = main_class
+                return results, summary, "Compilation failed and no run/JAR available."
+
+        summary["Compiled"] = compiled_ok
+        summary["MainClass"] = main_class
+
+        use_warm = bool(defaults.get("WarmJvm") and student_cmd and not student_from_jar)
+
+        def run_one(tc):
+            if cancel is not None and cancel.is_cancelled():
+                return None
+            # Warm runners are per thread, so each pool thread looks up its own
+            warm = get_warm_jvm(java, javac, jvm_flags) if use_warm else None
+            started = time.perf_counter()
+            row, meta = _run_test_case(tc, qname, java, jar, has_jar, jar_hash, cache_dir, defaults,
+                                       student_cmd, warm, classes_dir, main_class, compiled_ok, compile_log, student_from_jar,
+                                       cancel=cancel)
+            row["ElapsedMs"] = meta["ElapsedMs"] = round((time.perf_counter() - started) * 1000.0, 1)
+            if job is not None:
+                job.advance()
+            return row, meta
+
+        summary["Total"] = len(tcs)
+
+        # Rows only point at their texts; the compile log is written once per question instead of copied into every row
+        compile_log_path = ""
+        if bundle is None and compile_log:
+            compile_log_path = str(out_dir/f"{qname}-compile.log")
+            Path(compile_log_path).write_text(compile_log, encoding="utf-8", errors="ignore")
+
+        pending = [tc for tc in tcs if stored.get(tc.name) is None]
+        workers = min(test_workers(defaults), len(pending))
+        futures = {}
+        if workers > 1:
+            # At most `workers` tests of this question in flight; the pool itself may be larger
+            executor = _test_executor()
+            waiting = iter(pending)
+
+            def submit_next():
+                tc = next(waiting, None)
+                if tc is not None:
+                    futures[tc.name] = executor.submit(run_one, tc)
 
+            for _ in range(workers):
+                submit_next()
+
+        for tc in tcs:
+            case_name = tc.stem
+            exp_path = out_dir/f"{qname}-{case_name}-expected.txt"
+            stu_path = out_dir/f"{qname}-{case_name}-student.txt"
+            meta_path = out_dir/f"{qname}-{case_name}-meta.json"
+
+            hit = stored.get(tc.name)
+            if hit is not None:
+                row, meta = hit
+                # Test files with the same content share a stored row; it keeps the name of the first
+                row = dict(row, Question=qname, TestCase=tc.name)
+                summary["ReusedTests"] += 1
+                if job is not None:
+                    job.advance()
+            else:
+                if tc.name in futures:
+                    got = futures.pop(tc.name).result()
+                    submit_next()
+                else:
+                    got = run_one(tc)
+                if got is None:
+                    # Cancelled before this test started; the rows so far stay usable
+                    summary["Cancelled"] = True
+                    break
+                row, meta = got
+                summary["ExecutedTests"] += 1
+                for phase in PHASE_KEYS[1:]:
+                    summary[phase] = round(summary[phase] + row[phase], 1)
+                if row["Status"] == "ReferenceError":
+                    summary["ReferenceErrors"] += 1
+                if row["Status"] == "Cancelled":
+                    summary["Cancelled"] = True
+                elif _storable_result(row):
+                    store.put_test(tc_keys[tc.name], sub_hash, row, meta)
+
+            if bundle is not None:
+                row = bundle.put_test(row, meta)
+                row.update(Bundle=str(bundle.path), ExpectedPath="", StudentPath="")
+            else:
+                _write_case_files(exp_path, stu_path, meta_path, row["Expected"], row["Got"], meta)
+                row = {k: v for k, v in row.items() if k not in RESULT_TEXT_FIELDS}
+                row.update(ExpectedPath=str(exp_path), StudentPath=str(stu_path), MetaPath=str(meta_path),
+                           CompileLogPath=compile_log_path)
+
+            summary["MaxScore"] += row["Mark"]
+            if row["Passed"]:
+                summary["Score"] += row["Mark"]
+                summary["Passed"] += 1
+            results.append(row)
+
+        executed = summary["ExecutedTests"]
+        summary["SuiteKey"] = tcs.key
+        if executed and not summary["Cancelled"]:
+            # History for the batch scheduler's cost model; the summary carries it to a cluster coordinator
+            test_ms = sum(summary[k] for k in PHASE_KEYS[1:]) / executed
+            summary["TimingSample"] = [summary["CompileMs"] if compiled_now else None, round(test_ms, 1)]
+            record_question_timings(store, [summary])
+    finally:
+        if own_store:
+            store.close()
+        if bundle is not None:
+            bundle.commit()
+
+    # A cancelled question executed nothing either, but most of its results are missing, not reused
+    summary["Reused"] = bool(tcs) and not summary["Cancelled"] and summary["ReusedTests"] == len(tcs)
     if summary["MaxScore"] > 0:
         summary["Percent"] = round(100.0 * summary["Score"] / summary["MaxScore"], 2)
 
     return results, summary, compile_log
 
-def grade_all(root: Path, java_home: str = "", defaults: dict | None = None):
-    defaults = defaults or {"Strict": False, "IgnoreTrailingPerLine": False, "RemoveSpaces": None, "CaseSensitive": None, "TimeoutMs": None}
+# Time spent per grading phase, summed per question into timing.csv; ExtractMs is per submission
+PHASE_KEYS = ("CompileMs", "ReferenceMs", "StudentMs", "CompareMs")
+
+# Test cases of one question run on a long-lived thread pool, so pool threads keep their warm JVMs.
+# It is created once with room for the most TestWorkers allowed and starts threads only as tests
+# are submitted; each question caps its own tests in flight, so concurrent callers share it safely.
+MAX_TEST_WORKERS = 32
+_test_pool = None
+_test_pool_lock = threading.Lock()
+
+def test_workers(defaults: dict) -> int:
+    """defaults["TestWorkers"] if set, otherwise up to 4 concurrent test cases per question."""
+    value = defaults.get("TestWorkers")
+    if value:
+        return min(MAX_TEST_WORKERS, max(1, int(value)))
+    return min(4, os.cpu_count() or 1)
+
+def _test_executor() -> ThreadPoolExecutor:
+    """The shared test pool; never shut down or replaced while the process runs."""
+    global _test_pool
+    with _test_pool_lock:
+        if _test_pool is None:
+            _test_pool = ThreadPoolExecutor(max_workers=MAX_TEST_WORKERS, thread_name_prefix="autograde-test")
+        return _test_pool
+
+def _run_test_case(tc: TestCase, qname: str, java: str, jar: Path, has_jar: bool, jar_hash, cache_dir: Path, defaults: dict,
+                   student_cmd, warm, classes_dir: Path, main_class: str, compiled_ok: bool, compile_log: str, student_from_jar: bool,
+                   cancel: CancelToken | None = None):
+    input_text = tc.input_text
+    explicit_output = tc.expected_output
+    remove_spaces = tc.remove_spaces
+    case_sensitive = tc.case_sensitive
+    mark = tc.mark
+    timeout_ms = tc.timeout_ms
+    max_output = max_output_bytes(defaults)
+    compare_rules = tc.compare_rules
+    limits = resource_limits(defaults)
+
+    # Expected: prioritize run/Q*.jar when available so prompts match exactly
+    expected_from_jar = has_jar
+    reference_ms = 0.0
+    reference_cancelled = False
+    reference_error = ""
+    if expected_from_jar:
+        tc_hash = tc.sha
+        java_id = java_identity(java)
+        exp = load_expected_output(cache_dir, jar_hash, tc_hash, timeout_ms, java_id)
+        if exp is None:
+            started = time.perf_counter()
+            ref = run_process([java, "-jar", str(jar)], input_text=input_text, timeout_ms=timeout_ms, max_output_bytes=max_output,
+                              cancel=cancel)
+            exp = ref["Stdout"]
+            reference_cancelled = ref["Status"] == "Cancelled"
+            if not reference_cancelled:
+                reference_error = reference_failure(ref)
+            if not (reference_cancelled or reference_error):
+                store_expected_output(cache_dir, jar_hash, tc_hash, timeout_ms, java_id, exp)
+            reference_ms = _ms(time.perf_counter() - started)
+    elif explicit_output is not None:
+        exp = explicit_output
+    else:
+        exp = ""
+
+    # Student: warm JVM when enabled, plain `java` process when it cannot isolate the run.
+    # Only the plain process gets rlimits; a warm JVM shares one -Xmx/-Xss between its tests.
+    started = time.perf_counter()
+    res = warm.run(classes_dir, main_class, input_text=input_text, timeout_ms=timeout_ms, max_output_bytes=max_output) \
+        if warm and not (reference_cancelled or reference_error) else None
+    if reference_error:
+        # Nothing to compare against: an infrastructure problem, not a wrong answer
+        res = {"ExitCode": ref["ExitCode"], "Stdout": "", "Stderr": reference_error, "Timeout": False, "Status": "ReferenceError"}
+    elif res is None:
+        # Early-fail: stop the program once its output can no longer match
+        watch = StreamingComparator(exp, **compare_rules).feed if defaults.get("EarlyFail") else None
+        res = run_process(student_cmd, input_text=input_text, timeout_ms=timeout_ms, max_output_bytes=max_output, on_stdout=watch,
+                          cancel=cancel, limits=limits)
+    student_ms = _ms(time.perf_counter() - started)
+    rc2, out2, err2, to2 = res["ExitCode"], res["Stdout"], res["Stderr"], res["Timeout"]
+
+    empty_out = (out2.strip() == "")
+    status = "Cancelled" if reference_cancelled else res["Status"]
+    # An early-fail kill is a wrong answer, not a crash
+    runtime_error = status not in ("EarlyMismatch", "Cancelled", "ReferenceError") and ((rc2 != 0) or (err2.strip() != ""))
+    if status == "OK" and runtime_error:
+        status = "RuntimeError"
+    # A run that hit a limit crashed for a reason of its own, not the program's logic alone
+    limit = limit_exceeded(res, limits) if status in ("OK", "RuntimeError") else ""
+    if limit:
+        status = "ResourceLimitExceeded"
+
+    started = time.perf_counter()
+    passed = status not in ("Cancelled", "ReferenceError") and tc.normalizer.matches(exp, out2)
+    compare_ms = _ms(time.perf_counter() - started)
+    # Warm runs share one JVM, so only wall time is known for them
+    usage = {"WallMs": res.get("WallMs", student_ms), "CpuMs": res.get("CpuMs"), "PeakRssKb": res.get("PeakRssKb")}
+    phases = {"ReferenceMs": reference_ms, "StudentMs": student_ms, "CompareMs": compare_ms}
+
+    meta = {
+        "Status": status,
+        "ExitCode": rc2,
+        "Stderr": err2,
+        "Timeout": to2,
+        "EmptyOutput": empty_out,
+        "RuntimeError": runtime_error,
+        "LimitExceeded": limit,
+        "Limits": limits,
+        "TestCaseProblems": list(tc.problems),
+        "Usage": usage,
+        "PhaseMs": phases,
+        "AppliedRules": {
+            "RemoveSpaces": remove_spaces,
+            "CaseSensitive": case_sensitive,
+            "Strict": defaults.get("Strict", False),
+            "IgnoreTrailingPerLine": defaults.get("IgnoreTrailingPerLine", False)
+        }
+    }
+    row = {
+        "Question": qname,
+        "TestCase": tc.name,
+        "Passed": passed,
+        "Mark": mark,
+        "Expected": exp,
+        "Got": out2,
+        "Compiled": compiled_ok,
+        "MainClass": main_class,
+        "CompileLog": compile_log,
+        "RemoveSpaces": remove_spaces,
+        "CaseSensitive": case_sensitive,
+        "ExitCode": rc2,
+        "Stderr": err2,
+        "Timeout": to2,
+        "Status": status,
+        "EmptyOutput": empty_out,
+        "RuntimeError": runtime_error,
+        "LimitExceeded": limit,
+        "ExpectedFromJar": expected_from_jar,
+        "StudentFromJar": student_from_jar,
+        **usage,
+        **phases,
+    }
+    return row, meta
+
+
+RESULT_CSV_FIELDS = ["Question","TestCase","Passed","Mark","ExpectedPath","StudentPath","ExitCode","RuntimeError","EmptyOutput",
+                     "Status","LimitExceeded","ElapsedMs","WallMs","CpuMs","PeakRssKb"]
+
+def export_csvs(out_dir: Path, rows, summaries):
+    """Per-question <Q>-results.csv and summary.csv, written in a single pass over rows."""
+    files = {}
+    try:
+        for row in rows:
+            q = row["Question"]
+            if q not in files:
+                f = open(out_dir/f"{q}-results.csv", "w", newline='', encoding="utf-8")
+                w = csv.DictWriter(f, fieldnames=RESULT_CSV_FIELDS, extrasaction="ignore", restval="")
+                w.writeheader()
+                files[q] = (f, w)
+            files[q][1].writerow(row)
+    finally:
+        for f, _ in files.values():
+            f.close()
+
+    with open(out_dir/"summary.csv", "w", newline='', encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=["Question","Passed","Total","Percent","Compiled","MainClass","Score","MaxScore"], extrasaction="ignore")
+        w.writeheader()
+        for s in summaries:
+            w.writerow(s)
+
+class StreamingCsv:
+    """
+    A CSV written row by row and flushed as it goes, so an interrupted batch still leaves every
+    finished row on disk. finish(rows) rewrites it once in the final order.
+    """
+
+    def __init__(self, path: Path, fields):
+        self.path = Path(path)
+        self.fields = fields
+        self.file = open(self.path, "w", newline='', encoding="utf-8")
+        self.writer = csv.DictWriter(self.file, fieldnames=fields, extrasaction="ignore", restval="")
+        self.writer.writeheader()
+        self.file.flush()
+
+    def add(self, row: dict):
+        self.writer.writerow(row)
+        self.file.flush()
+
+    def finish(self, rows=None):
+        self.file.close()
+        if rows is None:
+            return
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w", newline='', encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=self.fields, extrasaction="ignore", restval="")
+            w.writeheader()
+            for row in rows:
+                w.writerow(row)
+        os.replace(tmp, self.path)
+
+def _read_text(path) -> str:
+    if not path:
+        return ""
+    try:
+        return Path(path).read_text(encoding="utf-8", errors="ignore")
+    except OSError:
+        return ""
+
+def load_result_texts(row: dict) -> dict:
+    """
+    Expected/Got/Stderr/CompileLog of a result row. grade_all rows only point at them:
+    blob hashes in grading.sqlite, or the expected/student/meta/compile-log files.
+    """
+    texts = {f: row[f] for f in RESULT_TEXT_FIELDS if row.get(f) is not None}
+    missing = [f for f in RESULT_TEXT_FIELDS if f not in texts]
+    if missing and row.get("Bundle"):
+        with ResultBundle(row["Bundle"], readonly=True) as bundle:
+            for f in missing:
+                texts[f] = bundle.get_text(row.get(f"{f}Blob", ""))
+    elif missing:
+        paths = {"Expected": row.get("ExpectedPath"), "Got": row.get("StudentPath"), "CompileLog": row.get("CompileLogPath")}
+        for f in missing:
+            if f == "Stderr":
+                try:
+                    texts[f] = json.loads(_read_text(row.get("MetaPath")) or "{}").get("Stderr", "")
+                except ValueError:
+                    texts[f] = ""
+            else:
+                texts[f] = _read_text(paths[f])
+    return {f: texts.get(f, "") for f in RESULT_TEXT_FIELDS}
+
+class GradingJob:
+    """
+    Progress and cancellation for one grade_all or grade_batch run.
+    on_progress(info) is called from the grading threads after every finished unit (a test for
+    grade_all, a submission for grade_batch) with {"Done", "Total", "Unit", "ElapsedS", "EtaS"};
+    cancel() may be called from any thread.
+    Units can carry a predicted cost (grade_batch uses the scheduler's milliseconds). EtaS is the
+    remaining cost at the pace measured so far, or at the predicted pace until `calibrate_after`
+    units have finished; without costs every unit counts as 1.
+    """
+
+    def __init__(self, on_progress=None, cancel_token: CancelToken | None = None):
+        self.on_progress = on_progress
+        self.cancel_token = cancel_token or CancelToken.with_flag_file()
+        self.lock = threading.Lock()
+        self.total = 0
+        self.done = 0
+        self.total_cost = 0.0
+        self.done_cost = 0.0
+        self.pace = None
+        self.calibrate_after = 1
+        self.unit = "test"
+        self.started = time.perf_counter()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token.is_cancelled()
+
+    def cancel(self):
+        self.cancel_token.cancel()
+
+    def expect(self, count: int, unit: str, cost: float | None = None, pace: float | None = None, calibrate_after: int = 1):
+        """count more units of cost in total; pace is the predicted seconds per unit of cost."""
+        with self.lock:
+            self.total += count
+            self.total_cost += count if cost is None else cost
+            self.unit = unit
+            self.pace = pace
+            self.calibrate_after = max(1, calibrate_after)
+            info = self._progress()
+        if self.on_progress:
+            self.on_progress(info)
+
+    def advance(self, count: int = 1, cost: float | None = None):
+        if count <= 0:
+            return
+        with self.lock:
+            self.done = min(self.total, self.done + count) if self.total else self.done + count
+            self.done_cost += count if cost is None else cost
+            info = self._progress()
+        if self.on_progress:
+            self.on_progress(info)
+
+    def _progress(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        remaining = max(0.0, self.total_cost - self.done_cost)
+        if self.done >= self.calibrate_after and self.done_cost > 0:
+            eta = elapsed / self.done_cost * remaining
+        elif self.pace is not None:
+            eta = remaining * self.pace
+        else:
+            eta = None
+        return {"Done": self.done, "Total": self.total, "Unit": self.unit,
+                "ElapsedS": round(elapsed, 1), "EtaS": None if eta is None else round(eta, 1)}
+
+    def progress(self) -> dict:
+        with self.lock:
+            return self._progress()
+
+    def close(self):
+        self.cancel_token.discard()
+        # Warm JVMs of grading threads that have ended by now; the others close as their thread ends
+        release_warm_jvms()
+
+def grade_all(root: Path, java_home: str = "", defaults: dict | None = None, cache_dir: Path | None = None,
+              job: GradingJob | None = None):
+    """
+    Grade every Q* folder of root into root/_grading_out. With a job, progress is reported per
+    test and a cancelled job stops early: the CSVs then cover the tests that finished.
+    """
+    defaults = defaults or {"Strict": False, "IgnoreTrailingPerLine": False, "RemoveSpaces": None, "CaseSensitive": None, "TimeoutMs": None,
+                            "MaxOutputBytes": DEFAULT_MAX_OUTPUT_BYTES}
     root = Path(root).resolve()
+    cache_dir = Path(cache_dir).resolve() if cache_dir else default_cache_dir(root)
     out_dir = root/"_grading_out"
     if out_dir.exists():
         shutil.rmtree(out_dir)
@@ -264,46 +1440,54 @@ def grade_all(root: Path, java_home: str = "", defaults: dict | None = None):
     summaries = []
     messages = []
 
-    for q in questions:
-        r, s, msg = grade_question(root, q, javac, java, out_dir, defaults)
-        all_results.extend(r)
-        summaries.append(s)
-        if msg:
-            messages.append(f"{q}: {msg}")
-
-    # Write per-question CSV
-    for q in set(s["Question"] for s in summaries):
-        rows = [r for r in all_results if r["Question"] == q]
-        if rows:
-            csv_path = out_dir/f"{q}-results.csv"
-            with open(csv_path, "w", newline='', encoding="utf-8") as f:
-                import csv as _csv
-                w = _csv.DictWriter(f, fieldnames=["Question","TestCase","Passed","Mark","ExpectedPath","StudentPath","ExitCode","RuntimeError","EmptyOutput"])
-                w.writeheader()
-                for row in rows:
-                    w.writerow({
-                        "Question": row["Question"],
-                        "TestCase": row["TestCase"],
-                        "Passed": row["Passed"],
-                        "Mark": row["Mark"],
-                        "ExpectedPath": row["ExpectedPath"],
-                        "StudentPath": row["StudentPath"],
-                        "ExitCode": row["ExitCode"],
-                        "RuntimeError": row["RuntimeError"],
-                        "EmptyOutput": row["EmptyOutput"],
-                    })
-
-    # Write summary
-    with open(out_dir/"summary.csv", "w", newline='', encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=["Question","Passed","Total","Percent","Compiled","MainClass","Score","MaxScore"])
+    # OutputFormat "sqlite" keeps every test of this run in one grading.sqlite instead of three files each
+    bundle = ResultBundle(out_dir/BUNDLE_FILE_NAME) if defaults.get("OutputFormat") == "sqlite" else None
+    store = ResultStore.for_cache_dir(cache_dir)
+    expected_tests = {}
+    if job is not None:
+        expected_tests = {q: len(load_test_suite(root/q/"TestCases", defaults)) for q in questions}
+        job.expect(sum(expected_tests.values()), "test")
+    cancelled = False
+    try:
+        for q in questions:
+            if job is not None and job.cancelled:
+                cancelled = True
+                break
+            r, s, msg = grade_question(root, q, javac, java, out_dir, defaults, cache_dir=cache_dir, store=store, bundle=bundle,
+                                       job=job)
+            cancelled = cancelled or s["Cancelled"]
+            if job is not None and not s["Cancelled"]:
+                # Questions that stop before their tests (no sources, compile failure) still count as done
+                job.advance(expected_tests.get(q, 0) - len(r))
+            all_results.extend(r)
+            summaries.append(s)
+            if bundle is not None:
+                bundle.put_summary(s)
+            if msg:
+                messages.append(f"{q}: {msg}")
+            if s["ReferenceErrors"]:
+                messages.append(f"{q}: run/{q}.jar failed on {s['ReferenceErrors']} test case(s); their expected output is unknown.")
+        export_csvs(out_dir, bundle.iter_tests() if bundle is not None else all_results, summaries)
+    finally:
+        store.close()
+        if bundle is not None:
+            bundle.close()
+
+    # Per-phase timing: where the time of this submission went
+    timing = {k: round(sum(s.get(k, 0.0) for s in summaries), 1) for k in PHASE_KEYS}
+    with open(out_dir/"timing.csv", "w", newline='', encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=["Question", *PHASE_KEYS], extrasaction="ignore")
         w.writeheader()
         for s in summaries:
             w.writerow(s)
+        w.writerow(dict(timing, Question="TOTAL"))
 
     total_score = sum(s["Score"] for s in summaries)
     total_max   = sum(s["MaxScore"] for s in summaries)
     with open(out_dir/"overall.txt", "w", encoding="utf-8") as f:
         f.write(f"Total Score: {total_score} / {total_max}\n")
+        if cancelled:
+            f.write("Cancelled: partial results\n")
 
     return {
         "results": all_results,
@@ -312,4 +1496,460 @@ def grade_all(root: Path, java_home: str = "", defaults: dict | None = None):
         "out_dir": str(out_dir),
         "total_score": total_score,
         "total_max": total_max,
+        "dedup": {"hits": sum(1 for s in summaries if s.get("Reused")), "total": len(summaries)},
+        "reuse": {"reused": sum(s.get("ReusedTests", 0) for s in summaries),
+                  "executed": sum(s.get("ExecutedTests", 0) for s in summaries)},
+        "timing": timing,
+        "cancelled": cancelled,
     }
+
+def looks_like_question_root(folder: Path) -> bool:
+    try:
+        return any(p.is_dir() and p.name.upper().startswith("Q") for p in folder.iterdir())
+    except Exception:
+        return False
+
+def guess_root_in_dir(base: Path) -> Path | None:
+    if looks_like_question_root(base):
+        return base
+    for child in base.iterdir():
+        if child.is_dir() and looks_like_question_root(child):
+            return child
+    return None
+
+def _zip_member_role(parts):
+    """
+    Returns (prefix_len, kind) when a ZIP member is something grading reads:
+    Q*/Given/src/**/*.java, Q*/Given/run/*.jar or Q*/TestCases/*.txt.
+    """
+    name = parts[-1].lower()
+    for i in range(len(parts) - 2):
+        if not parts[i].upper().startswith("Q"):
+            continue
+        rest = parts[i+1:]
+        if len(rest) >= 3 and rest[0] == "Given" and rest[1] == "src" and name.endswith(".java"):
+            return i, "src"
+        if len(rest) == 3 and rest[0] == "Given" and rest[1] == "run" and name.endswith(".jar"):
+            return i, "jar"
+        if len(rest) == 2 and rest[0] == "TestCases" and name.endswith(".txt"):
+            return i, "testcase"
+    return None
+
+def _pick_zip_members(zf: zipfile.ZipFile, max_members: int = ZIP_MAX_MEMBERS, max_member_bytes: int = ZIP_MAX_MEMBER_BYTES):
+    """
+    (root prefix, [(parts, kind, info)]) of the members grading reads under the question root,
+    or (None, []) when the ZIP has none.
+    """
+    infos = zf.infolist()
+    if len(infos) > max_members:
+        raise RuntimeError(f"ZIP có quá nhiều mục ({len(infos)} > {max_members}).")
+    picked = []
+    for info in infos:
+        if info.is_dir():
+            continue
+        parts = [x for x in info.filename.replace("\\", "/").split("/") if x not in ("", ".")]
+        if not parts or ".." in parts or info.filename.startswith(("/", "\\")) or ":" in parts[0]:
+            continue
+        role = _zip_member_role(parts)
+        if role is None:
+            continue
+        if info.file_size > max_member_bytes:
+            raise RuntimeError(f"Tệp quá lớn trong ZIP: {info.filename} ({info.file_size} bytes).")
+        picked.append((role[0], role[1], parts, info))
+    if not picked:
+        return None, []
+    # The shallowest Q* folder decides the root, like guess_root_in_dir does after extractall
+    depth = min(d for d, _, _, _ in picked)
+    prefix = min(tuple(parts[:depth]) for d, _, parts, _ in picked if d == depth)
+    return prefix, [(parts, kind, info) for d, kind, parts, info in picked if tuple(parts[:d]) == prefix]
+
+def extract_submission_zip(zip_path: Path, dest: Path, max_members: int = ZIP_MAX_MEMBERS,
+                           max_member_bytes: int = ZIP_MAX_MEMBER_BYTES, max_total_bytes: int = ZIP_MAX_TOTAL_BYTES) -> Path:
+    """
+    Extract only the members grading uses, reading the central directory first.
+    NetBeans build/ and nbproject/ trees, .class files and editor temp files are never written.
+    Returns the folder that plays the role of the question root.
+    """
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        prefix, picked = _pick_zip_members(zf, max_members, max_member_bytes)
+        if prefix is None:
+            return dest
+        total = 0
+        for parts, kind, info in picked:
+            target = dest.joinpath(*parts)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            written = 0
+            with zf.open(info) as src, open(target, "wb") as out:
+                # Sizes in the header can lie, so count what is actually inflated
+                for chunk in iter(lambda: src.read(1 << 16), b""):
+                    written += len(chunk)
+                    total += len(chunk)
+                    if written > max_member_bytes or total > max_total_bytes:
+                        raise RuntimeError(f"ZIP giải nén vượt giới hạn dung lượng tại {info.filename}.")
+                    out.write(chunk)
+    return dest.joinpath(*prefix) if prefix else dest
+
+def prepare_root_path(root_value: str):
+    path = Path(root_value)
+    if path.is_dir():
+        return {"root": path, "cleanup": None, "zip_source": None, "cache_dir": default_cache_dir(path)}
+    if path.is_file() and path.suffix.lower() == ".zip":
+        temp_base = Path(tempfile.mkdtemp(prefix="autograde_zip_"))
+        try:
+            guessed = extract_submission_zip(path, temp_base)
+        except Exception as ex:
+            shutil.rmtree(temp_base, ignore_errors=True)
+            raise RuntimeError(f"Giải nén ZIP thất bại: {ex}")
+        return {"root": guessed, "cleanup": temp_base, "zip_source": path, "cache_dir": default_cache_dir(path.parent)}
+    raise FileNotFoundError("Không tìm thấy thư mục hoặc ZIP hợp lệ.")
+
+def relocate_zip_results(zip_source: Path, data: dict):
+    out_dir = data.get("out_dir")
+    if not out_dir:
+        return None
+    src = Path(out_dir)
+    dest = zip_source.with_name(f"{zip_source.stem}_grading_out")
+    if dest.exists():
+        shutil.rmtree(dest, ignore_errors=True)
+    shutil.move(str(src), dest)
+    new_path = str(dest)
+    prefix = str(src)
+    for r in data.get("results", []):
+        for key in ("ExpectedPath","StudentPath","MetaPath","CompileLogPath","Bundle"):
+            val = r.get(key)
+            if isinstance(val, str) and val.startswith(prefix):
+                r[key] = new_path + val[len(prefix):]
+    data["out_dir"] = new_path
+    return new_path
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+def submission_row(source, error=""):
+    """The per-submission row grade_submission returns, empty; with error set for submissions that were not graded."""
+    return {"Source": str(source), "Score": 0.0, "Max": 0.0, "Summaries": [], "OutDir": "", "Messages": [], "Error": error,
+            "DedupHits": 0, "DedupTotal": 0, "TestsReused": 0, "TestsExecuted": 0, "Cancelled": False, "Resumed": False,
+            "Timing": dict.fromkeys(("ExtractMs",) + PHASE_KEYS, 0.0)}
+
+CANCELLED_ERROR = "Đã huỷ trước khi chấm."
+
+def _cancelled_row(source):
+    row = submission_row(source, error=CANCELLED_ERROR)
+    row["Cancelled"] = True
+    return row
+
+def grade_submission(source: str, java_home: str = "", defaults: dict | None = None, cache_dir: Path | None = None,
+                     cancel_token: CancelToken | None = None):
+    """
+    Grade one submission (folder or ZIP) end to end: extract, compile, run, clean up.
+    Returns a small picklable row so batch workers do not ship Expected/Got strings back.
+    A cancelled token stops the grading; the row then has Cancelled set and partial scores.
+    """
+    if cancel_token is not None and cancel_token.is_cancelled():
+        return _cancelled_row(source)
+    row = submission_row(source)
+    job = GradingJob(cancel_token=cancel_token) if cancel_token is not None else None
+    try:
+        started = time.perf_counter()
+        prep = prepare_root_path(source)
+        row["Timing"]["ExtractMs"] = _ms(time.perf_counter() - started)
+        try:
+            if not looks_like_question_root(prep["root"]):
+                raise RuntimeError("Không tìm thấy thư mục Q* trong bài nộp này.")
+            data = grade_all(prep["root"], java_home, defaults=dict(defaults) if defaults else None,
+                             cache_dir=cache_dir or prep["cache_dir"], job=job)
+            if prep["zip_source"]:
+                relocate_zip_results(prep["zip_source"], data)
+            row.update({
+                "Score": data.get("total_score", 0.0),
+                "Max": data.get("total_max", 0.0),
+                "Summaries": data.get("summaries", []),
+                "OutDir": data.get("out_dir", ""),
+                "Messages": data.get("messages", []),
+                "DedupHits": data["dedup"]["hits"],
+                "DedupTotal": data["dedup"]["total"],
+                "TestsReused": data["reuse"]["reused"],
+                "TestsExecuted": data["reuse"]["executed"],
+                "Cancelled": data["cancelled"],
+            })
+            row["Timing"].update(data["timing"])
+            failed = [s["Question"] for s in row["Summaries"] if s.get("ReferenceErrors")]
+            if failed:
+                row["Error"] = f"Chạy đáp án run/*.jar lỗi ở {', '.join(failed)}: không chấm được (kiểm tra JAVA_HOME)."
+        finally:
+            if prep.get("cleanup"):
+                shutil.rmtree(prep["cleanup"], ignore_errors=True)
+    except Exception as ex:
+        row["Error"] = str(ex)
+    return row
+
+_FINGERPRINT_SKIP = {"_grading_out", CACHE_DIR_NAME}
+
+def submission_fingerprint(source) -> str:
+    """Content hash of a submission: the ZIP bytes, or every file of a submission folder except grading output."""
+    path = Path(source)
+    if path.is_file():
+        return file_sha256(path)
+    h = hashlib.sha256()
+    for p in sorted(path.rglob("*")):
+        rel = p.relative_to(path)
+        if not p.is_file() or _FINGERPRINT_SKIP.intersection(rel.parts):
+            continue
+        h.update(rel.as_posix().encode("utf-8") + b"\0")
+        h.update(bytes.fromhex(file_sha256(p)))
+    return h.hexdigest()
+
+def batch_config(java_home: str, defaults: dict | None) -> str:
+    """What a finished batch entry depends on besides the submission itself."""
+    java_id = java_identity(find_java_tools(java_home or None)[1])
+    return json.dumps({"JavaHome": java_home or "", "Rules": result_rules(defaults or {}, java_id)}, sort_keys=True)
+
+# Cost model of the batch scheduler, in milliseconds of one worker; recorded question timings replace the defaults
+DEFAULT_COMPILE_MS = 1500.0
+DEFAULT_TEST_MS = 500.0
+SUBMISSION_OVERHEAD_MS = 300.0
+EXTRACT_BYTES_PER_MS = 50_000
+
+@dataclass(frozen=True)
+class QuestionInputs:
+    """What the cost model needs to know about one question of a submission, read without extracting it."""
+    name: str
+    source_hash: str
+    jar_hash: str | None
+    has_sources: bool
+    suite_key: str
+    testcase_hashes: tuple
+
+@dataclass(frozen=True)
+class JobEstimate:
+    source: str
+    cost_ms: float
+    questions: int
+    tests: int
+    size: int
+    # Nothing to run: known compile failures without a jar, or every test already in the result store
+    quick: bool
+
+def _zip_question_inputs(path: Path, max_member_bytes: int = ZIP_MAX_MEMBER_BYTES, max_total_bytes: int = ZIP_MAX_TOTAL_BYTES):
+    """
+    QuestionInputs read straight from a submission ZIP, one member at a time; None when the members
+    inflate past the limits extract_submission_zip enforces, so only the ZIP size is worth estimating.
+    """
+    with zipfile.ZipFile(path, "r") as zf:
+        prefix, picked = _pick_zip_members(zf, ZIP_MAX_MEMBERS, max_member_bytes)
+        if prefix is None:
+            return []
+        found = {}
+        total = 0
+        for parts, kind, info in picked:
+            rest = parts[len(prefix):]
+            q = found.setdefault(rest[0], {"src": [], "jar": None, "tests": []})
+            if kind == "jar" and rest[-1] != f"{rest[0]}.jar":
+                # Extracted but never hashed: the header size will do for the total
+                total += info.file_size
+                if total > max_total_bytes:
+                    return None
+                continue
+            h = hashlib.sha256()
+            data = bytearray()
+            written = 0
+            with zf.open(info) as src:
+                for chunk in iter(lambda: src.read(1 << 16), b""):
+                    written += len(chunk)
+                    total += len(chunk)
+                    if written > max_member_bytes or total > max_total_bytes:
+                        return None
+                    if kind == "src":
+                        data += chunk
+                    else:
+                        h.update(chunk)
+            if kind == "src":
+                # Only the SourceFile is kept, the bytes go with this member
+                q["src"].append(_source_file(PurePosixPath(*rest[3:]).as_posix(), bytes(data), None))
+            elif kind == "jar":
+                q["jar"] = h.hexdigest()
+            else:
+                q["tests"].append((rest[-1], h.hexdigest()))
+    inputs = []
+    for name, q in sorted(found.items()):
+        tests = sorted(q["tests"])
+        sources = _manifest(sorted(q["src"], key=lambda f: PurePosixPath(f.rel)))
+        inputs.append(QuestionInputs(name, sources.digest, q["jar"], bool(sources.files), suite_key(tests),
+                                     tuple(sha for _, sha in tests)))
+    return inputs
+
+def _folder_question_inputs(path: Path):
+    root = guess_root_in_dir(path)
+    if root is None:
+        return []
+    inputs = []
+    for q in sorted(d for d in root.iterdir() if d.is_dir() and d.name.upper().startswith("Q")):
+        src = q/"Given"/"src"
+        jar = q/"Given"/"run"/f"{q.name}.jar"
+        tcdir = q/"TestCases"
+        tests = [(p.name, _load_testcase_file(p)[0]) for p in (sorted(tcdir.glob("*.txt")) if tcdir.exists() else [])]
+        sources = scan_sources(src)
+        inputs.append(QuestionInputs(q.name, sources.digest, file_sha256(jar) if jar.exists() else None,
+                                     bool(sources.files), suite_key(tests), tuple(sha for _, sha in tests)))
+    return inputs
+
+def estimate_submission(source, defaults: dict | None, store: ResultStore, java_id: str = "") -> JobEstimate:
+    """
+    Predicted grading time of one submission: extraction from the ZIP size, then per question
+    its compile and its test cases, timed from the history of that test suite (or of any suite
+    of that question) in the result store. Questions the store already has every result for
+    cost nothing. java_id is the java_identity() the submission will be graded with.
+    """
+    path = Path(source)
+    try:
+        is_zip = path.is_file()
+        size = path.stat().st_size if is_zip else 0
+        inputs = _zip_question_inputs(path) if is_zip else _folder_question_inputs(path)
+    except Exception:
+        # Unreadable (a bad ZIP, a corrupt deflate stream...): it fails during extraction, which is
+        # quick, and grading reports the error for this submission alone
+        return JobEstimate(str(source), SUBMISSION_OVERHEAD_MS, 0, 0, 0, True)
+    if inputs is None:
+        # Too large to grade: extraction inflates up to the limit and stops there
+        return JobEstimate(str(source), round(SUBMISSION_OVERHEAD_MS + size / EXTRACT_BYTES_PER_MS, 1), 0, 0, size, True)
+    rules = result_rules(defaults or {}, java_id)
+    cost = SUBMISSION_OVERHEAD_MS + size / EXTRACT_BYTES_PER_MS
+    quick = True
+    for q in inputs:
+        if not q.has_sources and q.jar_hash is None:
+            continue
+        timing = store.get_timing(question_timing_keys(q.name, q.suite_key))
+        compile_ms = timing[0] if timing and timing[0] is not None else DEFAULT_COMPILE_MS
+        test_ms = timing[1] if timing else DEFAULT_TEST_MS
+        sub_hash = submission_hash(q.source_hash, q.jar_hash)
+        compiled = store.get_compile(compile_key(sub_hash, java_id))
+        if compiled is not None and q.testcase_hashes and \
+                all(store.has_test(test_result_key(sub_hash, sha, rules)) for sha in q.testcase_hashes):
+            continue
+        if compiled is not None and not compiled["Compiled"] and q.jar_hash is None:
+            cost += compile_ms
+            continue
+        quick = False
+        cost += (compile_ms if q.has_sources else 0.0) + len(q.testcase_hashes) * test_ms
+    return JobEstimate(str(source), round(cost, 1), len(inputs), sum(len(q.testcase_hashes) for q in inputs), size, quick)
+
+def record_question_timings(store: ResultStore, summaries):
+    """Fold the TimingSample of each question summary that has one into store's timing history."""
+    for s in summaries:
+        if s.get("TimingSample"):
+            store.record_timing(question_timing_keys(s["Question"], s["SuiteKey"]), *s["TimingSample"])
+
+def schedule_store_dir(source, cache_dir: Path | None = None) -> Path:
+    """Cache folder whose store schedule_submissions reads for source: cache_dir, else the one grading uses."""
+    path = Path(source)
+    return Path(cache_dir) if cache_dir else default_cache_dir(path.parent if path.is_file() else path)
+
+def schedule_submissions(sources, defaults: dict | None = None, cache_dir: Path | None = None, java_home: str = ""):
+    """
+    Estimates for sources in the order a worker pool should start them: longest first, so no
+    slow submission is left to run alone at the end, and the quick ones last, to fill the gaps
+    while the long ones finish.
+    """
+    java_id = java_identity(find_java_tools(java_home or None)[1])
+    stores = {}
+    estimates = []
+    try:
+        for src in sources:
+            store_dir = schedule_store_dir(src, cache_dir)
+            if store_dir not in stores:
+                stores[store_dir] = ResultStore.for_cache_dir(store_dir)
+            estimates.append(estimate_submission(src, defaults, stores[store_dir], java_id))
+    finally:
+        for store in stores.values():
+            store.close()
+    return sorted(estimates, key=lambda e: (e.quick, -e.cost_ms))
+
+def grade_batch(sources, java_home: str = "", defaults: dict | None = None, cache_dir: Path | None = None,
+                workers: int | None = None, on_result=None, job: GradingJob | None = None,
+                journal: BatchJournal | None = None):
+    """
+    Grade many submissions on a pool of worker processes.
+    on_result(source, row) is called in the caller's thread as each submission finishes;
+    the returned list keeps the order of sources. With a job, progress is reported per
+    submission; cancelling it kills the running JVMs in every worker, and submissions that
+    never started come back with CANCELLED_ERROR.
+    With a journal, every finished submission is appended to it, and submissions it already
+    has as completed (same name, content and config, output still on disk) are not graded
+    again: their rows come back with Resumed set.
+    In parallel runs the pool starts submissions in schedule_submissions order; the same cost
+    estimates drive the job's ETA.
+    """
+    sources = [str(s) for s in sources]
+    workers = max(1, int(workers or default_workers()))
+    rows = {}
+    token = job.cancel_token if job is not None else None
+    config = batch_config(java_home, defaults)
+    fingerprints = {}
+    costs = {}
+
+    def finish(src, row, resumed=False):
+        rows[src] = row
+        if journal is not None and not resumed:
+            journal.append(Path(src).name, fingerprints.get(src, ""), config, row,
+                           completed=not row["Error"] and not row.get("Cancelled"))
+        if job is not None:
+            job.advance(cost=costs.get(src, 0.0))
+        if on_result:
+            on_result(src, row)
+
+    resumed = []
+    if journal is not None:
+        pending = []
+        for src in sources:
+            try:
+                fingerprints[src] = submission_fingerprint(src)
+            except OSError:
+                pending.append(src)
+                continue
+            done = journal.completed(Path(src).name, fingerprints[src], config)
+            if done is not None and (not done["OutDir"] or Path(done["OutDir"]).exists()):
+                resumed.append((src, dict(done, Source=src, Resumed=True)))
+            else:
+                pending.append(src)
+    else:
+        pending = sources
+
+    parallel = workers > 1 and len(pending) > 1
+    if parallel or job is not None:
+        estimates = schedule_submissions(pending, defaults, cache_dir, java_home)
+        costs = {e.source: e.cost_ms for e in estimates}
+        if parallel:
+            pending = [e.source for e in estimates]
+    if job is not None:
+        lanes = min(workers, len(pending)) or 1
+        job.expect(len(sources), "submission", cost=sum(costs.values()), pace=1.0 / (1000.0 * lanes),
+                   calibrate_after=len(resumed) + lanes)
+    for src, row in resumed:
+        finish(src, row, resumed=True)
+
+    if parallel and not (defaults or {}).get("TestWorkers"):
+        # The process pool already fills the CPUs; running tests in parallel too would only oversubscribe them
+        defaults = dict(defaults or {}, TestWorkers=1)
+
+    if not parallel:
+        for src in pending:
+            finish(src, grade_submission(src, java_home, defaults, cache_dir, cancel_token=token))
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as ex:
+            futs = {ex.submit(grade_submission, src, java_home, defaults, cache_dir, token): src for src in pending}
+            if token is not None:
+                token.on_cancel(lambda: [f.cancel() for f in futs])
+            for fut in as_completed(futs):
+                src = futs[fut]
+                try:
+                    row = fut.result()
+                except CancelledError:
+                    row = _cancelled_row(src)
+                except Exception as exc:
+                    row = submission_row(src, error=str(exc))
+                finish(src, row)
+    return [rows[src] for src in sources]
+
+if __name__ == "__main__":
+    from grade_cli import main
+    sys.exit(main())
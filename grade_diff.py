@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Expected/Got diff for the result detail window.
+
+Outputs are diffed by line with Myers' O((N+M)D) algorithm after trimming the common
+prefix and suffix. Character-level highlighting is computed separately per changed line
+pair (refine_pair) so the UI only pays for the lines it shows.
+"""
+import difflib
+
+# Beyond this many line edits the outputs are unrelated; report one replace block instead
+DIFF_MAX_EDITS = 2000
+# Only the first DIFF_MAX_LINES lines of each side are diffed
+DIFF_MAX_LINES = 20000
+# Lines longer than this are highlighted as a whole instead of per character
+REFINE_MAX_CHARS = 2000
+
+
+def _myers_script(a, b, max_edits):
+    """Edit script [(tag, i, j)] turning a into b, or None when it needs more than max_edits edits."""
+    n, m = len(a), len(b)
+    v = {1: 0}
+    trace = []
+    for d in range(max_edits + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return None
+
+
+def _backtrack(trace, x, y):
+    script = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v.get(k - 1, -1) < v.get(k + 1, -1)):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v.get(prev_k, 0)
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            script.append(("equal", x, y))
+        if d > 0:
+            if x == prev_x:
+                script.append(("insert", x, prev_y))
+            else:
+                script.append(("delete", prev_x, y))
+        x, y = prev_x, prev_y
+    script.reverse()
+    return script
+
+
+def _script_opcodes(script, offset):
+    """Group an edit script into difflib-style (tag, i1, i2, j1, j2) opcodes."""
+    opcodes = []
+    for tag, i, j in script:
+        i += offset
+        j += offset
+        di, dj = (1, 1) if tag == "equal" else (1, 0) if tag == "delete" else (0, 1)
+        if opcodes:
+            ptag, i1, i2, j1, j2 = opcodes[-1]
+            if i2 == i and j2 == j:
+                if ptag == tag:
+                    opcodes[-1] = (tag, i1, i + di, j1, j + dj)
+                    continue
+                if tag != "equal" and ptag in ("delete", "insert", "replace"):
+                    opcodes[-1] = ("replace", i1, i + di, j1, j + dj)
+                    continue
+        opcodes.append((tag, i, i + di, j, j + dj))
+    return opcodes
+
+
+def line_opcodes(a_lines, b_lines, max_edits: int = DIFF_MAX_EDITS):
+    """difflib-style opcodes between two line lists."""
+    # Compare small ints instead of strings
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in a_lines]
+    b = [ids.setdefault(line, len(ids)) for line in b_lines]
+    n, m = len(a), len(b)
+    pre = 0
+    while pre < n and pre < m and a[pre] == b[pre]:
+        pre += 1
+    suf = 0
+    while suf < n - pre and suf < m - pre and a[n - 1 - suf] == b[m - 1 - suf]:
+        suf += 1
+    opcodes = [("equal", 0, pre, 0, pre)] if pre else []
+    mid_a, mid_b = a[pre:n - suf], b[pre:m - suf]
+    if mid_a or mid_b:
+        script = _myers_script(mid_a, mid_b, max_edits)
+        if script is None:
+            tag = "replace" if mid_a and mid_b else "delete" if mid_a else "insert"
+            opcodes.append((tag, pre, n - suf, pre, m - suf))
+        else:
+            opcodes.extend(_script_opcodes(script, pre))
+    if suf:
+        opcodes.append(("equal", n - suf, n, m - suf, m))
+    return opcodes
+
+
+def refine_pair(a: str, b: str):
+    """Character opcodes for one changed line pair; whole-line replace when the lines are too long."""
+    if len(a) > REFINE_MAX_CHARS or len(b) > REFINE_MAX_CHARS:
+        return [("replace", 0, len(a), 0, len(b))]
+    return difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes()
+
+
+class LineDiff:
+    """
+    Rendered form of a line diff: rows of (tag, text) with tag equal/del/ins, plus the
+    (deleted row, inserted row) index pairs whose characters can be refined later.
+    """
+
+    def __init__(self, expected: str, got: str, max_lines: int = DIFF_MAX_LINES):
+        a_lines = expected.splitlines()
+        b_lines = got.splitlines()
+        self.truncated = len(a_lines) > max_lines or len(b_lines) > max_lines
+        a_lines, b_lines = a_lines[:max_lines], b_lines[:max_lines]
+        self.rows = []
+        self.pairs = []
+        for tag, i1, i2, j1, j2 in line_opcodes(a_lines, b_lines):
+            if tag == "equal":
+                self.rows.extend(("equal", line) for line in a_lines[i1:i2])
+                continue
+            first_del = len(self.rows)
+            self.rows.extend(("del", line) for line in a_lines[i1:i2])
+            first_ins = len(self.rows)
+            self.rows.extend(("ins", line) for line in b_lines[j1:j2])
+            if tag == "replace":
+                self.pairs.extend((first_del + k, first_ins + k) for k in range(min(i2 - i1, j2 - j1)))
+        self.changed = sum(1 for tag, _ in self.rows if tag != "equal")
@@ -0,0 +1,673 @@
+#!/usr/bin/env python3
+"""
+Long-lived helper JVMs used by grade_core to avoid paying JVM startup per test case.
+
+The Java side is embedded below and compiled once per JDK into a temp folder.
+Requests and responses are length-prefixed byte strings over the helper's stdin/stdout.
+"""
+import os, subprocess, threading, hashlib, locale, struct, tempfile, shutil, atexit, weakref
+from pathlib import Path
+
+RUNNER_SOURCE = r'''
+import java.io.*;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.lang.reflect.Modifier;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.nio.charset.Charset;
+import java.nio.charset.StandardCharsets;
+import java.security.Permission;
+import java.util.Locale;
+import java.util.Properties;
+import java.util.TimeZone;
+
+public class AutogradeRunner {
+    static final int OK = 0, TIMEOUT = 1, FALLBACK = 2, OUTPUT_LIMIT = 3;
+    static volatile boolean trapping = false;
+    static volatile boolean limitHit = false;
+    // What a fresh java process prints System.out/err in, read before any student code runs
+    static final String OUT_ENCODING = streamEncoding("stdout.encoding");
+    static final String ERR_ENCODING = streamEncoding("stderr.encoding");
+
+    static final class ExitTrap extends Error {
+        final int status;
+        ExitTrap(int status) {
+            super("System.exit(" + status + ")", null, false, false);
+            this.status = status;
+        }
+    }
+
+    static final class OutputLimit extends Error {
+        OutputLimit() {
+            super("output limit exceeded", null, false, false);
+        }
+    }
+
+    static final class CappedBuffer extends ByteArrayOutputStream {
+        final long cap;
+
+        CappedBuffer(long cap) {
+            this.cap = cap;
+        }
+
+        @Override public synchronized void write(int b) {
+            if (cap > 0 && count >= cap) {
+                limitHit = true;
+                throw new OutputLimit();
+            }
+            super.write(b);
+        }
+
+        @Override public synchronized void write(byte[] b, int off, int len) {
+            if (cap > 0 && count + (long) len > cap) {
+                super.write(b, off, (int) Math.max(0, cap - count));
+                limitHit = true;
+                throw new OutputLimit();
+            }
+            super.write(b, off, len);
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        DataInputStream in = new DataInputStream(new BufferedInputStream(new FileInputStream(FileDescriptor.in)));
+        DataOutputStream out = new DataOutputStream(new BufferedOutputStream(new FileOutputStream(FileDescriptor.out)));
+        boolean isolated;
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                @Override public void checkExit(int status) {
+                    if (trapping) throw new ExitTrap(status);
+                }
+                @Override public void checkPermission(Permission perm) { }
+                @Override public void checkPermission(Permission perm, Object context) { }
+            });
+            isolated = true;
+        } catch (Throwable t) {
+            isolated = false;
+        }
+        writeString(out, isolated ? "READY" : "NOISOLATION");
+        out.flush();
+        if (!isolated) return;
+        while (true) {
+            String cmd;
+            try {
+                cmd = readString(in);
+            } catch (EOFException e) {
+                return;
+            }
+            if (!"RUN".equals(cmd)) return;
+            String classpath = readString(in);
+            String mainClass = readString(in);
+            long timeoutMs = in.readLong();
+            long maxOutput = in.readLong();
+            byte[] input = readBytes(in);
+            boolean reusable = runOne(classpath, mainClass, timeoutMs, maxOutput, input, out);
+            out.flush();
+            // Leftover student threads would keep a plain return from exiting the JVM
+            if (!reusable) Runtime.getRuntime().halt(0);
+        }
+    }
+
+    static boolean runOne(String classpath, String mainClass, long timeoutMs, long maxOutput, byte[] input, DataOutputStream out) throws IOException {
+        final Method entry;
+        URLClassLoader loader;
+        try {
+            loader = new URLClassLoader(new URL[]{ new File(classpath).toURI().toURL() }, ClassLoader.getSystemClassLoader().getParent());
+            Class<?> cls = Class.forName(mainClass, false, loader);
+            entry = cls.getMethod("main", String[].class);
+            if (!Modifier.isStatic(entry.getModifiers())) throw new NoSuchMethodException("main");
+        } catch (Throwable t) {
+            respond(out, FALLBACK, true, 0, new byte[0], new byte[0]);
+            return true;
+        }
+
+        ByteArrayOutputStream stdout = new CappedBuffer(maxOutput);
+        ByteArrayOutputStream stderr = new CappedBuffer(maxOutput);
+        InputStream oldIn = System.in;
+        PrintStream oldOut = System.out, oldErr = System.err;
+        PrintStream capOut = new PrintStream(stdout, true, OUT_ENCODING);
+        PrintStream capErr = new PrintStream(stderr, true, ERR_ENCODING);
+        // Student code may change these; the next test must start from what a fresh JVM has
+        Locale oldLocale = Locale.getDefault();
+        Locale oldFormat = Locale.getDefault(Locale.Category.FORMAT);
+        Locale oldDisplay = Locale.getDefault(Locale.Category.DISPLAY);
+        TimeZone oldZone = TimeZone.getDefault();
+        Properties oldProps = (Properties) System.getProperties().clone();
+        final int[] exit = {0};
+        final boolean[] fallback = {false};
+        ThreadGroup group = new ThreadGroup("student");
+        Thread main = new Thread(group, new Runnable() {
+            public void run() {
+                try {
+                    entry.invoke(null, (Object) new String[0]);
+                } catch (InvocationTargetException e) {
+                    Throwable cause = e.getCause();
+                    if (cause instanceof ExitTrap) {
+                        exit[0] = ((ExitTrap) cause).status;
+                    } else if (cause instanceof OutputLimit) {
+                        exit[0] = 125;
+                    } else {
+                        exit[0] = 1;
+                        System.err.print("Exception in thread \"main\" ");
+                        cause.printStackTrace();
+                    }
+                } catch (ExitTrap e) {
+                    exit[0] = e.status;
+                } catch (OutputLimit e) {
+                    exit[0] = 125;
+                } catch (Throwable e) {
+                    fallback[0] = true;
+                }
+            }
+        }, "main");
+        main.setContextClassLoader(loader);
+
+        System.setIn(new ByteArrayInputStream(input));
+        System.setOut(capOut);
+        System.setErr(capErr);
+        trapping = true;
+        limitHit = false;
+        long deadline = timeoutMs > 0 ? System.currentTimeMillis() + timeoutMs : Long.MAX_VALUE;
+        boolean timedOut = false;
+        try {
+            main.start();
+            timedOut = !joinUntil(main, deadline);
+            if (!timedOut) {
+                // The real JVM also waits for non-daemon threads the student started
+                Thread[] others = new Thread[group.activeCount() + 8];
+                int n = group.enumerate(others);
+                for (int i = 0; i < n && !timedOut; i++) {
+                    if (!others[i].isDaemon()) timedOut = !joinUntil(others[i], deadline);
+                }
+            }
+        } finally {
+            trapping = false;
+            capOut.flush();
+            capErr.flush();
+            System.setIn(oldIn);
+            System.setOut(oldOut);
+            System.setErr(oldErr);
+            Locale.setDefault(oldLocale);
+            Locale.setDefault(Locale.Category.FORMAT, oldFormat);
+            Locale.setDefault(Locale.Category.DISPLAY, oldDisplay);
+            TimeZone.setDefault(oldZone);
+            System.setProperties(oldProps);
+        }
+
+        if (limitHit) {
+            respond(out, OUTPUT_LIMIT, false, 125, stdout.toByteArray(), stderr.toByteArray());
+            return false;
+        }
+        if (timedOut) {
+            respond(out, TIMEOUT, false, 124, stdout.toByteArray(), stderr.toByteArray());
+            return false;
+        }
+        boolean reusable = group.activeCount() == 0;
+        if (fallback[0]) {
+            respond(out, FALLBACK, reusable, 0, new byte[0], new byte[0]);
+        } else {
+            respond(out, OK, reusable, exit[0], stdout.toByteArray(), stderr.toByteArray());
+        }
+        if (reusable) {
+            try {
+                loader.close();
+            } catch (IOException ignored) {
+            }
+        }
+        return reusable;
+    }
+
+    static boolean joinUntil(Thread t, long deadline) {
+        while (t.isAlive()) {
+            long left = deadline - System.currentTimeMillis();
+            if (left <= 0 || limitHit) return false;
+            try {
+                t.join(Math.min(left, 50L));
+            } catch (InterruptedException e) {
+                return false;
+            }
+        }
+        return true;
+    }
+
+    static String streamEncoding(String property) {
+        String[] names = { System.getProperty(property), System.getProperty("native.encoding") };
+        for (int i = 0; i < names.length; i++) {
+            try {
+                if (names[i] != null && Charset.isSupported(names[i])) return names[i];
+            } catch (IllegalArgumentException e) {
+                // A malformed name: try the next one
+            }
+        }
+        return Charset.defaultCharset().name();
+    }
+
+    static void respond(DataOutputStream out, int status, boolean reusable, int exitCode, byte[] stdout, byte[] stderr) throws IOException {
+        out.writeInt(status);
+        out.writeInt(reusable ? 1 : 0);
+        out.writeInt(exitCode);
+        writeBytes(out, stdout);
+        writeBytes(out, stderr);
+    }
+
+    static byte[] readBytes(DataInputStream in) throws IOException {
+        byte[] b = new byte[in.readInt()];
+        in.readFully(b);
+        return b;
+    }
+
+    static String readString(DataInputStream in) throws IOException {
+        return new String(readBytes(in), StandardCharsets.UTF_8);
+    }
+
+    static void writeBytes(DataOutputStream out, byte[] b) throws IOException {
+        out.writeInt(b.length);
+        out.write(b);
+    }
+
+    static void writeString(DataOutputStream out, String s) throws IOException {
+        writeBytes(out, s.getBytes(StandardCharsets.UTF_8));
+    }
+}
+'''
+
+COMPILER_SOURCE = r'''
+import java.io.*;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.List;
+import javax.tools.JavaCompiler;
+import javax.tools.ToolProvider;
+
+public class AutogradeCompiler {
+    public static void main(String[] args) throws Exception {
+        DataInputStream in = new DataInputStream(new BufferedInputStream(new FileInputStream(FileDescriptor.in)));
+        DataOutputStream out = new DataOutputStream(new BufferedOutputStream(new FileOutputStream(FileDescriptor.out)));
+        JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+        writeString(out, compiler != null ? "READY" : "NOCOMPILER");
+        out.flush();
+        if (compiler == null) return;
+        while (true) {
+            String cmd;
+            try {
+                cmd = readString(in);
+            } catch (EOFException e) {
+                return;
+            }
+            if (!"COMPILE".equals(cmd)) return;
+            int n = in.readInt();
+            List<String> argv = new ArrayList<String>();
+            for (int i = 0; i < n; i++) argv.add(readString(in));
+            ByteArrayOutputStream stdout = new ByteArrayOutputStream();
+            ByteArrayOutputStream stderr = new ByteArrayOutputStream();
+            PrintStream capOut = new PrintStream(stdout, true);
+            PrintStream capErr = new PrintStream(stderr, true);
+            int rc;
+            try {
+                rc = compiler.run(null, capOut, capErr, argv.toArray(new String[0]));
+            } catch (Throwable t) {
+                t.printStackTrace(capErr);
+                rc = 4;
+            }
+            capOut.flush();
+            capErr.flush();
+            out.writeInt(rc);
+            writeBytes(out, stdout.toByteArray());
+            writeBytes(out, stderr.toByteArray());
+            out.flush();
+        }
+    }
+
+    static byte[] readBytes(DataInputStream in) throws IOException {
+        byte[] b = new byte[in.readInt()];
+        in.readFully(b);
+        return b;
+    }
+
+    static String readString(DataInputStream in) throws IOException {
+        return new String(readBytes(in), StandardCharsets.UTF_8);
+    }
+
+    static void writeBytes(DataOutputStream out, byte[] b) throws IOException {
+        out.writeInt(b.length);
+        out.write(b);
+    }
+
+    static void writeString(DataOutputStream out, String s) throws IOException {
+        writeBytes(out, s.getBytes(StandardCharsets.UTF_8));
+    }
+}
+'''
+
+STATUS_OK, STATUS_TIMEOUT, STATUS_FALLBACK, STATUS_OUTPUT_LIMIT = 0, 1, 2, 3
+
+# Grace period on top of the test timeout before the Python side gives up on a helper
+HELPER_GRACE_S = 10.0
+# Restart the compile daemon now and then so javac's caches cannot grow without bound
+COMPILER_MAX_JOBS = 500
+# A compile the daemon has not answered by then kills it; the caller falls back to a javac process
+COMPILE_TIMEOUT_S = 120.0
+
+_build_lock = threading.Lock()
+_no_isolation = set()
+_no_compiler = set()
+_compilers = {}
+_compilers_lock = threading.Lock()
+_all_helpers = []
+# Warm runners by the thread using them (one WarmJvm never serves two threads at once)
+_runners = {}
+_runners_lock = threading.Lock()
+
+
+def _text_encoding():
+    return locale.getpreferredencoding(False)
+
+
+def decode_output(data: bytes) -> str:
+    # Same newline handling as subprocess.run(..., text=True)
+    text = data.decode(_text_encoding(), errors="replace")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def encode_input(text: str) -> bytes:
+    if os.name == "nt":
+        text = text.replace("\n", "\r\n")
+    return text.encode(_text_encoding(), errors="replace")
+
+
+def build_helper(javac: str, class_name: str, source: str) -> Path | None:
+    """Compile an embedded helper class once per JDK; returns the classes folder or None."""
+    digest = hashlib.sha256((javac + "\0" + source).encode("utf-8")).hexdigest()[:16]
+    target = Path(tempfile.gettempdir())/"autograde_jvm"/f"{class_name}-{digest}"
+    if (target/f"{class_name}.class").exists():
+        return target
+    with _build_lock:
+        if (target/f"{class_name}.class").exists():
+            return target
+        target.parent.mkdir(parents=True, exist_ok=True)
+        work = Path(tempfile.mkdtemp(prefix=f"{class_name}-", dir=target.parent))
+        try:
+            (work/f"{class_name}.java").write_text(source, encoding="utf-8")
+            res = subprocess.run([javac, "-nowarn", "-encoding", "UTF-8", "-d", str(work), str(work/f"{class_name}.java")],
+                                 capture_output=True, text=True)
+            if res.returncode != 0:
+                return None
+            try:
+                os.replace(work, target)
+            except OSError:
+                # Another process finished first
+                pass
+            return target if (target/f"{class_name}.class").exists() else None
+        except OSError:
+            return None
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+class Count(int):
+    """Marks an int that the Java side reads with readInt()."""
+
+
+class HelperProcess:
+    """A helper JVM speaking the length-prefixed protocol of the embedded Java classes."""
+
+    def __init__(self, java: str, classes_dir: Path, class_name: str, jvm_flags=()):
+        self.proc = subprocess.Popen([java, *jvm_flags, "-cp", str(classes_dir), class_name],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        _all_helpers.append(self)
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def send(self, *parts):
+        """Strings and bytes are length-prefixed, ints go out as Java longs, Count(n) as a Java int."""
+        buf = bytearray()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            if isinstance(part, Count):
+                buf += struct.pack(">i", part)
+            elif isinstance(part, int):
+                buf += struct.pack(">q", part)
+            else:
+                buf += struct.pack(">i", len(part)) + part
+        self.proc.stdin.write(bytes(buf))
+        self.proc.stdin.flush()
+
+    def _read_exact(self, n: int) -> bytes:
+        data = self.proc.stdout.read(n)
+        if data is None or len(data) != n:
+            raise EOFError("helper JVM closed its output")
+        return data
+
+    def read_int(self) -> int:
+        return struct.unpack(">i", self._read_exact(4))[0]
+
+    def read_bytes(self) -> bytes:
+        return self._read_exact(self.read_int())
+
+    def read_string(self) -> str:
+        return self.read_bytes().decode("utf-8", errors="replace")
+
+    def call(self, reader, timeout_s=None):
+        """Run reader() with a deadline; kills the helper and returns None when it does not answer."""
+        box = {}
+
+        def target():
+            try:
+                box["value"] = reader()
+            except Exception as ex:
+                box["error"] = ex
+
+        t = threading.Thread(target=target, daemon=True)
+        t.start()
+        t.join(timeout_s)
+        if t.is_alive() or "error" in box:
+            self.close()
+            return None
+        return box["value"]
+
+    def close(self):
+        try:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait(timeout=5)
+        except Exception:
+            pass
+        try:
+            _all_helpers.remove(self)
+        except ValueError:
+            pass
+
+
+class WarmJvm:
+    """
+    Runs student programs inside a long-lived JVM: one fresh ClassLoader per test,
+    System.in/out/err redirected and System.exit trapped.
+    run() returns the same dict as grade_core.run_process, or None when the caller should
+    fall back to a normal `java` process.
+    jvm_flags (such as -Xmx) apply to the helper JVM and so to every test it runs.
+    """
+
+    def __init__(self, java: str, javac: str, jvm_flags=()):
+        self.java = java
+        self.javac = javac
+        self.jvm_flags = tuple(jvm_flags)
+        self.helper = None
+
+    def _start(self) -> bool:
+        if self.java in _no_isolation:
+            return False
+        classes = build_helper(self.javac, "AutogradeRunner", RUNNER_SOURCE)
+        if classes is None:
+            _no_isolation.add(self.java)
+            return False
+        # JDK 18+ needs the flag to allow System.setSecurityManager; older JDKs reject it
+        for flags in (["-Djava.security.manager=allow"], []):
+            try:
+                helper = HelperProcess(self.java, classes, "AutogradeRunner", ["-Xshare:auto", *self.jvm_flags, *flags])
+            except OSError:
+                break
+            hello = helper.call(helper.read_string, timeout_s=30)
+            if hello == "READY":
+                self.helper = helper
+                return True
+            helper.close()
+            if hello == "NOISOLATION":
+                break
+        _no_isolation.add(self.java)
+        return False
+
+    def run(self, classes_dir, main_class: str, input_text=None, timeout_ms=None, max_output_bytes=None):
+        if self.helper is None or not self.helper.alive():
+            self.helper = None
+            if not self._start():
+                return None
+        helper = self.helper
+        try:
+            helper.send("RUN", str(classes_dir), main_class, int(timeout_ms or 0), int(max_output_bytes or 0), encode_input(input_text or ""))
+        except OSError:
+            helper.close()
+            self.helper = None
+            return None
+
+        def read_response():
+            return helper.read_int(), helper.read_int(), helper.read_int(), helper.read_bytes(), helper.read_bytes()
+
+        limit = None if timeout_ms is None else timeout_ms/1000.0 + HELPER_GRACE_S
+        resp = helper.call(read_response, timeout_s=limit)
+        if resp is None:
+            self.helper = None
+            return None
+        status, reusable, exit_code, out, err = resp
+        if not reusable:
+            # Student threads are still running in there; start a new helper next time
+            helper.close()
+            self.helper = None
+        if status == STATUS_FALLBACK:
+            return None
+        res = {"ExitCode": exit_code, "Stdout": decode_output(out), "Stderr": decode_output(err), "Timeout": False, "Status": "OK"}
+        if status == STATUS_TIMEOUT:
+            res.update(Timeout=True, Status="Timeout", Stderr=res["Stderr"] + "\n[TIMEOUT]")
+        elif status == STATUS_OUTPUT_LIMIT:
+            res.update(Status="OutputLimitExceeded", Stderr=res["Stderr"] + "\n[OUTPUT LIMIT EXCEEDED]")
+        return res
+
+    def close(self):
+        if self.helper is not None:
+            self.helper.close()
+            self.helper = None
+
+
+class CompileService:
+    """
+    One warm javac (javax.tools.JavaCompiler) shared by all threads of a process.
+    compile() returns (returncode, stdout, stderr) like a `javac` run, or None when the
+    JDK has no in-process compiler and the caller should start `javac` itself.
+    """
+
+    def __init__(self, java: str, javac: str):
+        self.java = java
+        self.javac = javac
+        self.helper = None
+        self.jobs = 0
+        self.lock = threading.Lock()
+
+    def _start(self) -> bool:
+        if self.java in _no_compiler:
+            return False
+        classes = build_helper(self.javac, "AutogradeCompiler", COMPILER_SOURCE)
+        helper = None
+        if classes is not None:
+            try:
+                helper = HelperProcess(self.java, classes, "AutogradeCompiler", ["-Xshare:auto", "-XX:+UseSerialGC", "-XX:TieredStopAtLevel=1"])
+            except OSError:
+                helper = None
+        if helper is not None and helper.call(helper.read_string, timeout_s=30) == "READY":
+            self.helper = helper
+            self.jobs = 0
+            return True
+        if helper is not None:
+            helper.close()
+        _no_compiler.add(self.java)
+        return False
+
+    def compile(self, args, timeout_s=COMPILE_TIMEOUT_S):
+        """(returncode, stdout, stderr), or None when the caller should run javac: no daemon, or no answer in timeout_s."""
+        with self.lock:
+            if self.helper is not None and (not self.helper.alive() or self.jobs >= COMPILER_MAX_JOBS):
+                self.helper.close()
+                self.helper = None
+            if self.helper is None and not self._start():
+                return None
+            helper = self.helper
+            try:
+                helper.send("COMPILE", Count(len(args)), *[str(a) for a in args])
+            except OSError:
+                helper.close()
+                self.helper = None
+                return None
+            resp = helper.call(lambda: (helper.read_int(), helper.read_bytes(), helper.read_bytes()), timeout_s=timeout_s)
+            if resp is None:
+                self.helper = None
+                return None
+            self.jobs += 1
+            rc, out, err = resp
+            return rc, decode_output(out), decode_output(err)
+
+    def close(self):
+        with self.lock:
+            if self.helper is not None:
+                self.helper.close()
+                self.helper = None
+
+
+def get_compile_service(java: str, javac: str) -> CompileService:
+    with _compilers_lock:
+        key = (java, javac)
+        if key not in _compilers:
+            _compilers[key] = CompileService(java, javac)
+        return _compilers[key]
+
+
+def get_warm_jvm(java: str, javac: str, jvm_flags=()) -> WarmJvm:
+    """
+    One warm runner per (thread, JDK, JVM flags); batch worker processes each get their own.
+    A thread's runners are closed when the thread ends, or by release_warm_jvms (GradingJob.close
+    calls it) once the thread has ended.
+    """
+    ident = threading.get_ident()
+    key = (java, javac, tuple(jvm_flags))
+    with _runners_lock:
+        runners = _runners.get(ident)
+        if runners is None:
+            runners = _runners[ident] = {}
+            weakref.finalize(threading.current_thread(), release_warm_jvms, [ident])
+        if key not in runners:
+            runners[key] = WarmJvm(java, javac, jvm_flags)
+        return runners[key]
+
+
+def release_warm_jvms(thread_idents=None):
+    """Close and forget the runners of the given threads; by default of every thread that has ended."""
+    with _runners_lock:
+        if thread_idents is None:
+            alive = {t.ident for t in threading.enumerate()}
+            thread_idents = [ident for ident in _runners if ident not in alive]
+        released = [runner for ident in thread_idents for runner in _runners.pop(ident, {}).values()]
+    for runner in released:
+        runner.close()
+
+
+def stop_warm_jvms():
+    """Kill every warm runner of this process; a test inside one comes back as a failed helper call."""
+    with _runners_lock:
+        runners = [runner for by_key in _runners.values() for runner in by_key.values()]
+    for runner in runners:
+        runner.close()
+
+
+@atexit.register
+def _shutdown_helpers():
+    for helper in list(_all_helpers):
+        helper.close()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+SQLite store of per-test grading results, shared by every grading run of an exam.
+
+A test result is keyed on the submission hash (normalized Given/src + reference jar),
+the test-case file hash and the verdict-relevant defaults, so re-grading only runs
+tests whose inputs changed.
+
+ResultBundle is the optional single-file output of one grading run; BatchJournal records
+the finished submissions of a batch so an interrupted batch can resume.
+"""
+import hashlib, json, os, sqlite3, threading, time
+from pathlib import Path
+
+STORE_FILE_NAME = "results.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS test_results (
+    key TEXT PRIMARY KEY,
+    submission TEXT NOT NULL,
+    question TEXT NOT NULL,
+    testcase TEXT NOT NULL,
+    row_json TEXT NOT NULL,
+    meta_json TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS compiles (
+    submission TEXT PRIMARY KEY,
+    compiled INTEGER NOT NULL,
+    main_class TEXT NOT NULL,
+    compile_log TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS question_timings (
+    key TEXT PRIMARY KEY,
+    samples INTEGER NOT NULL,
+    compile_ms REAL,
+    test_ms REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+# Weight of the newest run in the smoothed question timings
+TIMING_SMOOTHING = 0.3
+
+
+def test_result_key(submission_hash: str, testcase_hash: str, rules: str) -> str:
+    return hashlib.sha256(f"{submission_hash}|{testcase_hash}|{rules}".encode("utf-8")).hexdigest()
+
+
+def question_timing_keys(question: str, suite_key: str):
+    """Timing history keys, most specific first: this exact test suite, then any suite of that question."""
+    return (f"{question}|{suite_key}", question)
+
+
+class ResultStore:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # Batch workers in other processes write to the same file; wait for their locks
+        self.conn = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        try:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.DatabaseError:
+            pass
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    @classmethod
+    def for_cache_dir(cls, cache_dir: Path):
+        return cls(Path(cache_dir)/STORE_FILE_NAME)
+
+    def get_test(self, key: str):
+        with self.lock:
+            cur = self.conn.execute("SELECT row_json, meta_json FROM test_results WHERE key = ?", (key,))
+            found = cur.fetchone()
+        if not found:
+            return None
+        return json.loads(found[0]), json.loads(found[1])
+
+    def has_test(self, key: str) -> bool:
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM test_results WHERE key = ?", (key,)).fetchone() is not None
+
+    def put_test(self, key: str, submission_hash: str, row: dict, meta: dict):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO test_results (key, submission, question, testcase, row_json, meta_json, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, submission_hash, row.get("Question", ""), row.get("TestCase", ""),
+                 json.dumps(row, ensure_ascii=False), json.dumps(meta, ensure_ascii=False), time.time()))
+            self.conn.commit()
+
+    def get_compile(self, submission_hash: str):
+        with self.lock:
+            cur = self.conn.execute("SELECT compiled, main_class, compile_log FROM compiles WHERE submission = ?", (submission_hash,))
+            found = cur.fetchone()
+        if not found:
+            return None
+        return {"Compiled": bool(found[0]), "MainClass": found[1], "CompileLog": found[2]}
+
+    def put_compile(self, submission_hash: str, compiled: bool, main_class: str, compile_log: str):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO compiles (submission, compiled, main_class, compile_log, created) VALUES (?, ?, ?, ?, ?)",
+                (submission_hash, int(bool(compiled)), main_class, compile_log, time.time()))
+            self.conn.commit()
+
+    def get_timing(self, keys):
+        """(compile_ms, test_ms) of the first key with recorded runs; compile_ms may be None."""
+        with self.lock:
+            for key in keys:
+                found = self.conn.execute("SELECT compile_ms, test_ms FROM question_timings WHERE key = ?", (key,)).fetchone()
+                if found:
+                    return found
+        return None
+
+    def record_timing(self, keys, compile_ms, test_ms: float):
+        """Fold one graded question into the smoothed timings; compile_ms None when it did not compile."""
+        with self.lock:
+            for key in keys:
+                found = self.conn.execute("SELECT samples, compile_ms, test_ms FROM question_timings WHERE key = ?", (key,)).fetchone()
+                samples, new_compile, new_test = 0, compile_ms, test_ms
+                if found:
+                    samples, old_compile, old_test = found
+                    new_test = old_test + TIMING_SMOOTHING * (test_ms - old_test)
+                    if compile_ms is None:
+                        new_compile = old_compile
+                    elif old_compile is not None:
+                        new_compile = old_compile + TIMING_SMOOTHING * (compile_ms - old_compile)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO question_timings (key, samples, compile_ms, test_ms, updated) VALUES (?, ?, ?, ?, ?)",
+                    (key, samples + 1, new_compile, new_test, time.time()))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+BUNDLE_FILE_NAME = "grading.sqlite"
+
+# Large per-test texts; a bundle stores each distinct one once and rows refer to it by hash
+RESULT_TEXT_FIELDS = ("Expected", "Got", "Stderr", "CompileLog")
+
+BUNDLE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    question TEXT NOT NULL,
+    testcase TEXT NOT NULL,
+    row_json TEXT NOT NULL,
+    meta_json TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tests_by_case ON tests (question, testcase);
+CREATE TABLE IF NOT EXISTS summaries (
+    question TEXT PRIMARY KEY,
+    summary_json TEXT NOT NULL
+);
+"""
+
+
+class ResultBundle:
+    """
+    Single-file output of one grading run (_grading_out/grading.sqlite), used instead of the
+    per-test expected/student/meta files. Rows keep <Field>Blob hashes in place of the texts.
+    """
+
+    def __init__(self, path: Path, readonly: bool = False):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        if readonly:
+            self.conn = sqlite3.connect(f"file:{self.path.as_posix()}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.conn.executescript(BUNDLE_SCHEMA)
+            self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _put_blob(self, text: str) -> str:
+        sha = hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+        self.conn.execute("INSERT OR IGNORE INTO blobs (sha, data) VALUES (?, ?)", (sha, text))
+        return sha
+
+    def put_test(self, row: dict, meta: dict) -> dict:
+        """Store one test result; returns the row with its texts replaced by blob hashes."""
+        slim = {k: v for k, v in row.items() if k not in RESULT_TEXT_FIELDS}
+        with self.lock:
+            for field in RESULT_TEXT_FIELDS:
+                slim[f"{field}Blob"] = self._put_blob(row.get(field) or "")
+            self.conn.execute(
+                "INSERT INTO tests (question, testcase, row_json, meta_json) VALUES (?, ?, ?, ?)",
+                (row.get("Question", ""), row.get("TestCase", ""),
+                 json.dumps(slim, ensure_ascii=False), json.dumps(meta, ensure_ascii=False)))
+        return slim
+
+    def put_summary(self, summary: dict):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO summaries (question, summary_json) VALUES (?, ?)",
+                              (summary["Question"], json.dumps(summary, ensure_ascii=False)))
+            self.conn.commit()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def iter_tests(self):
+        """Rows without their texts, in grading order."""
+        with self.lock:
+            found = self.conn.execute("SELECT row_json FROM tests ORDER BY id").fetchall()
+        for (row_json,) in found:
+            yield json.loads(row_json)
+
+    def get_meta(self, question: str, testcase: str):
+        with self.lock:
+            found = self.conn.execute("SELECT meta_json FROM tests WHERE question = ? AND testcase = ? ORDER BY id DESC",
+                                      (question, testcase)).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def get_text(self, sha: str) -> str:
+        with self.lock:
+            found = self.conn.execute("SELECT data FROM blobs WHERE sha = ?", (sha,)).fetchone()
+        return found[0] if found else ""
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class BatchJournal:
+    """
+    Append-only JSON-lines log of the submissions a batch has finished, one line each,
+    flushed to disk as soon as it is written. Entries are keyed on the submission name,
+    its content hash and the grading config; a crash leaves at most one torn last line,
+    which is skipped on load.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        for line in data.splitlines():
+            try:
+                entry = json.loads(line)
+                self.entries[(entry["Name"], entry["Hash"], entry["Config"])] = entry
+            except (ValueError, KeyError, TypeError):
+                continue
+        torn = bool(data) and not data.endswith(b"\n")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+        if torn:
+            self.file.write("\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def completed(self, name: str, content_hash: str, config: str):
+        """The stored row of a submission finished earlier with this content and config, else None."""
+        entry = self.entries.get((name, content_hash, config))
+        return entry["Row"] if entry and entry["Completed"] else None
+
+    def append(self, name: str, content_hash: str, config: str, row: dict, completed: bool):
+        entry = {"Name": name, "Hash": content_hash, "Config": config, "Completed": bool(completed),
+                 "Finished": time.time(), "Row": row}
+        line = json.dumps(entry, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries[(name, content_hash, config)] = entry
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -4,15 +4,214 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from pathlib import Path
 import webbrowser
-import difflib
 import os
 import json
-import csv
 import shutil
-import tempfile
-import zipfile
+from collections import OrderedDict, deque
+
+from grade_core import (grade_all, grade_batch, default_cache_dir, default_workers, prepare_root_path, relocate_zip_results,
+                        compile_testcase, load_result_texts, GradingJob, StreamingCsv, DEFAULT_MAX_OUTPUT_BYTES,
+                        DEFAULT_LIMITS)
+from grade_store import BatchJournal
+from grade_diff import LineDiff, refine_pair, DIFF_MAX_LINES
+
+# How many opened results keep their texts in memory
+TEXT_CACHE_SIZE = 32
+# Batch summaries keep a journal next to them (<summary>.journal.jsonl) so an interrupted batch can resume
+JOURNAL_SUFFIX = ".journal.jsonl"
+# How often the status bar shows the progress of a running job
+PROGRESS_POLL_MS = 250
+PROGRESS_UNITS = {"test": "testcase", "submission": "bài"}
+
+
+def _sort_key(value):
+    # "7.5 / 10.0" sorts by its score, everything else numerically when possible
+    text = str(value)
+    try:
+        return (0, float(text.split("/")[0]), "")
+    except ValueError:
+        return (1, 0.0, text.lower())
+
+
+class VirtualTable:
+    """
+    Treeview front end that only materializes the rows in view.
+    Records live in Python and the Treeview keeps one reusable item per visible line, so
+    updates, sorting and filtering never rebuild it. post() may be called from worker
+    threads; queued updates are applied in batches on the Tk thread every FLUSH_MS.
+    """
+    FLUSH_MS = 100
+
+    def __init__(self, tree: ttk.Treeview, scrollbar: ttk.Scrollbar):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.columns = list(tree["columns"])
+        self.heads = {c: tree.heading(c, "text") for c in self.columns}
+        self.records = {}      # key -> (values, tags)
+        self.order = []        # keys in arrival order
+        self.view = []         # keys after filter and sort
+        self.offset = 0
+        self.slots = []        # Treeview items, one per visible line
+        self.slot_keys = {}    # Treeview item -> key shown in it
+        self.selected = None
+        self.sort_col = None
+        self.sort_desc = False
+        self.filter_text = ""
+        self.pending = deque()
+
+        tree.configure(yscrollcommand="")
+        scrollbar.configure(command=self._on_scrollbar)
+        for c in self.columns:
+            tree.heading(c, command=lambda c=c: self.sort_by(c))
+        tree.bind("<Configure>", lambda _e: self._resize())
+        tree.bind("<MouseWheel>", lambda e: self._scroll(-1 if e.delta > 0 else 1, 3))
+        tree.bind("<Button-4>", lambda _e: self._scroll(-1, 3))
+        tree.bind("<Button-5>", lambda _e: self._scroll(1, 3))
+        tree.bind("<Up>", lambda _e: self._step(-1))
+        tree.bind("<Down>", lambda _e: self._step(1))
+        tree.bind("<Prior>", lambda _e: self._step(-max(1, len(self.slots) - 1)))
+        tree.bind("<Next>", lambda _e: self._step(max(1, len(self.slots) - 1)))
+        tree.bind("<<TreeviewSelect>>", self._on_select)
+        tree.after(self.FLUSH_MS, self._flush)
+
+    # Data -------------------------------------------------------------
+    def post(self, key, update, tags=()):
+        """Queue a row; update is a values tuple or a callable (old values, old tags) -> (values, tags)."""
+        self.pending.append((key, update, tags))
+
+    def set_rows(self, rows):
+        self.pending.clear()
+        self.records = {key: (tuple(values), tuple(tags)) for key, values, tags in rows}
+        self.order = [key for key, _, _ in rows]
+        self.offset = 0
+        self.selected = None
+        self._apply_view()
+
+    def clear(self):
+        self.set_rows([])
+
+    def get(self, key):
+        found = self.records.get(key)
+        return found[0] if found else None
+
+    def key_of(self, item):
+        return self.slot_keys.get(item)
+
+    def _flush(self):
+        if self.pending:
+            while self.pending:
+                key, update, tags = self.pending.popleft()
+                old = self.records.get(key)
+                if callable(update):
+                    values, tags = update(old[0] if old else None, old[1] if old else ())
+                else:
+                    values = update
+                if values is None:
+                    continue
+                if old is None:
+                    self.order.append(key)
+                self.records[key] = (tuple(values), tuple(tags or ()))
+            self._apply_view()
+        try:
+            self.tree.after(self.FLUSH_MS, self._flush)
+        except tk.TclError:
+            pass
+
+    # View -------------------------------------------------------------
+    def sort_by(self, col):
+        self.sort_desc = (not self.sort_desc) if self.sort_col == col else False
+        self.sort_col = col
+        for c in self.columns:
+            arrow = (" ▼" if self.sort_desc else " ▲") if c == col else ""
+            self.tree.heading(c, text=self.heads[c] + arrow)
+        self._apply_view()
+
+    def set_filter(self, text: str):
+        self.filter_text = (text or "").strip().lower()
+        self.offset = 0
+        self._apply_view()
+
+    def _apply_view(self):
+        needle = self.filter_text
+        keys = [k for k in self.order if not needle or any(needle in str(v).lower() for v in self.records[k][0])]
+        if self.sort_col is not None:
+            idx = self.columns.index(self.sort_col)
+            keys.sort(key=lambda k: _sort_key(self.records[k][0][idx] if idx < len(self.records[k][0]) else ""),
+                      reverse=self.sort_desc)
+        self.view = keys
+        self._render()
+
+    def _resize(self):
+        rowheight = int(ttk.Style(self.tree).lookup("Treeview", "rowheight") or 20)
+        # One row is taken by the headings
+        wanted = max(1, self.tree.winfo_height() // rowheight - 1)
+        while len(self.slots) < wanted:
+            self.slots.append(self.tree.insert("", "end"))
+        while len(self.slots) > wanted:
+            item = self.slots.pop()
+            self.slot_keys.pop(item, None)
+            self.tree.delete(item)
+        self._render()
+
+    def _render(self):
+        n = len(self.slots)
+        self.offset = max(0, min(self.offset, len(self.view) - n))
+        focus_item = None
+        for i, item in enumerate(self.slots):
+            idx = self.offset + i
+            if idx < len(self.view):
+                key = self.view[idx]
+                values, tags = self.records[key]
+                self.tree.move(item, "", i)
+                self.tree.item(item, values=values, tags=tags)
+                self.slot_keys[item] = key
+                if key == self.selected:
+                    focus_item = item
+            else:
+                self.tree.detach(item)
+                self.slot_keys.pop(item, None)
+        if focus_item is not None:
+            self.tree.selection_set(focus_item)
+            self.tree.focus(focus_item)
+        elif self.tree.selection():
+            self.tree.selection_remove(*self.tree.selection())
+        total = len(self.view)
+        if total and n < total:
+            self.scrollbar.set(self.offset / total, min(1.0, (self.offset + n) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def _on_scrollbar(self, *args):
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * len(self.view))
+        elif args[0] == "scroll":
+            self.offset += int(args[1]) * (max(1, len(self.slots) - 1) if args[2] == "pages" else 1)
+        self._render()
+
+    def _scroll(self, direction, lines):
+        self.offset += direction * lines
+        self._render()
+        return "break"
+
+    def _step(self, delta):
+        if not self.view:
+            return "break"
+        idx = self.view.index(self.selected) + delta if self.selected in self.view else self.offset
+        idx = max(0, min(idx, len(self.view) - 1))
+        self.selected = self.view[idx]
+        if idx < self.offset:
+            self.offset = idx
+        elif idx >= self.offset + len(self.slots):
+            self.offset = idx - len(self.slots) + 1
+        self._render()
+        return "break"
+
+    def _on_select(self, _event):
+        sel = self.tree.selection()
+        # Selections cleared by _render while the row is scrolled away keep the remembered row
+        if sel and sel[0] in self.slot_keys:
+            self.selected = self.slot_keys[sel[0]]
 
-from grade_core import grade_all
 
 class GraderUI(tk.Tk):
     def __init__(self):
@@ -27,9 +226,21 @@ class GraderUI(tk.Tk):
         # Defaults / overrides
         self.strict_var = tk.BooleanVar(value=False)
         self.ignore_trailing_var = tk.BooleanVar(value=False)
+        self.warm_jvm_var = tk.BooleanVar(value=False)
+        self.compile_daemon_var = tk.BooleanVar(value=False)
+        self.early_fail_var = tk.BooleanVar(value=False)
+        self.single_file_var = tk.BooleanVar(value=False)
         self.default_rs = tk.StringVar(value="default")  # default/yes/no
         self.default_cs = tk.StringVar(value="default")  # default/yes/no
         self.timeout_ms_var = tk.StringVar(value="")     # optional
+        self.workers_var = tk.StringVar(value=str(default_workers()))
+        self.max_output_kb_var = tk.StringVar(value=str(DEFAULT_MAX_OUTPUT_BYTES // 1024))
+        # Per-test limits of student programs; an empty field turns the limit off
+        self.limit_vars = {key: tk.StringVar(value=str(value or "")) for key, value in DEFAULT_LIMITS.items()}
+        # The running grading job; grading threads only replace progress_info, the Tk thread shows it
+        self.job = None
+        self.job_label = ""
+        self.progress_info = None
 
         self._build_widgets()
 
@@ -55,6 +266,7 @@ class GraderUI(tk.Tk):
         ttk.Button(actions, text="Tạo testcase...", command=self.open_testcase_dialog).pack(side="left")
         ttk.Button(actions, text="Chấm hàng loạt...", command=self.run_batch_grade).pack(side="left", padx=6)
         ttk.Button(actions, text="Chấm nhiều ZIP...", command=self.run_multi_zip_grade).pack(side="left")
+        ttk.Button(actions, text="Dừng chấm", command=self.cancel_job).pack(side="left", padx=6)
 
         # Settings
         settings = ttk.Labelframe(self, text="Thiết lập so sánh (mặc định nếu testcase không chỉ rõ)", padding=10)
@@ -62,6 +274,8 @@ class GraderUI(tk.Tk):
 
         ttk.Checkbutton(settings, text="Strict compare (không chuẩn hoá gì)", variable=self.strict_var).grid(row=0, column=0, sticky="w")
         ttk.Checkbutton(settings, text="Bỏ khoảng trắng cuối dòng (ignore trailing spaces per line)", variable=self.ignore_trailing_var).grid(row=0, column=1, sticky="w", padx=10)
+        ttk.Checkbutton(settings, text="Warm JVM (chạy testcase trong JVM dùng lại)", variable=self.warm_jvm_var).grid(row=0, column=2, columnspan=3, sticky="w", padx=10)
+        ttk.Checkbutton(settings, text="Compile daemon (javac chạy sẵn)", variable=self.compile_daemon_var).grid(row=0, column=5, columnspan=3, sticky="w", padx=10)
 
         ttk.Label(settings, text="Default REMOVE_SPACES:").grid(row=1, column=0, sticky="w", pady=6)
         cb_rs = ttk.Combobox(settings, textvariable=self.default_rs, values=["default","yes","no"], width=10, state="readonly")
@@ -76,6 +290,22 @@ class GraderUI(tk.Tk):
         ttk.Label(settings, text="TIMEOUT_MS (mặc định):").grid(row=1, column=4, sticky="w")
         ttk.Entry(settings, textvariable=self.timeout_ms_var, width=12).grid(row=1, column=5, sticky="w")
 
+        ttk.Label(settings, text="Số tiến trình chấm (batch):").grid(row=1, column=6, sticky="w", padx=(10,0))
+        ttk.Entry(settings, textvariable=self.workers_var, width=6).grid(row=1, column=7, sticky="w")
+
+        ttk.Label(settings, text="Giới hạn output mỗi luồng (KB):").grid(row=2, column=0, sticky="w")
+        ttk.Entry(settings, textvariable=self.max_output_kb_var, width=12).grid(row=2, column=1, sticky="w")
+        ttk.Checkbutton(settings, text="Dừng sớm khi output đã sai (early-fail)", variable=self.early_fail_var).grid(row=2, column=2, columnspan=4, sticky="w", padx=10)
+        ttk.Checkbutton(settings, text="Gộp kết quả vào một file (grading.sqlite)", variable=self.single_file_var).grid(row=2, column=6, columnspan=2, sticky="w", padx=10)
+
+        limit_labels = [("MemoryMb", "RAM mỗi test (MB):"), ("StackKb", "Stack (KB):"), ("CpuSeconds", "CPU (giây):"),
+                        ("MaxProcesses", "Số tiến trình/luồng:"), ("FileSizeMb", "File ghi tối đa (MB):")]
+        limits_row = ttk.Frame(settings)
+        limits_row.grid(row=3, column=0, columnspan=8, sticky="w", pady=(6, 0))
+        for key, text in limit_labels:
+            ttk.Label(limits_row, text=text).pack(side="left", padx=(0, 4))
+            ttk.Entry(limits_row, textvariable=self.limit_vars[key], width=7).pack(side="left", padx=(0, 12))
+
         # Results tables (single + batch)
         mid = ttk.Frame(self, padding=10)
         mid.pack(fill="both", expand=True)
@@ -86,6 +316,8 @@ class GraderUI(tk.Tk):
         single_tab = ttk.Frame(notebook)
         notebook.add(single_tab, text="Kết quả đơn lẻ")
 
+        self.filter_var = tk.StringVar()
+        self._filter_bar(single_tab, self.filter_var)
         cols = ("Question","TestCase","Passed","Mark","Rules","Runtime")
         self.tree = ttk.Treeview(single_tab, columns=cols, show="headings", selectmode="browse")
         heads = {
@@ -98,12 +330,17 @@ class GraderUI(tk.Tk):
             self.tree.column(c, width=widths[c], anchor="center" if c in ("Passed","Mark") else "w")
         self.tree.pack(fill="both", expand=True, side="left")
         self.tree.bind("<Double-1>", self.on_open_detail)
-        vsb = ttk.Scrollbar(single_tab, orient="vertical", command=self.tree.yview)
-        self.tree.configure(yscrollcommand=vsb.set)
+        vsb = ttk.Scrollbar(single_tab, orient="vertical")
         vsb.pack(side="right", fill="y")
+        self.tree.tag_configure("pass", background="#e8ffe8")
+        self.tree.tag_configure("fail", background="#ffe8e8")
+        self.results_table = VirtualTable(self.tree, vsb)
+        self.filter_var.trace_add("write", lambda *_: self.results_table.set_filter(self.filter_var.get()))
 
         batch_tab = ttk.Frame(notebook)
         notebook.add(batch_tab, text="Batch ZIP")
+        self.batch_filter_var = tk.StringVar()
+        self._filter_bar(batch_tab, self.batch_filter_var)
         batch_cols = ("StudentID","FullName","Progress","Score","Q1","Q2","Q3","Q4")
         self.batch_tree = ttk.Treeview(batch_tab, columns=batch_cols, show="headings", selectmode="browse")
         batch_heads = {
@@ -116,11 +353,12 @@ class GraderUI(tk.Tk):
             anchor = "center" if c.startswith("Q") or c in ("Progress","Score","StudentID") else "w"
             self.batch_tree.column(c, width=batch_widths[c], anchor=anchor)
         self.batch_tree.pack(fill="both", expand=True, side="left")
-        batch_vsb = ttk.Scrollbar(batch_tab, orient="vertical", command=self.batch_tree.yview)
-        self.batch_tree.configure(yscrollcommand=batch_vsb.set)
+        batch_vsb = ttk.Scrollbar(batch_tab, orient="vertical")
         batch_vsb.pack(side="right", fill="y")
         self.batch_tree.tag_configure("pass", background="#e8ffe8")
         self.batch_tree.tag_configure("fail", background="#ffe8e8")
+        self.batch_table = VirtualTable(self.batch_tree, batch_vsb)
+        self.batch_filter_var.trace_add("write", lambda *_: self.batch_table.set_filter(self.batch_filter_var.get()))
 
         bottom = ttk.Frame(self, padding=10)
         bottom.pack(fill="x")
@@ -135,7 +373,15 @@ class GraderUI(tk.Tk):
 
         self.out_dir = None
         self.detail_cache = {}
-        self.batch_items = {}
+        # Expected/Got/Stderr/CompileLog of recently opened results; rows themselves only point at them
+        self.text_cache = OrderedDict()
+
+    def _filter_bar(self, parent, var):
+        bar = ttk.Frame(parent)
+        bar.pack(side="top", fill="x", pady=(0, 4))
+        ttk.Label(bar, text="Lọc:").pack(side="left")
+        ttk.Entry(bar, textvariable=var, width=40).pack(side="left", padx=6)
+        ttk.Label(bar, text="(bấm tiêu đề cột để sắp xếp)", foreground="#777").pack(side="left")
 
     def choose_root(self):
         d = filedialog.askdirectory(title="Chọn thư mục gốc chứa Q1..Q4")
@@ -165,62 +411,43 @@ class GraderUI(tk.Tk):
             timeout_ms = int(timeout_ms) if timeout_ms else None
         except Exception:
             timeout_ms = None
+        max_output_kb = self.max_output_kb_var.get().strip()
+        try:
+            max_output = int(max_output_kb) * 1024 if max_output_kb else None
+        except Exception:
+            max_output = DEFAULT_MAX_OUTPUT_BYTES
+        limits = {}
+        for key, var in self.limit_vars.items():
+            value = var.get().strip()
+            try:
+                limits[key] = max(0, int(value)) if value else 0
+            except Exception:
+                limits[key] = None
         return {
             "Strict": bool(self.strict_var.get()),
             "IgnoreTrailingPerLine": bool(self.ignore_trailing_var.get()),
             "RemoveSpaces": parse_opt(self.default_rs.get()),
             "CaseSensitive": parse_opt(self.default_cs.get()),
             "TimeoutMs": timeout_ms,
+            "MaxOutputBytes": max_output,
+            "WarmJvm": bool(self.warm_jvm_var.get()),
+            "CompileDaemon": bool(self.compile_daemon_var.get()),
+            "EarlyFail": bool(self.early_fail_var.get()),
+            "OutputFormat": "sqlite" if self.single_file_var.get() else "files",
+            **limits,
         }
 
-    def _looks_like_question_root(self, folder: Path) -> bool:
+    def _workers(self):
         try:
-            return any(p.is_dir() and p.name.upper().startswith("Q") for p in folder.iterdir())
+            return max(1, int(self.workers_var.get().strip()))
         except Exception:
-            return False
-
-    def _guess_root_in_dir(self, base: Path) -> Path | None:
-        if self._looks_like_question_root(base):
-            return base
-        for child in base.iterdir():
-            if child.is_dir() and self._looks_like_question_root(child):
-                return child
-        return None
+            return default_workers()
 
     def _prepare_root_path(self, root_value: str):
-        path = Path(root_value)
-        if path.is_dir():
-            return {"root": path, "cleanup": None, "zip_source": None}
-        if path.is_file() and path.suffix.lower() == ".zip":
-            temp_base = Path(tempfile.mkdtemp(prefix="autograde_zip_"))
-            try:
-                with zipfile.ZipFile(path, "r") as zf:
-                    zf.extractall(temp_base)
-            except Exception as ex:
-                shutil.rmtree(temp_base, ignore_errors=True)
-                raise RuntimeError(f"Giải nén ZIP thất bại: {ex}")
-            guessed = self._guess_root_in_dir(temp_base) or temp_base
-            return {"root": guessed, "cleanup": temp_base, "zip_source": path}
-        raise FileNotFoundError("Không tìm thấy thư mục hoặc ZIP hợp lệ.")
+        return prepare_root_path(root_value)
 
     def _relocate_zip_results(self, zip_source: Path, data: dict):
-        out_dir = data.get("out_dir")
-        if not out_dir:
-            return None
-        src = Path(out_dir)
-        dest = zip_source.with_name(f"{zip_source.stem}_grading_out")
-        if dest.exists():
-            shutil.rmtree(dest, ignore_errors=True)
-        shutil.move(str(src), dest)
-        new_path = str(dest)
-        prefix = str(src)
-        for r in data.get("results", []):
-            for key in ("ExpectedPath","StudentPath"):
-                val = r.get(key)
-                if isinstance(val, str) and val.startswith(prefix):
-                    r[key] = new_path + val[len(prefix):]
-        data["out_dir"] = new_path
-        return new_path
+        return relocate_zip_results(zip_source, data)
 
     def _parse_zip_name(self, stem: str):
         parts = stem.split("_", 1)
@@ -247,6 +474,46 @@ class GraderUI(tk.Tk):
             return "FALSE"
         return ""
 
+    def _start_job(self, label):
+        if self.job is not None:
+            messagebox.showwarning("Đang chấm", "Đang có một lượt chấm chạy. Hãy chờ xong hoặc bấm 'Dừng chấm'.")
+            return None
+        self.job_label = label
+        self.progress_info = None
+        self.job = GradingJob(on_progress=self._on_job_progress)
+        self.after(PROGRESS_POLL_MS, self._poll_progress)
+        return self.job
+
+    def _on_job_progress(self, info):
+        # Grading threads: a plain attribute swap, no Tk calls
+        self.progress_info = info
+
+    def _poll_progress(self):
+        if self.job is None:
+            return
+        info = self.progress_info
+        if info and not self.job.cancelled:
+            unit = PROGRESS_UNITS.get(info["Unit"], info["Unit"])
+            eta = f" — còn khoảng {self._format_duration(info['EtaS'])}" if info["EtaS"] is not None else ""
+            self.status_var.set(f"{self.job_label}: {info['Done']}/{info['Total']} {unit}{eta}")
+        self.after(PROGRESS_POLL_MS, self._poll_progress)
+
+    def _format_duration(self, seconds):
+        minutes, secs = divmod(int(round(seconds)), 60)
+        return f"{minutes}:{secs:02d}" if minutes else f"{secs}s"
+
+    def _finish_job(self, job):
+        job.close()
+        if self.job is job:
+            self.job = None
+
+    def cancel_job(self):
+        if self.job is None:
+            messagebox.showinfo("Thông tin", "Không có lượt chấm nào đang chạy.")
+            return
+        self.job.cancel()
+        self.status_var.set("Đang dừng... các JVM đang chạy đã bị dừng, kết quả đã chấm vẫn được giữ.")
+
     def run_grade(self):
         root_value = self.root_var.get().strip()
         if not root_value:
@@ -257,10 +524,19 @@ class GraderUI(tk.Tk):
         except Exception as exc:
             messagebox.showerror("Lỗi", str(exc))
             return
+        job = self._start_job("Đang chấm")
+        if job is None:
+            if prep.get("cleanup"):
+                shutil.rmtree(prep["cleanup"], ignore_errors=True)
+            return
+        # Tk variables are only read here, on the Tk thread
+        java_home = self.java_home_var.get().strip()
+        defaults = self._defaults()
 
         self.status_var.set("Đang chấm...")
-        self.tree.delete(*self.tree.get_children())
+        self.results_table.clear()
         self.detail_cache.clear()
+        self.text_cache.clear()
         self.out_dir = None
         self.total_var.set("")
 
@@ -268,35 +544,43 @@ class GraderUI(tk.Tk):
             cleanup_root = prep.get("cleanup")
             zip_source = prep.get("zip_source")
             try:
-                data = grade_all(prep["root"], self.java_home_var.get().strip(), defaults=self._defaults())
+                data = grade_all(prep["root"], java_home, defaults=defaults, cache_dir=prep["cache_dir"], job=job)
                 if zip_source:
                     self._relocate_zip_results(zip_source, data)
-                self.out_dir = data.get("out_dir")
+                out_dir = data.get("out_dir")
                 results = data.get("results", [])
                 for r in results:
-                    rules = f"RS={'YES' if r['RemoveSpaces'] else 'NO' if r['RemoveSpaces'] is not None else 'default'}; "                             f"CS={'YES' if r['CaseSensitive'] else 'NO' if r['CaseSensitive'] is not None else 'default'}; "                             f"Strict={self.strict_var.get()}; IgnoreTrail={self.ignore_trailing_var.get()}"
-                    runtime = f"Exit={r['ExitCode']}; Error={r['RuntimeError']}; Empty={r['EmptyOutput']}; Timeout={r['Timeout']}"
+                    rules = f"RS={'YES' if r['RemoveSpaces'] else 'NO' if r['RemoveSpaces'] is not None else 'default'}; "                             f"CS={'YES' if r['CaseSensitive'] else 'NO' if r['CaseSensitive'] is not None else 'default'}; "                             f"Strict={defaults['Strict']}; IgnoreTrail={defaults['IgnoreTrailingPerLine']}"
+                    status = f"{r['Status']} ({r['LimitExceeded']})" if r.get("LimitExceeded") else r.get("Status", "")
+                    runtime = f"{status}; Exit={r['ExitCode']}; Error={r['RuntimeError']}; Empty={r['EmptyOutput']}; Timeout={r['Timeout']}"
                     values = (r["Question"], r["TestCase"], "PASS" if r["Passed"] else "FAIL", f"{r['Mark']}", rules, runtime)
-                    item_id = self.tree.insert("", "end", values=values)
-                    self.tree.item(item_id, tags=("pass",) if r["Passed"] else ("fail",))
                     self.detail_cache[(r["Question"], r["TestCase"])] = r
-
-                self.tree.tag_configure("pass", background="#e8ffe8")
-                self.tree.tag_configure("fail", background="#ffe8e8")
+                    self.results_table.post((r["Question"], r["TestCase"]), values, ("pass",) if r["Passed"] else ("fail",))
 
                 total_score = data.get("total_score", 0.0)
                 total_max   = data.get("total_max", 0.0)
-                self.total_var.set(f"Tổng điểm: {total_score} / {total_max}")
-                self.status_var.set(f"Hoàn tất. Kết quả tại: {self.out_dir}")
+                reuse = data.get("reuse", {})
+                done = "Đã dừng, kết quả một phần" if data.get("cancelled") else "Hoàn tất"
+                status = f"{done} (dùng lại {reuse.get('reused', 0)}, chạy {reuse.get('executed', 0)} testcase). Kết quả tại: {out_dir}"
+                self.after(0, self._after_grade, out_dir, f"Tổng điểm: {total_score} / {total_max}", status)
             except Exception as e:
-                self.status_var.set("Có lỗi khi chấm.")
-                messagebox.showerror("Lỗi", str(e))
+                self.after(0, self._grading_failed, str(e))
             finally:
                 if cleanup_root:
                     shutil.rmtree(cleanup_root, ignore_errors=True)
+                self.after(0, self._finish_job, job)
 
         threading.Thread(target=worker, daemon=True).start()
 
+    def _after_grade(self, out_dir, total, status):
+        self.out_dir = out_dir
+        self.total_var.set(total)
+        self.status_var.set(status)
+
+    def _grading_failed(self, message):
+        self.status_var.set("Có lỗi khi chấm.")
+        messagebox.showerror("Lỗi", message)
+
     def open_testcase_dialog(self):
         root = self.root_var.get().strip()
         if not root:
@@ -317,51 +601,92 @@ class GraderUI(tk.Tk):
         if not parent:
             return
         parent_path = Path(parent)
-        child_dirs = [p for p in parent_path.iterdir() if p.is_dir() and not p.name.startswith("_")]
+        child_dirs = sorted([p for p in parent_path.iterdir() if p.is_dir() and not p.name.startswith("_")], key=lambda p: p.name)
         if not child_dirs:
             messagebox.showwarning("Không tìm thấy", "Thư mục này không chứa bài nộp con.")
             return
         java_home = self.java_home_var.get().strip()
         defaults_template = self._defaults()
-        self.status_var.set(f"Đang chấm hàng loạt trong {parent_path} ...")
+        cache_dir = default_cache_dir(parent_path)
+        workers = self._workers()
+        job = self._start_job("Đang chấm hàng loạt")
+        if job is None:
+            return
+        self.status_var.set(f"Đang chấm hàng loạt trong {parent_path} ({workers} tiến trình)...")
+        self._reset_batch_tree(child_dirs, lambda p: p.name)
+
+        summary_path = parent_path / "_batch_summary.csv"
+
+        def to_entry(folder, res):
+            max_score = res["Max"]
+            entry = {"Student": folder.name, "Score": "", "Max": "", "Percent": "", "OutDir": "", "Error": res["Error"]}
+            if not res["Error"]:
+                entry.update({
+                    "Score": res["Score"],
+                    "Max": max_score,
+                    "Percent": round(100.0 * res["Score"] / max_score, 2) if max_score else 0.0,
+                    "OutDir": res["OutDir"],
+                })
+            return entry
 
         def worker():
-            rows = []
-            for folder in sorted(child_dirs, key=lambda p: p.name):
-                entry = {"Student": folder.name, "Score": "", "Max": "", "Percent": "", "OutDir": "", "Error": ""}
-                try:
-                    q_dirs = [c for c in folder.iterdir() if c.is_dir() and c.name.upper().startswith("Q")]
-                    if not q_dirs:
-                        raise RuntimeError("Không tìm thấy thư mục Q* trong bài nộp này.")
-                    data = grade_all(folder, java_home, defaults=defaults_template.copy())
-                    score = data.get("total_score", 0.0)
-                    max_score = data.get("total_max", 0.0)
-                    percent = round(100.0 * score / max_score, 2) if max_score else 0.0
-                    entry.update({
-                        "Score": score,
-                        "Max": max_score,
-                        "Percent": percent,
-                        "OutDir": data.get("out_dir", ""),
-                        "Error": ""
-                    })
-                except Exception as ex:
-                    entry["Error"] = str(ex)
-                rows.append(entry)
-            summary_path = parent_path / "_batch_summary.csv"
-            with open(summary_path, "w", newline='', encoding="utf-8") as f:
-                writer = csv.DictWriter(f, fieldnames=["Student","Score","Max","Percent","OutDir","Error"])
-                writer.writeheader()
-                for row in rows:
-                    writer.writerow(row)
-            self.after(0, lambda: self._after_batch(summary_path, rows))
+            summary = None
+            rows = None
+
+            def on_result(src, row):
+                entry = {"Progress": self._progress_label(row), "Score": row["Score"], "Max": row["Max"], "Error": row["Error"]}
+                entry.update(self._extract_question_passes(row["Summaries"]))
+                self._update_batch_row(src, entry)
+                summary.add(to_entry(Path(src), row))
+
+            try:
+                # Finished submissions reach the CSV and the journal as they come in, not after the last one
+                summary = StreamingCsv(summary_path, ["Student","Score","Max","Percent","OutDir","Error"])
+                with BatchJournal(summary_path.with_suffix(JOURNAL_SUFFIX)) as journal:
+                    results = grade_batch(child_dirs, java_home, defaults_template, cache_dir=cache_dir, workers=workers,
+                                          on_result=on_result, job=job, journal=journal)
+                rows = [to_entry(folder, res) for folder, res in zip(child_dirs, results)]
+                dedup = self._dedup_rate(results)
+            except Exception as e:
+                self.after(0, self._grading_failed, str(e))
+            finally:
+                if summary is not None:
+                    summary.finish(rows)
+                self.after(0, self._finish_job, job)
+            if rows is not None:
+                self.after(0, lambda: self._after_batch(summary_path, rows, dedup))
 
         threading.Thread(target=worker, daemon=True).start()
 
-    def _after_batch(self, summary_path, rows):
+    def _dedup_rate(self, results):
+        hits = sum(r.get("DedupHits", 0) for r in results)
+        total = sum(r.get("DedupTotal", 0) for r in results)
+        pct = round(100.0 * hits / total, 1) if total else 0.0
+        reused = sum(r.get("TestsReused", 0) for r in results)
+        executed = sum(r.get("TestsExecuted", 0) for r in results)
+        resumed = sum(1 for r in results if r.get("Resumed"))
+        text = f"Dùng lại kết quả trùng: {hits}/{total} câu ({pct}%); testcase dùng lại {reused}, chạy mới {executed}"
+        if resumed:
+            text += f"; bỏ qua {resumed} bài đã chấm ở lần trước"
+        return text
+
+    def _progress_label(self, row):
+        if row.get("Cancelled"):
+            return "Đã huỷ" if row["Error"] else "Dừng giữa chừng"
+        return "Lỗi" if row["Error"] else "Hoàn tất"
+
+    def _after_batch(self, summary_path, rows, dedup=""):
         ok = sum(1 for r in rows if not r["Error"])
         fail = len(rows) - ok
-        self.status_var.set(f"Chấm hàng loạt xong: {ok} OK, {fail} lỗi. Kết quả: {summary_path}")
-        messagebox.showinfo("Hoàn tất", f"Đã tạo file tổng hợp: {summary_path}\nThành công: {ok}  Lỗi: {fail}")
+        self.status_var.set(f"Chấm hàng loạt xong: {ok} OK, {fail} lỗi. {dedup}. Kết quả: {summary_path}")
+        messagebox.showinfo("Hoàn tất", f"Đã tạo file tổng hợp: {summary_path}\nThành công: {ok}  Lỗi: {fail}\n{dedup}")
+
+    def _reset_batch_tree(self, sources, name_of):
+        rows = []
+        for src in sources:
+            student_id, full_name = self._parse_zip_name(name_of(src))
+            rows.append((str(src), (student_id, full_name, "Chờ", "", "", "", "", ""), ()))
+        self.batch_table.set_rows(rows)
 
     def run_multi_zip_grade(self):
         files = filedialog.askopenfilenames(title="Chọn nhiều file ZIP", filetypes=[("ZIP","*.zip")])
@@ -369,77 +694,87 @@ class GraderUI(tk.Tk):
             return
         java_home = self.java_home_var.get().strip()
         defaults = self._defaults()
-        self.status_var.set(f"Đang chấm {len(files)} ZIP...")
+        workers = self._workers()
+        job = self._start_job(f"Đang chấm {len(files)} ZIP")
+        if job is None:
+            return
+        self.status_var.set(f"Đang chấm {len(files)} ZIP ({workers} tiến trình)...")
 
-        self.batch_tree.delete(*self.batch_tree.get_children())
-        self.batch_items = {}
         paths = [Path(f) for f in files]
-        for zip_path in paths:
+        cache_dir = default_cache_dir(paths[0].parent)
+        self._reset_batch_tree(paths, lambda p: p.stem)
+
+        def to_entry(zip_path, res):
             student_id, full_name = self._parse_zip_name(zip_path.stem)
-            iid = self.batch_tree.insert("", "end", values=(student_id, full_name, "Chờ", "", "", "", "", ""))
-            self.batch_items[str(zip_path)] = iid
+            entry = {
+                "StudentID": student_id,
+                "FullName": full_name,
+                "Q1": "",
+                "Q2": "",
+                "Q3": "",
+                "Q4": "",
+                "Score": "",
+                "Max": "",
+                "Error": res["Error"],
+                "Progress": self._progress_label(res),
+            }
+            if not res["Error"]:
+                entry["Score"] = res["Score"]
+                entry["Max"] = res["Max"]
+                entry.update(self._extract_question_passes(res["Summaries"]))
+            return entry
+
+        summary_path = paths[0].parent / "_KetQua.csv"
+        fields = ["StudentID","FullName","Q1","Q2","Q3","Q4","Score","Max","Error"]
+
+        def to_csv_row(entry):
+            row_out = {k: entry.get(k, "") for k in fields}
+            for key in ("Q1","Q2","Q3","Q4"):
+                row_out[key] = self._format_bool(row_out[key])
+            return row_out
 
         def worker():
-            rows = []
-            for zip_path in paths:
-                student_id, full_name = self._parse_zip_name(zip_path.stem)
-                entry = {
-                    "StudentID": student_id,
-                    "FullName": full_name,
-                    "Q1": "",
-                    "Q2": "",
-                    "Q3": "",
-                    "Q4": "",
-                    "Score": "",
-                    "Max": "",
-                    "Error": "",
-                }
-                try:
-                    self.after(0, self._update_batch_row, str(zip_path), {"Progress":"Đang chấm"})
-                    prep = self._prepare_root_path(str(zip_path))
-                    try:
-                        data = grade_all(prep["root"], java_home, defaults=defaults.copy())
-                        if prep["zip_source"]:
-                            self._relocate_zip_results(prep["zip_source"], data)
-                        entry["Score"] = data.get("total_score", 0.0)
-                        entry["Max"] = data.get("total_max", 0.0)
-                        entry.update(self._extract_question_passes(data.get("summaries")))
-                        entry["Progress"] = "Hoàn tất"
-                    finally:
-                        cleanup = prep.get("cleanup")
-                        if cleanup:
-                            shutil.rmtree(cleanup, ignore_errors=True)
-                except Exception as ex:
-                    entry["Error"] = str(ex)
-                    entry["Progress"] = "Lỗi"
-                rows.append(entry)
-                self.after(0, self._update_batch_row, str(zip_path), entry)
-
-            summary_path = paths[0].parent / "_KetQua.csv"
-            fields = ["StudentID","FullName","Q1","Q2","Q3","Q4","Score","Max","Error"]
-            with open(summary_path, "w", newline='', encoding="utf-8") as f:
-                writer = csv.DictWriter(f, fieldnames=fields)
-                writer.writeheader()
-                for row in rows:
-                    row_out = {k: row.get(k, "") for k in fields}
-                    for key in ("Q1","Q2","Q3","Q4"):
-                        row_out[key] = self._format_bool(row_out[key])
-                    writer.writerow(row_out)
-            self.after(0, lambda: self._after_multi_zip(summary_path, rows))
+            summary = None
+            rows = None
+
+            def on_result(src, res):
+                entry = to_entry(Path(src), res)
+                self._update_batch_row(src, entry)
+                summary.add(to_csv_row(entry))
+
+            try:
+                # Finished ZIPs reach the CSV and the journal as they come in, not after the last one
+                summary = StreamingCsv(summary_path, fields)
+                with BatchJournal(summary_path.with_suffix(JOURNAL_SUFFIX)) as journal:
+                    results = grade_batch(paths, java_home, defaults, cache_dir=cache_dir, workers=workers, on_result=on_result,
+                                          job=job, journal=journal)
+                rows = [to_entry(zip_path, res) for zip_path, res in zip(paths, results)]
+                dedup = self._dedup_rate(results)
+            except Exception as e:
+                self.after(0, self._grading_failed, str(e))
+            finally:
+                if summary is not None:
+                    summary.finish(None if rows is None else [to_csv_row(r) for r in rows])
+                self.after(0, self._finish_job, job)
+            if rows is not None:
+                self.after(0, lambda: self._after_multi_zip(summary_path, rows, dedup))
 
         threading.Thread(target=worker, daemon=True).start()
 
-    def _after_multi_zip(self, summary_path, rows):
+    def _after_multi_zip(self, summary_path, rows, dedup=""):
         ok = sum(1 for r in rows if not r["Error"])
         fail = len(rows) - ok
-        self.status_var.set(f"Chấm ZIP xong: {ok} OK, {fail} lỗi. File: {summary_path}")
-        messagebox.showinfo("Hoàn tất", f"Đã xuất: {summary_path}\nThành công: {ok}  Lỗi: {fail}")
+        self.status_var.set(f"Chấm ZIP xong: {ok} OK, {fail} lỗi. {dedup}. File: {summary_path}")
+        messagebox.showinfo("Hoàn tất", f"Đã xuất: {summary_path}\nThành công: {ok}  Lỗi: {fail}\n{dedup}")
 
     def _update_batch_row(self, zip_key, entry):
-        iid = self.batch_items.get(zip_key)
-        if not iid:
-            return
-        values = list(self.batch_tree.item(iid, "values"))
+        # Called from grading threads; the merge runs on the Tk thread when the table flushes
+        self.batch_table.post(zip_key, lambda values, tags: self._merge_batch_row(values, tags, entry))
+
+    def _merge_batch_row(self, values, tags, entry):
+        if values is None:
+            return values, tags
+        values = list(values)
         if "Progress" in entry:
             values[2] = entry["Progress"]
         if "Score" in entry and entry["Score"] != "":
@@ -449,25 +784,30 @@ class GraderUI(tk.Tk):
         for idx, key in enumerate(("Q1","Q2","Q3","Q4"), start=4):
             if key in entry:
                 values[idx] = self._format_bool(entry[key])
-        self.batch_tree.item(iid, values=values)
         if entry.get("Error"):
-            self.batch_tree.item(iid, tags=("fail",))
+            tags = ("fail",)
         elif entry.get("Progress") == "Hoàn tất":
-            self.batch_tree.item(iid, tags=("pass",))
+            tags = ("pass",)
+        return values, tags
 
     def on_open_detail(self, event):
         sel = self.tree.focus()
         if not sel:
             return
-        values = self.tree.item(sel, "values")
-        if not values:
-            return
-        q, tc, *_ = values
-        key = (q, tc)
+        key = self.results_table.key_of(sel)
         if key not in self.detail_cache:
             return
         r = self.detail_cache[key]
-        DetailWindow(self, r)
+        DetailWindow(self, r, self._result_texts(key, r))
+
+    def _result_texts(self, key, r):
+        texts = self.text_cache.pop(key, None)
+        if texts is None:
+            texts = load_result_texts(r)
+        self.text_cache[key] = texts
+        while len(self.text_cache) > TEXT_CACHE_SIZE:
+            self.text_cache.popitem(last=False)
+        return texts
 
     def open_out_dir(self):
         if self.out_dir and os.path.isdir(self.out_dir):
@@ -492,7 +832,7 @@ class GraderUI(tk.Tk):
             messagebox.showinfo("Thông tin", "Chưa tìm thấy summary.csv")
 
 class DetailWindow(tk.Toplevel):
-    def __init__(self, master, r):
+    def __init__(self, master, r, texts=None):
         super().__init__(master)
         self.title(f"Chi tiết — {r['Question']} / {r['TestCase']}")
         self.geometry("1200x850")
@@ -501,17 +841,23 @@ class DetailWindow(tk.Toplevel):
         info.pack(fill="x")
         ttk.Label(info, text=f"Compiled: {'YES' if r['Compiled'] else 'NO'} — MainClass: {r['MainClass']} — Mark: {r['Mark']}").pack(side="left")
 
-        runtime_line = f"ExitCode={r['ExitCode']}  RuntimeError={r['RuntimeError']}  EmptyOutput={r['EmptyOutput']}  Timeout={r['Timeout']}"
+        runtime_line = f"Status={r.get('Status', '')}  ExitCode={r['ExitCode']}  RuntimeError={r['RuntimeError']}  EmptyOutput={r['EmptyOutput']}  Timeout={r['Timeout']}"
+        if r.get("LimitExceeded"):
+            runtime_line += f"  LimitExceeded={r['LimitExceeded']}"
+        if r.get("WallMs") is not None:
+            runtime_line += f"  Wall={r['WallMs']}ms  CPU={r.get('CpuMs') if r.get('CpuMs') is not None else '?'}ms  PeakRSS={r.get('PeakRssKb') if r.get('PeakRssKb') is not None else '?'}KB"
         ttk.Label(self, text=runtime_line, foreground="#555").pack(anchor="w", padx=10)
 
+        texts = texts if texts is not None else load_result_texts(r)
+
         btns = ttk.Frame(self, padding=8)
         btns.pack(fill="x")
-        ttk.Button(btns, text="Mở Expected", command=lambda: self.open_path(r["ExpectedPath"])).pack(side="left")
-        ttk.Button(btns, text="Mở Student", command=lambda: self.open_path(r["StudentPath"])).pack(side="left", padx=6)
-        if not r["Compiled"] and r["CompileLog"]:
-            ttk.Button(btns, text="Xem Compile Log", command=lambda: self.show_text("Compile Log", r["CompileLog"])).pack(side="left", padx=6)
-        if r["Stderr"]:
-            ttk.Button(btns, text="Xem Stderr", command=lambda: self.show_text("Stderr", r["Stderr"])).pack(side="left", padx=6)
+        ttk.Button(btns, text="Mở Expected", command=lambda: self.open_path(r["ExpectedPath"] or self.export_text(r, "expected", texts["Expected"]))).pack(side="left")
+        ttk.Button(btns, text="Mở Student", command=lambda: self.open_path(r["StudentPath"] or self.export_text(r, "student", texts["Got"]))).pack(side="left", padx=6)
+        if not r["Compiled"] and texts["CompileLog"]:
+            ttk.Button(btns, text="Xem Compile Log", command=lambda: self.show_text("Compile Log", texts["CompileLog"])).pack(side="left", padx=6)
+        if texts["Stderr"]:
+            ttk.Button(btns, text="Xem Stderr", command=lambda: self.show_text("Stderr", texts["Stderr"])).pack(side="left", padx=6)
 
         paned = ttk.PanedWindow(self, orient=tk.HORIZONTAL)
         paned.pack(fill="both", expand=True, padx=8, pady=8)
@@ -520,14 +866,14 @@ class DetailWindow(tk.Toplevel):
         ttk.Label(left, text="Expected").pack(anchor="w")
         self.txt_expected = tk.Text(left, wrap="word")
         self.txt_expected.pack(fill="both", expand=True)
-        self.txt_expected.insert("1.0", r["Expected"] or "")
+        self.txt_expected.insert("1.0", texts["Expected"])
         paned.add(left, weight=1)
 
         right = ttk.Frame(paned)
         ttk.Label(right, text="Got (Student)").pack(anchor="w")
         self.txt_got = tk.Text(right, wrap="word")
         self.txt_got.pack(fill="both", expand=True)
-        self.txt_got.insert("1.0", r["Got"] or "")
+        self.txt_got.insert("1.0", texts["Got"])
         paned.add(right, weight=1)
 
         diff_frame = ttk.Frame(self, padding=8)
@@ -535,26 +881,90 @@ class DetailWindow(tk.Toplevel):
         ttk.Label(diff_frame, text="Diff:").pack(anchor="w")
         self.txt_diff = tk.Text(diff_frame, wrap="none", height=16)
         self.txt_diff.pack(fill="both", expand=True)
-        self.show_colored_diff(r["Expected"] or "", r["Got"] or "")
+        self.show_colored_diff(texts["Expected"], texts["Got"])
 
     def show_colored_diff(self, expected, got):
-        # Colored character-level diff
-        sm = difflib.SequenceMatcher(None, expected, got)
-        for tag, i1, i2, j1, j2 in sm.get_opcodes():
-            s1 = expected[i1:i2]
-            s2 = got[j1:j2]
-            if tag == "equal":
-                self.txt_diff.insert("end", s1)
-            elif tag == "delete":
-                self.txt_diff.insert("end", s1, ("del",))
-            elif tag == "insert":
-                self.txt_diff.insert("end", s2, ("ins",))
-            elif tag == "replace":
-                self.txt_diff.insert("end", s1, ("del",))
-                self.txt_diff.insert("end", s2, ("ins",))
-        # Tag styles
+        # Line diff off the Tk thread; characters are refined only for changed lines on screen
         self.txt_diff.tag_configure("del", background="#ffe0e0")
         self.txt_diff.tag_configure("ins", background="#e0ffe0")
+        self.txt_diff.tag_configure("del_char", background="#ff9c9c")
+        self.txt_diff.tag_configure("ins_char", background="#8fe08f")
+        self.txt_diff.tag_configure("note", foreground="#888")
+        self.txt_diff.insert("end", "Đang so sánh...", ("note",))
+        self.diff = None
+        self._refine_pending = False
+
+        def work():
+            diff = LineDiff(expected, got)
+            self.after(0, self._render_diff, diff)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def _render_diff(self, diff):
+        if not self.winfo_exists():
+            return
+        self.diff = diff
+        self.refined = set()
+        self.pair_by_row = {}
+        for pair in diff.pairs:
+            self.pair_by_row[pair[0]] = pair
+            self.pair_by_row[pair[1]] = pair
+
+        # One insert call with runs of same-tag lines keeps big outputs fast
+        args, run_tag, run = [], None, []
+        for tag, line in diff.rows:
+            if tag != run_tag and run:
+                args += ["".join(run), () if run_tag == "equal" else (run_tag,)]
+                run = []
+            run_tag = tag
+            run.append({"equal": "  ", "del": "- ", "ins": "+ "}[tag] + line + "\n")
+        if run:
+            args += ["".join(run), () if run_tag == "equal" else (run_tag,)]
+        if diff.truncated:
+            args += [f"... chỉ so sánh {DIFF_MAX_LINES} dòng đầu\n", ("note",)]
+        if not diff.rows:
+            args += ["(cả hai output đều rỗng)\n", ("note",)]
+        self.txt_diff.delete("1.0", "end")
+        self.txt_diff.insert("end", *args)
+        self.txt_diff.tag_raise("del_char")
+        self.txt_diff.tag_raise("ins_char")
+        self.txt_diff.configure(yscrollcommand=lambda *_: self._schedule_refine())
+        self.txt_diff.bind("<Configure>", lambda _e: self._schedule_refine())
+        self._schedule_refine()
+
+    def _schedule_refine(self):
+        if not self._refine_pending:
+            self._refine_pending = True
+            self.after_idle(self._refine_visible)
+
+    def _refine_visible(self):
+        self._refine_pending = False
+        if self.diff is None or not self.winfo_exists():
+            return
+        top = int(self.txt_diff.index("@0,0").split(".")[0]) - 1
+        bottom = int(self.txt_diff.index(f"@0,{self.txt_diff.winfo_height()}").split(".")[0])
+        for row in range(top, bottom):
+            pair = self.pair_by_row.get(row)
+            if pair is None or pair in self.refined:
+                continue
+            self.refined.add(pair)
+            del_row, ins_row = pair
+            a, b = self.diff.rows[del_row][1], self.diff.rows[ins_row][1]
+            # Text lines are 1-based and every row starts with a 2-character marker
+            for tag, i1, i2, j1, j2 in refine_pair(a, b):
+                if tag in ("replace", "delete") and i2 > i1:
+                    self.txt_diff.tag_add("del_char", f"{del_row + 1}.{i1 + 2}", f"{del_row + 1}.{i2 + 2}")
+                if tag in ("replace", "insert") and j2 > j1:
+                    self.txt_diff.tag_add("ins_char", f"{ins_row + 1}.{j1 + 2}", f"{ins_row + 1}.{j2 + 2}")
+
+    def export_text(self, r, kind, text):
+        # Results kept in grading.sqlite have no file of their own; write one next to it to open
+        bundle = r.get("Bundle")
+        if not bundle:
+            return ""
+        target = Path(bundle).with_name(f"{r['Question']}-{Path(r['TestCase']).stem}-{kind}.txt")
+        target.write_text(text, encoding="utf-8", errors="ignore")
+        return str(target)
 
     def open_path(self, p):
         if not p: return
@@ -614,27 +1024,28 @@ class TestcaseDialog(tk.Toplevel):
         self.timeout_var = tk.StringVar()
         ttk.Entry(form, textvariable=self.timeout_var, width=10).grid(row=5, column=3, sticky="w")
 
+        self.check_var = tk.StringVar()
+        self.check_label = ttk.Label(form, textvariable=self.check_var, wraplength=640, justify="left")
+        self.check_label.grid(row=6, column=0, columnspan=4, sticky="w", pady=(6, 0))
+
         btns = ttk.Frame(form, padding=10)
-        btns.grid(row=6, column=0, columnspan=4, sticky="e")
+        btns.grid(row=7, column=0, columnspan=4, sticky="e")
         ttk.Button(btns, text="Lưu", command=self.save).pack(side="right")
         ttk.Button(btns, text="Hủy", command=self.destroy).pack(side="right", padx=6)
 
         form.columnconfigure(1, weight=1)
         form.columnconfigure(3, weight=1)
 
-    def save(self):
-        q = self.q_var.get()
-        name = self.name_var.get().strip()
-        if not name:
-            messagebox.showwarning("Thiếu thông tin", "Nhập tên file testcase.")
-            return
-        if not name.lower().endswith(".txt"):
-            name += ".txt"
+        # Validate while typing with the same parser the grader uses
+        for var in (self.name_var, self.rs_var, self.cs_var, self.mark_var, self.timeout_var):
+            var.trace_add("write", lambda *_: self.validate())
+        for widget in (self.txt_input, self.txt_output):
+            widget.bind("<KeyRelease>", lambda _e: self.validate())
+        self.validate()
+
+    def _content(self):
         input_text = self.txt_input.get("1.0", "end").strip("\n")
         output_text = self.txt_output.get("1.0", "end").strip("\n")
-        if not input_text or not output_text:
-            messagebox.showwarning("Thiếu thông tin", "INPUT và OUTPUT không được để trống.")
-            return
         mark = self.mark_var.get().strip() or "1.0"
         timeout = self.timeout_var.get().strip()
         sections = []
@@ -647,7 +1058,43 @@ class TestcaseDialog(tk.Toplevel):
         sections.append(f"MARK:\n{mark}")
         if timeout:
             sections.append(f"TIMEOUT_MS:\n{timeout}")
-        content = "\n".join(sections).rstrip() + "\n"
+        return input_text, output_text, "\n".join(sections).rstrip() + "\n"
+
+    def problems(self):
+        problems = []
+        if not self.name_var.get().strip():
+            problems.append("Nhập tên file testcase.")
+        input_text, output_text, content = self._content()
+        if not input_text or not output_text:
+            problems.append("INPUT và OUTPUT không được để trống.")
+        tc = compile_testcase(self.name_var.get().strip() or "new.txt", content)
+        problems.extend(tc.problems)
+        if input_text and tc.input_text != input_text:
+            problems.append("INPUT chứa một dòng tiêu đề mục (vd: OUTPUT:), file sẽ bị đọc sai.")
+        if output_text and tc.expected_output != output_text:
+            problems.append("OUTPUT chứa một dòng tiêu đề mục (vd: MARK:), file sẽ bị đọc sai.")
+        return problems
+
+    def validate(self):
+        problems = self.problems()
+        if problems:
+            self.check_var.set("\n".join(f"• {p}" for p in problems))
+            self.check_label.configure(foreground="#b00020")
+        else:
+            self.check_var.set("✓ Testcase hợp lệ")
+            self.check_label.configure(foreground="#1b7f3b")
+        return not problems
+
+    def save(self):
+        q = self.q_var.get()
+        problems = self.problems()
+        if problems:
+            messagebox.showwarning("Testcase chưa hợp lệ", "\n".join(problems))
+            return
+        name = self.name_var.get().strip()
+        if not name.lower().endswith(".txt"):
+            name += ".txt"
+        _, _, content = self._content()
 
         target = self.root_path / q / "TestCases" / name
         if target.exists():